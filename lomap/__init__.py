@@ -61,6 +61,8 @@ Using
 
 from .dbmol import DBMolecules
 from .dbmol import SMatrix
+from .dbmol import SparseSMatrix
+from .dbmol import ScoreStore
 from .dbmol import Molecule
 from .mcs import MCS
 
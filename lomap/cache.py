@@ -0,0 +1,297 @@
+# ******************
+# MODULE DOCSTRING
+# ******************
+
+"""
+
+LOMAP: Persistent pair score cache
+=====
+
+Alchemical free energy calculations hold increasing promise as an aid to drug
+discovery efforts. However, applications of these techniques in discovery
+projects have been relatively few, partly because of the difficulty of planning
+and setting up calculations. The Lead Optimization Mapper (LOMAP) is an
+automated algorithm to plan efficient relative free energy calculations between
+potential ligands within a substantial of compounds.
+
+"""
+
+# *****************************************************************************
+# Lomap2: A toolkit to plan alchemical relative binding affinity calculations
+# Copyright 2015 - 2016  UC Irvine and the Authors
+#
+# Authors: Dr Gaetano Calabro' and Dr David Mobley
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see http://www.gnu.org/licenses/
+# *****************************************************************************
+
+
+# ****************
+# MODULE IMPORTS
+# ****************
+
+import hashlib
+import logging
+import os
+import sqlite3
+
+__all__ = ['ScoreCache', 'molecule_key', 'options_key']
+
+# Bump this when the scoring rules change, so that stale cached scores are never reused
+CACHE_VERSION = 1
+
+
+def molecule_key(mol, coords=False):
+    """
+    This function computes a content hash of an RDKit molecule. The hash
+    depends on the molecular graph in input atom order (the MCS atom maps
+    refer to input atom indexes), on the charges used by the electrostatic
+    rule and, optionally, on the 3D coordinates. The molecule name is not
+    used, so renamed files map to the same key
+
+    Parameters
+    ----------
+    mol : RDKit molecule object
+        the molecule to hash
+    coords : bool
+        if True the atom coordinates are included in the hash
+
+    Returns
+    -------
+    key : str
+        the hexadecimal hash of the molecule
+
+    """
+
+    h = hashlib.sha256()
+
+    for at in mol.GetAtoms():
+        charge = at.GetProp('_TriposPartialCharge') if at.HasProp('_TriposPartialCharge') else ''
+        h.update(('%d,%d,%d,%d,%d,%s;' % (at.GetAtomicNum(), at.GetFormalCharge(), at.GetIsotope(),
+                                          int(at.GetChiralTag()), at.GetNumExplicitHs(), charge)).encode())
+
+    bonds = sorted((min(b.GetBeginAtomIdx(), b.GetEndAtomIdx()), max(b.GetBeginAtomIdx(), b.GetEndAtomIdx()),
+                    int(b.GetBondType()), int(b.GetStereo())) for b in mol.GetBonds())
+    h.update(repr(bonds).encode())
+
+    if coords and mol.GetNumConformers() > 0:
+        conf = mol.GetConformer()
+        for i in range(mol.GetNumAtoms()):
+            pos = conf.GetAtomPosition(i)
+            h.update(('%.4f,%.4f,%.4f;' % (pos.x, pos.y, pos.z)).encode())
+
+    return h.hexdigest()
+
+
+def options_key(options):
+    """
+    This function computes a hash of the user options that affect the pair scores
+
+    Parameters
+    ----------
+    options : argparse python object
+        the list of user options
+
+    Returns
+    -------
+    key : str
+        the hexadecimal hash of the scoring options
+
+    """
+
+    opts = 'v%d time=%s ecrscore=%r max3d=%r threed=%s' % (CACHE_VERSION, options.time, float(options.ecrscore),
+                                                          float(options.max3d), bool(options.threed))
+
+    return hashlib.sha256(opts.encode()).hexdigest()
+
+
+def transpose_map(map_str):
+    """
+    Swap the two molecules in an MCS atom map string atom_m1:atom_m2,...
+    The returned string is sorted by first index as MCS.all_atom_match_list() does
+    """
+
+    if not map_str:
+        return map_str
+
+    pairs = [tuple(int(x) for x in p.split(':')) for p in map_str.split(',')]
+
+    return ",".join([str(j) + ":" + str(i) for (j, i) in sorted((j, i) for (i, j) in pairs)])
+
+
+class ScoreCache(object):
+    """
+    This class implements an on-disk cache of the pair scores and MCS atom
+    maps. Entries are addressed by the content hashes of the two molecules and
+    of the scoring options. The cache is stored in an SQLite database, so that
+    it can be shared between concurrent runs on the same filesystem, and it is
+    bounded in size by evicting the least recently used entries
+
+    """
+
+    def __init__(self, fname, max_entries=1000000):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        fname : str
+            the cache file name
+        max_entries : int
+            the maximum number of stored molecule pairs
+
+        """
+
+        self.fname = fname
+        self.max_entries = max_entries
+
+        # Counters used for reporting
+        self.hits = 0
+        self.misses = 0
+
+        # Pending writes and access time updates, flushed in a single transaction
+        self.__pending = []
+        self.__touched = []
+
+        # The connection is opened lazily and per process, as SQLite connections
+        # must not be shared across a fork
+        self.__conn = None
+        self.__pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_ScoreCache__conn'] = None
+        state['_ScoreCache__pid'] = None
+        state['_ScoreCache__pending'] = []
+        state['_ScoreCache__touched'] = []
+        return state
+
+    def _connect(self):
+
+        if self.__conn is not None and self.__pid == os.getpid():
+            return self.__conn
+
+        # Buffered entries inherited from a parent process are owned by the parent
+        if self.__pid is not None:
+            self.__pending = []
+            self.__touched = []
+
+        self.__conn = sqlite3.connect(self.fname, timeout=600, isolation_level=None)
+        self.__pid = os.getpid()
+
+        with self.__conn:
+            self.__conn.execute('CREATE TABLE IF NOT EXISTS pairs (key TEXT PRIMARY KEY, strict REAL, loose REAL, '
+                                'true_strict REAL, map TEXT, last_used INTEGER)')
+            self.__conn.execute('CREATE INDEX IF NOT EXISTS pairs_last_used ON pairs (last_used)')
+
+        return self.__conn
+
+    @staticmethod
+    def pair_key(keyi, keyj, optkey):
+        return hashlib.sha256((keyi + keyj + optkey).encode()).hexdigest()
+
+    def lookup(self, keyi, keyj, optkey):
+        """
+        Retrieve the cached scores of a molecule pair. A pair stored in the
+        opposite order is also returned, with its atom map transposed
+
+        Parameters
+        ----------
+        keyi : str
+            the first molecule key
+        keyj : str
+            the second molecule key
+        optkey : str
+            the scoring options key
+
+        Returns
+        -------
+        entry : tuple or None
+            the tuple (strict, loose, true_strict, map string) or None if the
+            pair is not cached. The map string is None if the MCS failed
+
+        """
+
+        conn = self._connect()
+
+        for swap, key in ((False, self.pair_key(keyi, keyj, optkey)), (True, self.pair_key(keyj, keyi, optkey))):
+            row = conn.execute('SELECT strict, loose, true_strict, map FROM pairs WHERE key=?', (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                self.__touched.append(key)
+                if swap:
+                    row = (row[0], row[1], row[2], transpose_map(row[3]))
+                return tuple(row)
+
+        self.misses += 1
+        return None
+
+    def store(self, keyi, keyj, optkey, strict, loose, true_strict, map_str):
+        """
+        Add the scores of a molecule pair to the cache. Entries are buffered and
+        written by flush()
+
+        """
+
+        self.__pending.append((self.pair_key(keyi, keyj, optkey), strict, loose, true_strict, map_str))
+
+        if len(self.__pending) >= 100:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered entries, update the access times of the cache hits and
+        evict the least recently used entries exceeding the size bound
+
+        """
+
+        if self.__conn is None or self.__pid != os.getpid():
+            self._connect()
+
+        if not self.__pending and not self.__touched:
+            return
+
+        conn = self.__conn
+
+        with conn:
+            # The access time is a counter rather than a clock, so that the LRU order is
+            # strict. Taking the write lock first keeps it consistent between processes
+            conn.execute('BEGIN IMMEDIATE')
+            now = conn.execute('SELECT COALESCE(MAX(last_used), 0) + 1 FROM pairs').fetchone()[0]
+            conn.executemany('INSERT OR REPLACE INTO pairs (key, strict, loose, true_strict, map, last_used) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', [e + (now,) for e in self.__pending])
+            conn.executemany('UPDATE pairs SET last_used=? WHERE key=?', [(now, k) for k in self.__touched])
+
+            excess = conn.execute('SELECT COUNT(*) FROM pairs').fetchone()[0] - self.max_entries
+            if excess > 0:
+                logging.info('Score cache: evicting %d entries' % excess)
+                conn.execute('DELETE FROM pairs WHERE key IN (SELECT key FROM pairs ORDER BY last_used ASC LIMIT ?)',
+                             (excess,))
+
+        self.__pending = []
+        self.__touched = []
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM pairs').fetchone()[0]
+
+    def close(self):
+        """
+        Flush the pending entries and close the database connection
+        """
+
+        if self.__conn is not None and self.__pid == os.getpid():
+            self.flush()
+            self.__conn.close()
+        self.__conn = None
+        self.__pid = None
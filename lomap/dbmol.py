@@ -41,22 +41,34 @@ potential ligands within a substantial of compounds.
 # ****************
 
 import argparse
-import glob
 import logging
 import math
 import multiprocessing
 import os
 import pickle
+import queue
+import sys
+import time
 from ._version import get_versions
 
 import networkx as nx
 import numpy as np
+from . import cache
+from . import fp
 from . import graphgen
 from . import mcs
+from . import molstore
+from . import readers
 from rdkit import Chem
 from rdkit import DataStructs
 
-__all__ = ['DBMolecules', 'SMatrix', 'Molecule']
+__all__ = ['DBMolecules', 'SMatrix', 'SparseSMatrix', 'ScoreStore', 'Molecule']
+
+# Status of the molecule pairs of the similarity score matrices (DBMolecules.pair_status)
+PAIR_SCORED = 0         # the pair has been scored, or will be
+PAIR_PREFILTERED = 1    # the MCS has been skipped by the fingerprint prefilter
+PAIR_PRUNED = 2         # the MCS has been skipped as the score upper bound is below the prune cutoff
+PAIR_CHARGE = 3         # the molecules have different charges and the electrostatic score is zero
 
 
 # *************************
@@ -75,15 +87,19 @@ class DBMolecules(object):
                  time=20, ecrscore=0.0, threed=False, max3d=1000.0, output=False,
                  name='out', output_no_images=False, output_no_graph=False, display=False,
                  allow_tree=False, max=6, cutoff=0.4, radial=False, hub=None, fast=False, 
-                 links_file=None, known_actives_file=None, max_dist_from_actives=2):
+                 links_file=None, known_actives_file=None, max_dist_from_actives=2, score_cache=None,
+                 score_cache_size=1000000, batch_size=4, fp_cutoff=0.0, prune_cutoff=0.0, sparse=False,
+                 sparse_floor=0.0, matrix_dir=None,
+                 score_precision='float64', score_report_top=0):
 
         """
         Initialization of  the Molecule Database Class
     
         Parameters
         ----------
-        directory : str 
-           the mol2/sdf directory file name
+        directory : str or list of str
+           the mol2/sdf directory file name, or a list of directories, mol2/sdf file names or glob
+           patterns. The files can be gzipped and hold several molecules each
         parallel : int
            the number of cores used to generate the similarity score matrices
         verbose : bool
@@ -119,20 +135,37 @@ class DBMolecules(object):
            the name of a file containing mols whose activity is known
         max_dist_from_actives : int
             The maximum number of links from any molecule to an active
+        score_cache : str
+            the name of a file used to cache the pair scores between runs
+        score_cache_size : int
+            the maximum number of molecule pairs stored in the score cache
+        batch_size : int
+            the number of molecule pairs handed out at a time to each process in parallel mode
+        fp_cutoff : float
+            the fingerprint similarity below which the MCS of a molecule pair is skipped.
+            If 0.0 the prefilter is disabled
+        prune_cutoff : float
+            the score below which a molecule pair does not need to be scored. The MCS is skipped for
+            the pairs whose score upper bound is lower. If 0.0 no pair is pruned
+        sparse : bool
+            if set, the similarity score matrices only store their non zero elements
+        sparse_floor : float
+            in sparse mode, the scores not greater than this value are not stored and read as zero
+        matrix_dir : str
+            the directory where the similarity score matrices are stored as memory mapped files.
+            If None the matrices are held in memory
+        score_precision : str
+            the floating point type of the similarity scores held in memory, 'float32' or 'float64'.
+            float32 halves the memory, but close scores may become equal and change the graph
+        score_report_top : int
+            if not 0, the score report only lists the graph edges and the given number of best
+            scored partners of each molecule. 0, the default, lists all the molecule pairs
             
 
         """
 
         # Set the Logging 
-        if verbose == 'off':
-            logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
-
-        if verbose == 'info':
-            logging.basicConfig(format='%(message)s', level=logging.INFO)
-
-        if verbose == 'pedantic':
-            logging.basicConfig(format='%(message)s', level=logging.DEBUG)
-            # logging.basicConfig(format='%(levelname)s:\t%(message)s', level=logging.DEBUG)
+        set_logging(verbose)
 
         if __name__ == '__main__':
             self.options = parser.parse_args()
@@ -153,6 +186,9 @@ class DBMolecules(object):
 
             if not isinstance(radial, bool):
                 raise TypeError('The radial flag is not a bool type')
+
+            if not isinstance(sparse, bool):
+                raise TypeError('The sparse flag is not a bool type')
             output_str = ''
             output_no_images_str = ''
             output_no_graph_str = ''
@@ -163,6 +199,9 @@ class DBMolecules(object):
             links_file_str = ''
             known_actives_file_str = ''
             allow_tree_str = ''
+            score_cache_str = ''
+            sparse_str = ''
+            matrix_dir_str = ''
 
             if output:
                 output_str = '--output'
@@ -194,16 +233,36 @@ class DBMolecules(object):
             if known_actives_file:
                 known_actives_file_str = f'--known-actives-file {known_actives_file}'
 
-            names_str = '%s --parallel %s --verbose %s --time %s --ecrscore %s --max3d %s --name %s --max %s --max-dist-from-actives %s --cutoff %s --hub %s %s %s %s %s %s %s %s %s %s %s' \
+            if score_cache:
+                score_cache_str = f'--score-cache {score_cache}'
+
+            if sparse:
+                sparse_str = '--sparse'
+
+            if matrix_dir:
+                matrix_dir_str = f'--matrix-dir {matrix_dir}'
+
+            if not isinstance(directory, str):
+                directory = ' '.join(directory)
+
+            names_str = '%s --parallel %s --verbose %s --time %s --ecrscore %s --max3d %s --name %s --max %s --max-dist-from-actives %s --cutoff %s --hub %s --score-cache-size %s --batch-size %s --fp-cutoff %s --prune-cutoff %s --sparse-floor %s --score-precision %s --score-report-top %s %s %s %s %s %s %s %s %s %s %s %s %s %s' \
                         % (
-                        directory, parallel, verbose, time, ecrscore, max3d, name, max, max_dist_from_actives, cutoff, hub, output_str, display_str, output_no_images_str, output_no_graph_str,
-                        radial_str, fast_str, threed_str, allow_tree_str, links_file_str, known_actives_file_str)
+                        directory, parallel, verbose, time, ecrscore, max3d, name, max, max_dist_from_actives, cutoff, hub, score_cache_size, batch_size, fp_cutoff, prune_cutoff, sparse_floor, score_precision, score_report_top, output_str, display_str, output_no_images_str, output_no_graph_str,
+                        radial_str, fast_str, threed_str, allow_tree_str, links_file_str, known_actives_file_str, score_cache_str, sparse_str, matrix_dir_str)
 
             #print("ARGS:",names_str)
             self.options = parser.parse_args(names_str.split())
 
-        # Internal list container used to store the loaded molecule objects
-        self.__list = self.read_molecule_files()
+        # Internal list container used to store the loaded molecule objects. A molecule
+        # database written by lomap prepare also holds the per-molecule data
+        database = self.input_database()
+        if database is not None:
+            self.__list = database.molecules()
+            self._charges = np.array(database.charges)
+            self._atom_counts = np.array(database.atom_counts)
+            logging.info('Molecule database %s opened. %d structures in total\n' % (database.fname, len(database)))
+        else:
+            self.__list = self.parse_molecule_files()
 
         # Dictionary which holds the mapping between the generated molecule IDs and molecule file names
         self.dic_mapping = {}
@@ -220,8 +279,9 @@ class DBMolecules(object):
 
         # List of which molecules are "known actives". Note that all pairs of known actives 
         # are automatically added as prespecified links with a score of -1 (i.e force score to
-        # 1 and force link to be included)
-        self.known_actives = []
+        # 1 and force link to be included). The molecules of a molecule database can be
+        # flagged as active
+        self.known_actives = [mol.getID() for mol in self.__list if mol.isActive()]
 
         for mol in self.__list:
             self.dic_mapping[mol.getID()] = mol.getName()
@@ -232,6 +292,13 @@ class DBMolecules(object):
 
         if self.options.known_actives_file and len(self.options.known_actives_file)>0:
             self.parse_known_actives_file(self.options.known_actives_file)
+        elif self.known_actives:
+            self.add_known_actives_links()
+
+        # On-disk cache of the pair scores, shared between runs
+        self.score_cache = None
+        if self.options.score_cache:
+            self.score_cache = cache.ScoreCache(self.options.score_cache, self.options.score_cache_size)
 
         # Index used to perform index selection by using __iter__ function
         self.__ci = 0
@@ -240,9 +307,83 @@ class DBMolecules(object):
         self.strict_mtx = SMatrix(shape=(0,))
         self.loose_mtx = SMatrix(shape=(0,))
 
+        # Store of the similarity scores, when the matrices are views of it
+        self.scores = None
+
+        # Status of the molecule pairs of the matrices, one of the PAIR_* values
+        self.pair_status = np.zeros(0, dtype=np.uint8)
+
         # Empty pointer to the networkx graph 
         self.Graph = nx.Graph()
 
+        # Molecules prepared for the MCS calculations, by ID
+        self._prepared = {}
+
+    def __getstate__(self):
+        # The matrices which are views of the score store are rebuilt when loaded,
+        # rather than pickled as separate copies. The prepared molecules are rebuilt on demand
+        state = self.__dict__.copy()
+        state.pop('_prepared', None)
+        if state.get('scores') is not None:
+            for kind in ('strict_mtx', 'loose_mtx', 'true_strict_mtx'):
+                state.pop(kind, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._prepared = {}
+        # Databases saved before the score store was introduced
+        self.__dict__.setdefault('scores', None)
+        if self.scores is not None:
+            self.strict_mtx, self.loose_mtx, self.true_strict_mtx = self.scores.matrices()
+
+    @staticmethod
+    def load(fname, options=None):
+        """
+        Load a molecule database saved by a previous run, together with its
+        similarity score matrices and MCS maps
+
+        Parameters
+        ----------
+        fname : str
+           the pickle file name. Both a pickled molecule database and the graph
+           pickle file written by build_graph are accepted
+        options : argparse python object
+           if passed, the user options replacing the ones of the previous run
+
+        Returns
+        -------
+        db_mol : DBMolecules obj
+           the loaded molecule database
+
+        """
+
+        with open(fname, 'rb') as pickle_f:
+            db_mol = pickle.load(pickle_f)
+
+        if isinstance(db_mol, graphgen.GraphGen):
+            db_mol = db_mol.dbase
+
+        if not isinstance(db_mol, DBMolecules):
+            raise IOError('The file %s does not contain a molecule database' % fname)
+
+        # Databases saved before the pair status was introduced
+        if not hasattr(db_mol, 'pair_status'):
+            db_mol.pair_status = np.zeros(db_mol.strict_mtx.size, dtype=np.uint8)
+
+        # Options saved before the score report could be limited
+        if not hasattr(db_mol.options, 'score_report_top'):
+            db_mol.options.score_report_top = 0
+
+        if options is not None:
+            set_logging(options.verbose)
+            db_mol.options = options
+            db_mol.score_cache = None
+            if options.score_cache:
+                db_mol.score_cache = cache.ScoreCache(options.score_cache, options.score_cache_size)
+
+        return db_mol
+
     def __iter__(self):
         """
         Index generator
@@ -287,6 +428,12 @@ class DBMolecules(object):
 
         self.__list[index] = molecule
 
+        # The per-molecule data computed from the replaced molecule are stale
+        self._mol_keys = None
+        self._charges = None
+        self._fingerprints = None
+        self._atom_counts = None
+
     def __add__(self, molecule):
 
         """
@@ -301,7 +448,98 @@ class DBMolecules(object):
         if not isinstance(molecule, Molecule):
             raise ValueError('The passed molecule is not a Molecule object')
 
+        self.add_molecules([molecule])
+
+        return self
+
+    def add_molecules(self, molecules):
+        """
+        Append new molecules to the molecule database. If the similarity score
+        matrices have already been built they are extended in place, and only
+        the pairs involving the new molecules are scored: adding k molecules to
+        a database of n molecules costs k*n + k*(k-1)/2 MCS calculations
+
+        Parameters
+        ----------
+        molecules : list of Molecule objects
+           the molecules to append. They are given the IDs following the ones
+           already present in the database
+
+        Returns
+        -------
+        strict_mtx, loose_mtx : SMatrix
+           the extended strict and loose similarity score matrices
+
+        """
+
+        for molecule in molecules:
+            if not isinstance(molecule, Molecule):
+                raise ValueError('The passed molecule is not a Molecule object')
+            if molecule.getName() in self.inv_dic_mapping:
+                raise ValueError('The molecule %s is already in the molecule database' % molecule.getName())
+
+        n = self.nums()
+
+        # The matrices are extended only if they hold the scores of the current molecules
+        scored = n > 1 and self.strict_mtx.size == n * (n - 1) // 2
+
+        for molecule in molecules:
+            mol_id = self.nums()
+            if molecule.getID() != mol_id:
+                active = molecule.isActive()
+                molecule = Molecule(molecule.getBinary(), mol_id, molecule.getName())
+                molecule.setActive(active)
             self.__list.append(molecule)
+            self.dic_mapping[mol_id] = molecule.getName()
+            self.inv_dic_mapping[molecule.getName()] = mol_id
+            logging.info('ID %s\t%s' % (mol_id, molecule.getName()))
+
+        if not scored or not molecules:
+            return self.strict_mtx, self.loose_mtx
+
+        logging.info('\nMatrix scoring of %d new molecules in progress....\n' % len(molecules))
+
+        new_n = self.nums()
+
+        if self.scores is not None:
+            self.scores = self.scores.expand(new_n)
+            self.strict_mtx, self.loose_mtx, self.true_strict_mtx = self.scores.matrices()
+        elif self.options.matrix_dir:
+            # The expanded matrices are written to temporary files, which replace
+            # the matrix files once all complete: the scores on disk are kept if
+            # the expansion fails
+            kinds = ('strict', 'loose', 'true_strict')
+            try:
+                for kind in kinds:
+                    mat = getattr(self, kind + '_mtx').expand(new_n, self.matrix_file(kind) + '.tmp')
+                    mat.flush()
+                    del mat
+            except Exception:
+                for kind in kinds:
+                    if os.path.exists(self.matrix_file(kind) + '.tmp'):
+                        os.remove(self.matrix_file(kind) + '.tmp')
+                raise
+            for kind in kinds:
+                fname = self.matrix_file(kind)
+                os.replace(fname + '.tmp', fname)
+                setattr(self, kind + '_mtx', SMatrix.memmap(fname, mode='r+'))
+        else:
+            self.strict_mtx = self.strict_mtx.expand(new_n)
+            self.loose_mtx = self.loose_mtx.expand(new_n)
+            self.true_strict_mtx = self.true_strict_mtx.expand(new_n)
+        self.pair_status = expand_condensed(self.pair_status, n, new_n)
+
+        # Linear indexes of the pairs made of a new molecule and any other molecule
+        pairs = []
+        for i in range(0, new_n - 1):
+            start = i * new_n - i * (i + 1) // 2
+            first_j = max(i + 1, n)
+            pairs.append(np.arange(start + first_j - i - 1, start + new_n - i - 1))
+        pairs = np.concatenate(pairs)
+
+        self.score_pairs(pairs)
+
+        return self.strict_mtx, self.loose_mtx
 
     def nums(self):
         """
@@ -312,7 +550,29 @@ class DBMolecules(object):
 
     def read_molecule_files(self):
         """
-        Read in all the mol2 or SDF files
+        Read in all the molecules of the input, a molecule database or a set of
+        mol2 or SDF files
+
+        Returns
+        -------
+        molid_list : list of Molecule objects
+           the container list of all the allocated Molecule objects
+
+        """
+
+        # The molecules of a molecule database are not parsed again
+        database = self.input_database()
+        if database is not None:
+            return database.molecules()
+
+        return self.parse_molecule_files()
+
+    def parse_molecule_files(self):
+        """
+        Read in all the molecules of the mol2 or SDF files. The files are read
+        one record at a time, so that large multi record files, possibly
+        gzipped, are not loaded in memory. The molecule IDs follow the file
+        name and record order, whatever the number of parsing processes
 
         Returns
         -------
@@ -330,49 +590,55 @@ class DBMolecules(object):
 
         logging.info(30 * '-')
 
-        # The .mol2 and .sdf file formats are the only supported so far
-        mol_fnames = glob.glob(self.options.directory + "/*.mol2")
-        mol_fnames += glob.glob(self.options.directory + "/*.sdf")
-
-        mol_fnames.sort()
-
-        if len(mol_fnames) < 2:
-            raise IOError('The directory %s must contain at least two mol2/sdf files' % self.options.directory)
-
         print_cnt = 0
         mol_id_cnt = 0
 
-        for fname in mol_fnames:
-            # The RDkit molecule object reads in as mol2/sdf file. The molecule is not sanitized and 
-            # all the hydrogens are kept in place - we are assuming 3D input, correctly charged
-            # and prepared in the protein active site
-            if fname.endswith(".mol2"):
-                rdkit_mol = Chem.MolFromMol2File(fname, sanitize=False, removeHs=False)
-            else:
-                rdkit_mol = Chem.MolFromMolFile(fname, sanitize=False, removeHs=False)
+        # The .mol2 and .sdf file formats are the only supported so far. The RDkit molecule
+        # objects are not sanitized and all the hydrogens are kept in place - we are assuming
+        # 3D input, correctly charged and prepared in the protein active site. In parallel mode
+        # the records are parsed by a pool of processes. The molecules which cannot be
+        # sanitized are reported here rather than by the MCS of each pair, but they are
+        # kept as before, so that the IDs do not change. Their pairs are scored 0
+        records = readers.read_molecules(self.options.directory, parallel=self.options.parallel, validate=True,
+                                         binary=True)
+
+        for name, rdkit_mol, error in records:
 
             # Reading problems
-            if rdkit_mol == None:
-                logging.warning('Error reading the file: %s' % os.path.basename(fname))
-                mol_error_list_fn.append(os.path.basename(fname))
+            if rdkit_mol is None:
+                logging.warning('Error reading the molecule: %s - %s' % (name, error))
+                mol_error_list_fn.append(name)
                 continue
 
+            if error:
+                logging.warning('The molecule %s cannot be sanitized, its pairs are scored 0 - %s' % (name, error))
+
             # The Rdkit molecule is stored in a Molecule object
-            mol = Molecule(rdkit_mol, mol_id_cnt, os.path.basename(fname))
+            mol = Molecule(rdkit_mol, mol_id_cnt, name)
             mol_id_cnt += 1
 
-            # Cosmetic printing and status
-            if print_cnt < 15 or print_cnt == (len(mol_fnames) - 1):
-                logging.info('ID %s\t%s' % (mol.getID(), os.path.basename(fname)))
+            # Cosmetic printing and status. The number of molecules is not known
+            # in advance, so the last one is printed once all are read
+            if print_cnt < 15:
+                logging.info('ID %s\t%s' % (mol.getID(), name))
 
             if print_cnt == 15:
-                logging.info('ID %s\t%s' % (mol.getID(), os.path.basename(fname)))
+                logging.info('ID %s\t%s' % (mol.getID(), name))
                 logging.info(3 * '\t.\t.\n')
 
             print_cnt += 1
 
             molid_list.append(mol)
 
+        if print_cnt > 16:
+            logging.info('ID %s\t%s' % (molid_list[-1].getID(), molid_list[-1].getName()))
+
+        if len(molid_list) + len(mol_error_list_fn) < 2:
+            sources = self.options.directory
+            if not isinstance(sources, str):
+                sources = ' '.join(sources)
+            raise IOError('The input %s must contain at least two mol2/sdf molecules' % sources)
+
         logging.info(30 * '-')
 
         logging.info('Finish reading input files. %d structures in total....skipped %d\n' % (
@@ -387,6 +653,46 @@ class DBMolecules(object):
 
         return molid_list
 
+    def input_database(self):
+        """
+        Open the molecule database written by lomap prepare, if it is the input
+
+        Returns
+        -------
+        database : MoleculeDatabase object or None
+           the molecule database, None if the input is a set of mol2/sdf files
+
+        """
+
+        sources = self.options.directory
+        if isinstance(sources, str):
+            sources = [sources]
+
+        if not any(molstore.is_database(source) for source in sources):
+            return None
+
+        if len(sources) > 1:
+            raise IOError('A molecule database must be the only input')
+
+        return molstore.MoleculeDatabase(sources[0])
+
+    def write_database(self, fname):
+        """
+        Write the molecules and their per-molecule data to a molecule database
+        file, which can be passed as input instead of the mol2/sdf files. The
+        molecules are not parsed again when it is opened
+
+        Parameters
+        ----------
+        fname : str
+           the database file name
+
+        """
+
+        molstore.write_database(fname, self.__list, self.total_charges(), self.atom_counts())
+
+        logging.info('Molecule database written to %s. %d structures in total' % (fname, self.nums()))
+
     def parse_links_file(self, links_file):
         try:
             with open(links_file,"r") as lf:
@@ -415,12 +721,16 @@ class DBMolecules(object):
                 for line in lf:
                     mols = line.split();
                     indexa = self.inv_dic_mapping[mols[0]]
-                    self.known_actives.append(indexa)
+                    if indexa not in self.known_actives:
+                        self.known_actives.append(indexa)
                     self.__list[indexa].setActive(True)
                     print("Added known activity for mol",mols[0],"->",indexa)
         except KeyError as e:
             raise IOError('Filename within the actives file "'+actives_file+'" not found: '+str(e)) from None
-        # Add all combinations of these to the set of prespecified links
+        self.add_known_actives_links()
+
+    def add_known_actives_links(self):
+        # Add all combinations of the known actives to the set of prespecified links
         for t in [(x,y) for x in self.known_actives for y in self.known_actives]:
             print("Added prespecified link for ",t)
             self.prespecified_links[t]=-1
@@ -441,11 +751,12 @@ class DBMolecules(object):
             return self.mcs_map_store[idx]
         return None
 
-    def compute_mtx(self, a, b, strict_mtx, loose_mtx, true_strict_mtx, MCS_map):
+    def compute_mtx(self, a, b, strict_mtx, loose_mtx, true_strict_mtx, MCS_map, pairs=None):
         """
         Compute a chunk of the similarity score matrices. The chunk is selected
         by the start index a and the final index b. The matrices are indeed 
-        treated as linear array
+        treated as linear array. If a list of linear indexes is passed, the
+        chunk is selected from that list instead
 
         Parameters
         ----------
@@ -453,25 +764,25 @@ class DBMolecules(object):
            the start index of the chunk 
         b : int
            the final index of the chunk
-        strict_mtx: python multiprocessing array
-
-           strict similarity score matrix. This array is used as shared memory
-           array managed by the different allocated processes. Each process 
-           operates on a separate chunk selected by the indexes a and b
+        strict_mtx: array or dict
+           strict similarity score matrix, indexed by the linear index. The
+           parallel processes use a local dict, sent back to the parent process
 
-        loose_mtx: python multiprocessing array
-           loose similarity score matrix. This array is used as shared memory 
-           array managed by the different allocated processes. Each process 
-           operates on a separate chunk selected by the indexes a and b
+        loose_mtx: array or dict
+           loose similarity score matrix, indexed by the linear index
 
-        true_strict_mtx: python multiprocessing array
+        true_strict_mtx: array or dict
            Holds the strict score *before* that is potentially
            modified by the prespecified link function (which sets the link score to 1.0).
 
-        MCS_map: dict (multiprocessing)
+        MCS_map: dict
             Holds a dict of (index tuple) -> string with the strings being the 
             MCS atom index map between the two molecules
 
+        pairs: numpy array of int
+            the linear indexes of the matrix elements to compute. If None all
+            the elements from a to b are computed
+
         """
 
         # name = multiprocessing.current_process().name
@@ -479,70 +790,32 @@ class DBMolecules(object):
         # print('a = %d, b = %d' % (a,b))
         # print('\n') 
 
-        def formal_charge(mol):
-            total_charge_mol = 0.0
-
-            try:
-                # Assume mol2
-                total_charge_mol=sum([float(a.GetProp('_TriposPartialCharge')) for a in mol.GetAtoms()])
-            except:
-                # wasn't mol2, so assume SDF with correct formal charge props for mols
-                total_charge_mol=sum([a.GetFormalCharge() for a in mol.GetAtoms()])
-
-            return total_charge_mol
-
-
-
-        def ecr(mol_i, mol_j):
-            """
-            This function computes the similarity score between the passed molecules
-            by using the EleCtrostatic Rule (ECR)
-
-            Parameters
-            ----------
-            mol_i : Rdkit molecule object 
-               the first molecules used to calculate the ECR rule  
-            mol_j : Rdkit molecule object 
-               the second molecules used to calculate the ECR rule 
-
-            Returns
-            -------
-            scr_ecr: float
-                the calculated similarity score (1 if mol_i and mol_j have the
-                same total charges, 0  otherwire)
-
-            """
-
-            total_charge_mol_i = formal_charge(mol_i) 
-            total_charge_mol_j = formal_charge(mol_j) 
-
-            if abs(total_charge_mol_j - total_charge_mol_i) < 1e-3:
-                scr_ecr = 1.0
-            else:
-                scr_ecr = 0.0
-
-            return scr_ecr
-
         # Total number of loaded molecules
         n = self.nums()
 
+        # Total charges of the molecules, used by the electrostatic score rule
+        charges = self.total_charges()
+
+        # Keys used to address the score cache
+        if self.score_cache is not None:
+            mol_keys, opt_key = self.score_cache_keys()
+
         # Looping over all the elements of the selected matrix chunk
-        for k in range(a, b + 1):
+        for idx in range(a, b + 1):
+
+            k = idx if pairs is None else int(pairs[idx])
 
             # The linear index k is converted into the row and column indexes of
             # an hypothetical bidimensional symmetric matrix
-            i = int(n - 2 - math.floor(math.sqrt(-8 * k + 4 * n * (n - 1) - 7) / 2.0 - 0.5))
-            j = int(k + i + 1 - n * (n - 1) / 2 + (n - i) * ((n - i) - 1) / 2)
+            i, j = linear_to_pair(k, n)
+            i, j = int(i), int(j)
             # print 'k = %d , i = %d , j = %d' % (k,i,j)
 
-            # The Rdkit molecules moli and molj are extracted form the molecule database
-            moli = self[i].getMolecule()
-            molj = self[j].getMolecule()
-
             logging.info('Processing molecules: %s-%s' % (self[i].getName(),self[j].getName()))
 
-            # The Electrostatic score rule is calculated
-            ecr_score = ecr(moli, molj)
+            # The Electrostatic score rule is calculated: 1 if the molecules have
+            # the same total charges, 0 otherwise
+            ecr_score = float(abs(charges[i] - charges[j]) < 1e-3)
 
             # If the prespecified links map has this link, and the value is >-1, then
             # we don't need to compute the score
@@ -558,38 +831,64 @@ class DBMolecules(object):
                         logging.critical('WARNING: Mutation between different charge molecules is enabled')
                         ecr_score = self.options.ecrscore
 
-                    try:
-                        if self.options.verbose == 'pedantic':
-                            logging.info(50 * '-')
-                            logging.info('MCS molecules: %s - %s' % (self[i].getName(), self[j].getName()))
-
-                        # Maximum Common Subgraph (MCS) calculation
-                        MC = mcs.MCS(moli, molj, options=self.options)
-                        ml=MC.all_atom_match_list()
+                    # Previously computed scores are taken from the score cache
+                    cached = None
+                    if self.score_cache is not None:
+                        cached = self.score_cache.lookup(mol_keys[i], mol_keys[j], opt_key)
+
+                    if cached is not None:
+                        strict_scr, loose_scr, _, ml = cached
+                        if ml is None:
+                            logging.info('MCS molecules: %s - %s failed in a previous run (score cache)' %
+                                         (self[i].getName(), self[j].getName()))
+                            continue
                         self.set_MCSmap(i,j,ml)
                         MCS_map[(i,j)]=ml
-
-                    except Exception as e:
-                        logging.warning(
-                            'Skipping MCS molecules (exception): %s - %s\t\n\n%s' % (self[i].getName(), self[j].getName(), e))
-                        logging.info(50 * '-')
-                        continue
+                        logging.info('MCS molecules: %s - %s final score %s from score cache' %
+                                     (self[i].getName(), self[j].getName(), strict_scr))
+                    else:
+                        try:
+                            if self.options.verbose == 'pedantic':
+                                logging.info(50 * '-')
+                                logging.info('MCS molecules: %s - %s' % (self[i].getName(), self[j].getName()))
+
+                            # The prepared molecules moli and molj are extracted form the molecule
+                            # database. They are built once per molecule and reused for all the pairs
+                            moli = self.prepared_molecule(i)
+                            molj = self.prepared_molecule(j)
+
+                            # Maximum Common Subgraph (MCS) calculation
+                            MC = mcs.MCS(moli, molj, options=self.options)
+                            ml=MC.all_atom_match_list()
+                            self.set_MCSmap(i,j,ml)
+                            MCS_map[(i,j)]=ml
+
+                        except Exception as e:
+                            logging.warning(
+                                'Skipping MCS molecules (exception): %s - %s\t\n\n%s' % (self[i].getName(), self[j].getName(), e))
+                            logging.info(50 * '-')
+                            if self.score_cache is not None:
+                                self.score_cache.store(mol_keys[i], mol_keys[j], opt_key, 0.0, 0.0, 0.0, None)
+                            continue
+
+                        # The scoring between the two molecules is performed by using different rules.
+                        # The total score will be the product of all the single rules
+                        tmp_scr = ecr_score * MC.mncar() * MC.mcsr() * MC.atomic_number_rule() * MC.hybridization_rule()
+                        tmp_scr *= MC.sulfonamides_rule() * MC.heterocycles_rule() * MC.transmuting_methyl_into_ring_rule()
+                        tmp_scr *= MC.transmuting_ring_sizes_rule()
+                        # Note - no longer using tmcsr rule!
+                        strict_scr = tmp_scr * 1 #  MC.tmcsr(strict_flag=True)
+                        loose_scr = tmp_scr * 1 #  MC.tmcsr(strict_flag=False)
+                        logging.info(
+                            'MCS molecules: %s - %s final score %s from ecr %s mncar %s mcsr %s tmcsr %s anum %s sulf %s het %s RingMe %s' % 
+                              (self[i].getName(), self[j].getName(), strict_scr, ecr_score, MC.mncar(),MC.mcsr(),MC.tmcsr(strict_flag=True),
+                                MC.atomic_number_rule(),MC.sulfonamides_rule(),MC.heterocycles_rule(),MC.transmuting_methyl_into_ring_rule()))
+
+                        if self.score_cache is not None:
+                            self.score_cache.store(mol_keys[i], mol_keys[j], opt_key, strict_scr, loose_scr, strict_scr, ml)
                 else:
                     continue
 
-                # The scoring between the two molecules is performed by using different rules.
-                # The total score will be the product of all the single rules
-                tmp_scr = ecr_score * MC.mncar() * MC.mcsr() * MC.atomic_number_rule() * MC.hybridization_rule()
-                tmp_scr *= MC.sulfonamides_rule() * MC.heterocycles_rule() * MC.transmuting_methyl_into_ring_rule()
-                tmp_scr *= MC.transmuting_ring_sizes_rule()
-                # Note - no longer using tmcsr rule!
-                strict_scr = tmp_scr * 1 #  MC.tmcsr(strict_flag=True)
-                loose_scr = tmp_scr * 1 #  MC.tmcsr(strict_flag=False)
-                logging.info(
-                    'MCS molecules: %s - %s final score %s from ecr %s mncar %s mcsr %s tmcsr %s anum %s sulf %s het %s RingMe %s' % 
-                      (self[i].getName(), self[j].getName(), strict_scr, ecr_score, MC.mncar(),MC.mcsr(),MC.tmcsr(strict_flag=True),
-                        MC.atomic_number_rule(),MC.sulfonamides_rule(),MC.heterocycles_rule(),MC.transmuting_methyl_into_ring_rule()))
-
             strict_mtx[k] = strict_scr
             loose_mtx[k] = loose_scr
             true_strict_mtx[k] = strict_scr
@@ -602,227 +901,788 @@ class DBMolecules(object):
                 # Note that true_strict_mtx holds the original strict_scr value
                 continue
 
+        if self.score_cache is not None:
+            self.score_cache.flush()
+
         return
 
-    def build_matrices(self):
+    def prepared_molecule(self, i):
         """
-        This function coordinates the calculation of the similarity score matrices
-        by distributing chunks of the matrices between the allocated processes
+        This function returns the molecule i prepared for the MCS calculations.
+        It is built once and kept by the database, rather than by the molecule
+        object, which a molecule block may drop from its cache and rebuild. A
+        molecule which cannot be prepared raises the same exception for all its
+        pairs, without being prepared again
+
+        Parameters
+        ----------
+        i : int
+           the molecule ID
+
+        Returns
+        -------
+           : PreparedMolecule object
+           the prepared molecule, which must not be modified
 
         """
 
-        logging.info('\nMatrix scoring in progress....\n')
+        threed = bool(self.options.threed)
+        entry = self._prepared.get(i)
+        if entry is None or entry[0] != threed:
+            try:
+                entry = (threed, mcs.PreparedMolecule(self[i].getMolecule(), self.options))
+            except Exception as e:
+                entry = (threed, e)
+            self._prepared[i] = entry
 
-        # The similarity score matrices are defined instances of the class SMatrix
-        # which implements a basic class for symmetric matrices
-        self.strict_mtx = SMatrix(shape=(self.nums(),))
-        self.loose_mtx = SMatrix(shape=(self.nums(),))
-        self.true_strict_mtx = SMatrix(shape=(self.nums(),))
-        # The total number of the effective elements present in the symmetric matrix
-        l = int(self.nums() * (self.nums() - 1) / 2)
+        if isinstance(entry[1], Exception):
+            raise entry[1].with_traceback(None)
 
-        if self.options.parallel == 1:  # Serial execution
-            MCS_map = {}
-            self.compute_mtx(0, l - 1, self.strict_mtx, self.loose_mtx, self.true_strict_mtx, MCS_map)
-            for idx in MCS_map:
-              self.set_MCSmap(idx[0],idx[1],MCS_map[idx])
-        else:
-            # Parallel execution
-            logging.info('Parallel mode is on')
+        return entry[1]
 
-            # Number of selected processes
-            num_proc = self.options.parallel
+    def score_cache_keys(self):
+        """
+        This function returns the content keys of the loaded molecules and of the
+        scoring options used to address the score cache. The molecule coordinates
+        are part of the keys when they are used by the MCS (--threed or --max3d)
 
-            delta = int(l / num_proc)
-            rem = l % num_proc
+        Returns
+        -------
+        mol_keys : list of str
+           the molecule keys, indexed by molecule ID
+        opt_key : str
+           the scoring options key
 
-            if delta < 1:
-                kmax = l
-            else:
-                kmax = num_proc
-            proc = []
+        """
 
-            with multiprocessing.Manager() as manager:
-
-              # Shared memory array used by the different allocated processes
-              # At the moment we're using a combination of Array and Manager, which is nasty
-              strict_mtx = multiprocessing.Array('d', self.strict_mtx)
-              loose_mtx = multiprocessing.Array('d', self.loose_mtx)
-              true_strict_mtx = multiprocessing.Array('d', self.true_strict_mtx)
-              MCS_map = manager.dict()
-  
-              # Chopping the indexes redistributing the remainder
-              for k in range(0, kmax):
-  
-                  spc = delta + int(int(rem / (k + 1)) > 0)
-  
-                  if k == 0:
-                      i = 0
-                  else:
-                      i = j + 1
-  
-                  if k != kmax - 1:
-                      j = i + spc - 1
-                  else:
-                      j = l - 1
-  
-                  # Python multiprocessing allocation
-                  p = multiprocessing.Process(target=self.compute_mtx,
-                                              args=(i, j, strict_mtx, loose_mtx, true_strict_mtx, MCS_map, ))
-                  p.start()
-                  proc.append(p)
-              # End parallel execution
-              for p in proc:
-                  p.join()
-
-              # Copying back the results
-              self.strict_mtx[:] = strict_mtx[:]
-              self.loose_mtx[:] = loose_mtx[:]
-              self.true_strict_mtx[:] = true_strict_mtx[:]
-              for idx in MCS_map.keys():
-                self.set_MCSmap(idx[0],idx[1],MCS_map[idx])
+        if getattr(self, '_mol_keys', None) is None:
+            self._mol_keys = []
 
-        return self.strict_mtx, self.loose_mtx
+        # Only the molecules added since the last call are hashed
+        coords = bool(self.options.threed) or self.options.max3d > 0
+        for mol in self.__list[len(self._mol_keys):]:
+            self._mol_keys.append(cache.molecule_key(mol.getMolecule(copy=False), coords))
 
-    def build_graph(self):
+        return self._mol_keys, cache.options_key(self.options)
+
+    def total_charges(self):
         """
-        This function coordinates the Graph generation
+        This function returns the total charges of the loaded molecules. The
+        mol2 partial charges are summed if present, the formal charges
+        otherwise. They are computed once per molecule
+
+        Returns
+        -------
+        charges : numpy array of float
+           the total charges, indexed by molecule ID
 
         """
-        logging.info('\nGenerating graph in progress....')
 
-        # The Graph is build from an instance of the Class GraphGen by passing
-        # the selected user options
-        Gr = graphgen.GraphGen(self)
+        if getattr(self, '_charges', None) is None:
+            self._charges = np.zeros(0)
 
-        # Writing the results is files
-        if self.options.output:
+        def total_charge(mol):
             try:
-                Gr.write_graph(self.options.output_no_images, self.options.output_no_graph)
-                with open(self.options.name + ".pickle", "wb") as pickle_f:
-                    pickle.dump(Gr, pickle_f)
-            except Exception as e:
-                logging.error(str(e))
+                # Assume mol2
+                return sum([float(at.GetProp('_TriposPartialCharge')) for at in mol.GetAtoms()])
+            except (KeyError, ValueError):
+                # wasn't mol2, so assume SDF with correct formal charge props for mols
+                return float(sum([at.GetFormalCharge() for at in mol.GetAtoms()]))
 
-        # Handle to the the NetworkX generated graph
-        self.Graph = Gr.get_graph()
+        # Only the molecules added since the last call are summed
+        new_charges = [total_charge(mol.getMolecule(copy=False)) for mol in self.__list[len(self._charges):]]
+        if new_charges:
+            self._charges = np.concatenate((self._charges, new_charges))
 
-        # print self.Graph.nodes(data=True)
+        return self._charges
 
-        # Display the graph by using Matplotlib
-        if self.options.display:
-            Gr.draw()
+    def charge_class_pairs(self, pairs=None):
+        """
+        This function removes from the molecule pairs to score the ones made
+        of molecules with different total charges, which score zero when the
+        electrostatic score option is not set. Their status is set to
+        PAIR_CHARGE. The prespecified links are always kept. When all the
+        pairs are considered, the molecules are partitioned in classes of equal
+        charges and only the pairs within each class are generated
 
-        return self.Graph
+        Parameters
+        ----------
+        pairs : numpy array of int
+           the linear indexes of the matrix elements to score. If None all the
+           matrix elements are considered
 
-    def write_dic(self):
-        """
-        This function writes out a text file with the mapping between the
-        generated molecule indexes and the corresponding molecule file names
+        Returns
+        -------
+        pairs : numpy array of int
+           the linear indexes of the matrix elements left to score
 
         """
 
-        try:
-            file_txt = open(self.options.name + '.txt', 'w')
-        except Exception:
-            raise IOError('It was not possible to write out the mapping file')
-        file_txt.write('#ID\tFileName\n')
-        for key in self.dic_mapping:
-            file_txt.write('%d\t%s\n' % (key, self.dic_mapping[key]))
+        n = self.nums()
+        charges = self.total_charges()
+
+        if pairs is not None:
+            pairs = self.candidate_pairs(pairs)
+            rows, cols = linear_to_pair(pairs, n)
+            same = np.abs(charges[rows] - charges[cols]) < 1e-3
+            return self.drop_pairs(pairs, same, PAIR_CHARGE, 'Charge classes')
+
+        # The charge classes are separated by gaps of at least 1e-3 between the
+        # sorted charges, so molecules of different classes never have the same charges
+        order = np.argsort(charges, kind='stable')
+        splits = np.flatnonzero(np.diff(charges[order]) >= 1e-3) + 1
+
+        class_pairs = []
+        for members in np.split(order, splits):
+            if len(members) < 2:
+                continue
+            members = np.sort(members)
+            a, b = np.triu_indices(len(members), 1)
+            rows, cols = members[a], members[b]
+            same = np.abs(charges[rows] - charges[cols]) < 1e-3
+            class_pairs.append(pair_to_linear(rows[same], cols[same], n))
 
-        file_txt.close()
+        logging.info('Charge classes: %d classes of molecules with equal charges' % (len(splits) + 1))
 
-    # *************************
+        # The status of the pairs made of molecules with different charges is
+        # set row by row
+        for i in range(0, n - 1):
+            start = i * n - i * (i + 1) // 2
+            row_status = self.pair_status[start:start + n - i - 1]
+            row_status[np.abs(charges[i + 1:] - charges[i]) >= 1e-3] = PAIR_CHARGE
 
+        if self.prespecified_links:
+            class_pairs.append(np.array([pair_to_linear(i, j, n) for (i, j) in self.prespecified_links if i < j],
+                                        dtype=np.int64))
 
-# Symmetric  Class
-# *************************
+        if not class_pairs:
+            return np.zeros(0, dtype=np.int64)
 
+        pairs = np.unique(np.concatenate(class_pairs).astype(np.int64))
+        self.pair_status[pairs] = PAIR_SCORED
 
-class SMatrix(np.ndarray):
-    """
-    This class implements a "basic" interface for symmetric matrices 
-    subclassing ndarray. The class internally stores a bi-dimensional
-    numpy array as a linear array A[k], however the user can still 
-    access to the matrix elements by using a two indeces notation A[i,j]
- 
-    """
+        logging.info('Charge classes: %d of %d molecule pairs skipped' % (n * (n - 1) // 2 - len(pairs),
+                                                                          n * (n - 1) // 2))
 
-    def __new__(subtype, shape, dtype=float, buffer=None, offset=0, strides=None, order=None):
-        if len(shape) > 2:
-            raise ValueError('The matrix shape is greater than two')
+        return pairs
 
-        elif len(shape) == 2:
-            if shape[0] != shape[1]:
-                raise ValueError('The matrix must be a squre matrix')
+    def fingerprints(self):
+        """
+        This function returns the skeleton fingerprints of the loaded molecules
+        used by the MCS prefilter. They are computed once per molecule
 
-        l = int(shape[0] * (shape[0] - 1) / 2)
+        Returns
+        -------
+        fps : list of RDKit ExplicitBitVect
+           the fingerprints, indexed by molecule ID
 
-        shape = (l,)
+        """
 
-        obj = np.ndarray.__new__(subtype, shape, dtype, buffer, offset, strides, order)
+        if getattr(self, '_fingerprints', None) is None:
+            self._fingerprints = []
 
-        # Array initialization
-        obj = obj * 0.0
+        # Only the molecules added since the last call are fingerprinted
+        for mol in self.__list[len(self._fingerprints):]:
+            self._fingerprints.append(fp.skeleton_fingerprint(mol.getMolecule(copy=False)))
 
-        return obj
+        return self._fingerprints
 
-    def __getitem__(self, *kargs):
+    def prefilter_pairs(self, pairs=None):
         """
-        This function retrieves the selected elements i,j from the symmetric
-        matrix A[i,j]
-        
+        This function removes from the molecule pairs to score the ones whose
+        fingerprint similarity is below the fp_cutoff option. Their scores are
+        left to zero and their status is set to PAIR_PREFILTERED. The
+        prespecified links are always kept
+
         Parameters
         ----------
-        *kargs : python tuples
-           the passed elements i,j
+        pairs : numpy array of int
+           the linear indexes of the matrix elements to score. If None all the
+           matrix elements are considered
 
         Returns
         -------
-            : float
-            the selected element extracted from the allocated linear array
-            
+        pairs : numpy array of int
+           the linear indexes of the matrix elements left to score
+
         """
 
-        if isinstance(kargs[0], int):
-            k = kargs[0]
-            return super(SMatrix, self).__getitem__(k)
+        n = self.nums()
 
-        if isinstance(kargs[0], slice):
-            k = kargs[0]
-            return super(SMatrix, self).__getitem__(k)
+        pairs = self.candidate_pairs(pairs)
 
-        elif len(kargs[0]) > 2:
-            raise ValueError('Two indices can be addressed')
+        if len(pairs) == 0:
+            return pairs
 
-        i = kargs[0][0]
-        j = kargs[0][1]
+        fps = self.fingerprints()
 
-        if i == j:
-            return 0.0
+        # The pairs are sorted by row, so that the similarities are computed
+        # with one bulk Tanimoto call per molecule
+        rows, cols = linear_to_pair(pairs, n)
+        sim = np.empty(len(pairs))
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(rows)) + 1, [len(pairs)]))
+        for a, b in zip(starts[:-1], starts[1:]):
+            sim[a:b] = fp.bulk_tanimoto(fps[rows[a]], [fps[j] for j in cols[a:b]])
 
-        # Length of the linear array 
-        l = self.size
+        return self.drop_pairs(pairs, sim >= self.options.fp_cutoff, PAIR_PREFILTERED, 'Fingerprint prefilter')
 
-        # Total number of elements in the corresponding bi-dimensional symmetric matrix
-        n = int((1 + math.sqrt(1 + 8 * l)) / 2)
+    def atom_counts(self):
+        """
+        This function returns the atom counts of the loaded molecules used to
+        bound their pair scores (see MCS.atom_counts)
 
-        if i > n - 1:
-            raise ValueError('First index out of bound')
+        Returns
+        -------
+        counts : numpy array of int
+           the counts, with shape (number of molecules, 3)
 
-        if j > n - 1:
-            raise ValueError('Second index out of bound')
+        """
 
-        if i < j:
-            k = int((n * (n - 1) / 2) - (n - i) * ((n - i) - 1) / 2 + j - i - 1)
-        else:
-            k = int((n * (n - 1) / 2) - (n - j) * ((n - j) - 1) / 2 + i - j - 1)
+        if getattr(self, '_atom_counts', None) is None:
+            self._atom_counts = np.zeros((0, 3), dtype=np.int64)
 
-        return super(SMatrix, self).__getitem__(k)
+        # Only the molecules added since the last call are counted
+        new_counts = [mcs.MCS.atom_counts(mol.getMolecule(copy=False)) for mol in self.__list[len(self._atom_counts):]]
+        if new_counts:
+            self._atom_counts = np.concatenate((self._atom_counts, np.array(new_counts, dtype=np.int64)))
+
+        return self._atom_counts
+
+    def prune_pairs(self, pairs=None):
+        """
+        This function removes from the molecule pairs to score the ones whose
+        score upper bound is below the prune_cutoff option. The bound is exact,
+        so the removed pairs would score below the cutoff anyway. Their scores
+        are left to zero and their status is set to PAIR_PRUNED. The
+        prespecified links are always kept
+
+        Parameters
+        ----------
+        pairs : numpy array of int
+           the linear indexes of the matrix elements to score. If None all the
+           matrix elements are considered
+
+        Returns
+        -------
+        pairs : numpy array of int
+           the linear indexes of the matrix elements left to score
+
+        """
+
+        pairs = self.candidate_pairs(pairs)
+
+        if len(pairs) == 0:
+            return pairs
+
+        counts = self.atom_counts()
+        rows, cols = linear_to_pair(pairs, self.nums())
+        bound = mcs.MCS.score_upper_bound(counts[rows], counts[cols])
+
+        return self.drop_pairs(pairs, bound >= self.options.prune_cutoff, PAIR_PRUNED, 'Score upper bound pruning')
+
+    def candidate_pairs(self, pairs=None):
+        """
+        This function returns the sorted linear indexes of the matrix elements
+        to score, all the elements if pairs is None
+        """
+
+        if pairs is None:
+            n = self.nums()
+            return np.arange(n * (n - 1) // 2, dtype=np.int64)
+
+        return np.sort(np.asarray(pairs, dtype=np.int64))
+
+    def drop_pairs(self, pairs, keep, status, stage):
+        """
+        This function removes the pairs not selected by the keep mask from the
+        molecule pairs to score, setting their status. The prespecified links
+        are always kept
+
+        Parameters
+        ----------
+        pairs : numpy array of int
+           the linear indexes of the matrix elements to score
+        keep : numpy array of bool
+           the mask of the pairs to keep
+        status : int
+           the PAIR_* status of the removed pairs
+        stage : str
+           the stage name used for logging
+
+        Returns
+        -------
+        pairs : numpy array of int
+           the linear indexes of the matrix elements left to score
+
+        """
+
+        if self.prespecified_links:
+            n = self.nums()
+            links = np.array([pair_to_linear(i, j, n) for (i, j) in self.prespecified_links if i < j], dtype=np.int64)
+            keep = keep | np.isin(pairs, links)
+
+        self.pair_status[pairs[~keep]] = status
+
+        logging.info('%s: %d of %d molecule pairs skipped' % (stage, len(pairs) - keep.sum(), len(pairs)))
+
+        return pairs[keep]
+
+    def build_matrices(self):
+        """
+        This function coordinates the calculation of the similarity score matrices
+        by distributing chunks of the matrices between the allocated processes
+
+        """
+
+        logging.info('\nMatrix scoring in progress....\n')
+
+        # The similarity score matrices are defined instances of the class SMatrix
+        # which implements a basic class for symmetric matrices. Unless they are
+        # sparse or memory mapped, they are views of a single score store
+        if self.options.sparse or self.options.matrix_dir:
+            self.scores = None
+            self.strict_mtx = self.new_matrix('strict')
+            self.loose_mtx = self.new_matrix('loose')
+            self.true_strict_mtx = self.new_matrix('true_strict')
+        else:
+            self.scores = ScoreStore(self.nums(), dtype=np.dtype(self.options.score_precision))
+            self.strict_mtx, self.loose_mtx, self.true_strict_mtx = self.scores.matrices()
+
+        # Status of each molecule pair, one of the PAIR_* values
+        self.pair_status = np.zeros(self.strict_mtx.size, dtype=np.uint8)
+
+        self.score_pairs()
+
+        return self.strict_mtx, self.loose_mtx
+
+    def new_matrix(self, kind):
+        """
+        This function returns an empty similarity score matrix for the molecules
+        of the database, a SparseSMatrix if the sparse option is set and a
+        SMatrix otherwise. With the matrix_dir option, the SMatrix is stored
+        in a memory mapped file
+
+        Parameters
+        ----------
+        kind : str
+           the matrix name, one of 'strict', 'loose' and 'true_strict'
+
+        """
+
+        if self.options.sparse:
+            if self.options.matrix_dir:
+                raise ValueError('The sparse matrices cannot be stored in memory mapped files')
+            return SparseSMatrix(shape=(self.nums(),), floor=self.options.sparse_floor)
+
+        if self.options.matrix_dir:
+            os.makedirs(self.options.matrix_dir, exist_ok=True)
+            return SMatrix.memmap(self.matrix_file(kind), self.nums(), mode='w+')
+
+        return SMatrix(shape=(self.nums(),))
+
+    def matrix_file(self, kind):
+        """
+        This function returns the file name of the memory mapped similarity
+        score matrix kind
+        """
+
+        return os.path.join(self.options.matrix_dir, '%s_mtx.dat' % kind)
+
+    def score_pairs(self, pairs=None):
+        """
+        This function scores the selected elements of the similarity score
+        matrices, distributing them between the allocated processes
+
+        Parameters
+        ----------
+        pairs : numpy array of int
+           the linear indexes of the matrix elements to compute. If None all
+           the matrix elements are computed
+
+        """
+
+        # The forced links are flagged in the score store, which keeps their true
+        # scores aside
+        if self.scores is not None:
+            forced = [pair_to_linear(i, j, self.nums()) for (i, j), score in self.prespecified_links.items()
+                      if score < 0 and i != j]
+            if forced:
+                self.scores.set_forced(forced)
+
+        # Without electrostatic score, only the pairs of molecules with the same
+        # charges are scored
+        if not self.options.ecrscore:
+            pairs = self.charge_class_pairs(pairs)
+
+        # The molecule pairs which cannot reach the prune cutoff or are not
+        # similar enough are not scored
+        if self.options.prune_cutoff > 0.0:
+            pairs = self.prune_pairs(pairs)
+
+        if self.options.fp_cutoff > 0.0:
+            pairs = self.prefilter_pairs(pairs)
+
+        # The total number of the effective elements to compute
+        if pairs is None:
+            l = int(self.nums() * (self.nums() - 1) / 2)
+        else:
+            l = len(pairs)
+
+        # The molecule keys are computed once here, rather than in each process
+        if self.score_cache is not None:
+            self.score_cache_keys()
+
+        if self.options.parallel == 1:  # Serial execution
+            MCS_map = {}
+            if l > 0:
+                self.compute_mtx(0, l - 1, self.strict_mtx, self.loose_mtx, self.true_strict_mtx, MCS_map, pairs)
+            for idx in MCS_map:
+              self.set_MCSmap(idx[0],idx[1],MCS_map[idx])
+            if self.score_cache is not None:
+                logging.info('Score cache: %d hits, %d misses' % (self.score_cache.hits, self.score_cache.misses))
+        else:
+            # Parallel execution
+            logging.info('Parallel mode is on')
+
+            # Number of selected processes
+            num_proc = min(self.options.parallel, max(l, 1))
+
+            # Number of matrix elements handed out to a process at a time. Small
+            # batches balance the load, as the MCS time varies widely between pairs
+            batch_size = self.options.batch_size
+
+            # The shared queue of the batches is the index of the next batch to
+            # compute: the processes take batches from it until it is exhausted
+            next_batch = multiprocessing.Value('l', 0)
+
+            # The processes send their results back through this queue
+            results = multiprocessing.Queue()
+
+            # The molecules are shipped once to the processes as a shared memory
+            # block, rather than with a copy of the whole database per process
+            store = molstore.SharedMoleculeStore.create(self.__list)
+            context = (self.options, self.prespecified_links, self.score_cache, getattr(self, '_mol_keys', None),
+                       self.total_charges())
+
+            proc = []
+            for w in range(0, num_proc):
+                # Python multiprocessing allocation
+                p = multiprocessing.Process(target=score_worker,
+                                            args=(w, next_batch, l, batch_size, results, pairs, store.name, context, ))
+                p.start()
+                proc.append(p)
+
+            # The results are merged as they arrive. The queue must be drained
+            # before the processes are joined
+            busy = [0.0] * num_proc
+            done = 0
+            while done < num_proc:
+                try:
+                    msg = results.get(timeout=1.0)
+                except queue.Empty:
+                    if any(p.exitcode not in (None, 0) for p in proc):
+                        for p in proc:
+                            p.terminate()
+                        store.close()
+                        raise RuntimeError('A scoring process terminated unexpectedly')
+                    continue
+
+                if msg[0] is None:
+                    busy[msg[1]] = msg[2]
+                    done += 1
+                    continue
+
+                ks, strict_scr, loose_scr, true_strict_scr, maps = msg
+                self.strict_mtx.put(ks, strict_scr)
+                self.loose_mtx.put(ks, loose_scr)
+                self.true_strict_mtx.put(ks, true_strict_scr)
+                for i, j, ml in maps:
+                    self.set_MCSmap(i, j, ml)
+            # End parallel execution
+            for p in proc:
+                p.join()
+            store.close()
+
+            # Load imbalance: the time of the slowest process over the mean time
+            mean_busy = sum(busy) / len(busy)
+            self.load_imbalance = max(busy) / mean_busy if mean_busy > 0 else 1.0
+            logging.info('Parallel scoring: %d processes, batch size %d, load imbalance %.2f '
+                         '(max %.2fs, mean %.2fs)' % (num_proc, batch_size, self.load_imbalance,
+                                                       max(busy), mean_busy))
+
+        # The memory mapped matrices are written to disk
+        if self.options.matrix_dir:
+            for mtx in (self.strict_mtx, self.loose_mtx, self.true_strict_mtx):
+                mtx.flush()
+
+    @classmethod
+    def scoring_view(cls, molecules, options, prespecified_links, score_cache=None, mol_keys=None, charges=None):
+        """
+        This function returns a minimal molecule database used by the scoring
+        processes. The molecules are not copied, but read on demand from the
+        passed sequence
+
+        Parameters
+        ----------
+        molecules : sequence of Molecule objects
+           the molecules indexed by ID, e.g. a molstore.MoleculeBlock
+        options : argparse python object
+           the list of user options
+        prespecified_links : dict
+           the prespecified links of the parent database
+        score_cache : ScoreCache or None
+           the pair score cache
+        mol_keys : list of str
+           the score cache molecule keys
+        charges : numpy array of float
+           the total charges of the molecules
+
+        Returns
+        -------
+        db_mol : DBMolecules
+           the molecule database
+
+        """
+
+        db_mol = cls.__new__(cls)
+        db_mol.options = options
+        db_mol.__list = molecules
+        db_mol.dic_mapping = {}
+        db_mol.inv_dic_mapping = {}
+        db_mol.mcs_map_store = {}
+        db_mol.prespecified_links = prespecified_links
+        db_mol.known_actives = []
+        db_mol.score_cache = score_cache
+        db_mol._mol_keys = mol_keys
+        db_mol._charges = charges
+        db_mol._prepared = {}
+
+        return db_mol
+
+    def score_worker(self, w, next_batch, l, batch_size, results, pairs=None):
+        """
+        This function is run by each of the allocated processes. Batches of
+        matrix elements are taken from the shared queue and computed until all
+        the l elements have been handed out. The results are accumulated locally
+        and sent back to the parent process in blocks of arrays
+
+        Parameters
+        ----------
+        w : int
+           the process number
+        next_batch : python multiprocessing value
+           the start index of the next batch to compute
+        l : int
+           the total number of the elements to compute
+        batch_size : int
+           the number of elements taken from the queue at a time
+        results : python multiprocessing queue
+           the queue used to send back the results. Each message is the tuple
+           (linear indexes, strict scores, loose scores, true strict scores,
+           list of (i, j, MCS map)). A final (None, w, busy time) message is
+           sent when the process is over
+        pairs: numpy array of int
+            the linear indexes of the matrix elements to compute. If None all
+            the matrix elements are computed
+
+        """
+
+        # With memory mapped matrices the scores are written directly into the
+        # files of the parent process, and only the MCS maps are sent back
+        direct = bool(self.options.matrix_dir)
+
+        if direct:
+            strict_mtx, loose_mtx, true_strict_mtx = [SMatrix.memmap(self.matrix_file(kind), mode='r+')
+                                                      for kind in ('strict', 'loose', 'true_strict')]
+        else:
+            strict_mtx, loose_mtx, true_strict_mtx = {}, {}, {}
+        MCS_map = {}
+
+        def send():
+            if direct:
+                ks = np.zeros(0, dtype=np.int64)
+                scores = (np.zeros(0), np.zeros(0), np.zeros(0))
+            else:
+                ks = np.fromiter(strict_mtx.keys(), dtype=np.int64, count=len(strict_mtx))
+                scores = tuple(np.fromiter(mtx.values(), dtype=float, count=len(ks))
+                               for mtx in (strict_mtx, loose_mtx, true_strict_mtx))
+                strict_mtx.clear()
+                loose_mtx.clear()
+                true_strict_mtx.clear()
+            results.put((ks,) + scores + ([(i, j, ml) for (i, j), ml in MCS_map.items()],))
+            MCS_map.clear()
+
+        busy = 0.0
+        while True:
+            with next_batch.get_lock():
+                a = next_batch.value
+                next_batch.value = a + batch_size
+
+            if a >= l:
+                break
+
+            start = time.time()
+            self.compute_mtx(a, min(a + batch_size, l) - 1, strict_mtx, loose_mtx, true_strict_mtx, MCS_map, pairs)
+            busy += time.time() - start
+
+            if len(MCS_map) >= 256 or (not direct and len(strict_mtx) >= 256):
+                send()
+
+        if MCS_map or (not direct and strict_mtx):
+            send()
+
+        if direct:
+            for mtx in (strict_mtx, loose_mtx, true_strict_mtx):
+                mtx.flush()
+
+        if self.score_cache is not None:
+            logging.info('Score cache: %d hits, %d misses' % (self.score_cache.hits, self.score_cache.misses))
+
+        results.put((None, w, busy))
+
+    def build_graph(self):
+        """
+        This function coordinates the Graph generation
+
+        """
+        logging.info('\nGenerating graph in progress....')
+
+        # The Graph is build from an instance of the Class GraphGen by passing
+        # the selected user options
+        Gr = graphgen.GraphGen(self)
+
+        # Writing the results is files
+        if self.options.output:
+            try:
+                Gr.write_graph(self.options.output_no_images, self.options.output_no_graph)
+                with open(self.options.name + ".pickle", "wb") as pickle_f:
+                    pickle.dump(Gr, pickle_f)
+            except Exception as e:
+                logging.error(str(e))
+
+        # Handle to the the NetworkX generated graph
+        self.Graph = Gr.get_graph()
+
+        # print self.Graph.nodes(data=True)
+
+        # Display the graph by using Matplotlib
+        if self.options.display:
+            Gr.draw()
+
+        return self.Graph
+
+    def write_dic(self):
+        """
+        This function writes out a text file with the mapping between the
+        generated molecule indexes and the corresponding molecule file names
+
+        """
+
+        try:
+            file_txt = open(self.options.name + '.txt', 'w')
+        except Exception:
+            raise IOError('It was not possible to write out the mapping file')
+        file_txt.write('#ID\tFileName\n')
+        for key in self.dic_mapping:
+            file_txt.write('%d\t%s\n' % (key, self.dic_mapping[key]))
+
+        file_txt.close()
+
+    # *************************
+
+
+# Symmetric  Class
+# *************************
+
+
+class SMatrix(np.ndarray):
+    """
+    This class implements a "basic" interface for symmetric matrices 
+    subclassing ndarray. The class internally stores a bi-dimensional
+    numpy array as a linear array A[k], however the user can still 
+    access to the matrix elements by using a two indeces notation A[i,j]
+ 
+    """
+
+    def __new__(subtype, shape, dtype=float, buffer=None, offset=0, strides=None, order=None):
+        if len(shape) > 2:
+            raise ValueError('The matrix shape is greater than two')
+
+        elif len(shape) == 2:
+            if shape[0] != shape[1]:
+                raise ValueError('The matrix must be a squre matrix')
+
+        l = int(shape[0] * (shape[0] - 1) / 2)
+
+        shape = (l,)
+
+        obj = np.ndarray.__new__(subtype, shape, dtype, buffer, offset, strides, order)
+
+        # Array initialization. The memory is not initialized, so it is filled
+        # rather than multiplied by zero, which would keep any NaN
+        obj.fill(0.0)
+
+        return obj
+
+    def __getitem__(self, *kargs):
+        """
+        This function retrieves the selected elements i,j from the symmetric
+        matrix A[i,j]. The indexes i and j can also be integer arrays, in which
+        case the array of the selected elements is returned. An integer, a
+        slice or an array of linear indexes selects the linear array elements
+        
+        Parameters
+        ----------
+        *kargs : python tuples
+           the passed elements i,j
+
+        Returns
+        -------
+            : float or numpy array
+            the selected element extracted from the allocated linear array
+            
+        """
+
+        if isinstance(kargs[0], (int, np.integer, slice, np.ndarray)):
+            k = kargs[0]
+            return super(SMatrix, self).__getitem__(k)
+
+        elif len(kargs[0]) > 2:
+            raise ValueError('Two indices can be addressed')
+
+        i = kargs[0][0]
+        j = kargs[0][1]
+
+        if np.ndim(i) or np.ndim(j):
+            k, diag = self.pair_indexes(i, j)
+            values = self.view(np.ndarray)[np.where(diag, 0, k)] if self.size > 0 else np.zeros(k.shape)
+            values[diag] = 0.0
+            return values
+
+        if i == j:
+            return 0.0
+
+        # Total number of elements in the corresponding bi-dimensional symmetric matrix
+        n = self.mat_size()
+
+        if i > n - 1:
+            raise ValueError('First index out of bound')
+
+        if j > n - 1:
+            raise ValueError('Second index out of bound')
+
+        if i > j:
+            i, j = j, i
+
+        # The index is computed with integer arithmetic, which is exact for any matrix size
+        k = (n * (n - 1)) // 2 - ((n - i) * (n - i - 1)) // 2 + j - i - 1
+
+        return super(SMatrix, self).__getitem__(int(k))
 
     def __setitem__(self, *kargs):
         """
-        This function set the matrix elements i,j to the passed value
+        This function set the matrix elements i,j to the passed value. As for
+        __getitem__, the indexes can be integer arrays
         
         Parameters
         ----------
@@ -831,86 +1691,966 @@ class SMatrix(np.ndarray):
 
         """
 
-        if isinstance(kargs[0], int):
-            k = kargs[0]
-            value = kargs[1]
-            return super(SMatrix, self).__setitem__(k, value)
+        if isinstance(kargs[0], (int, np.integer, slice, np.ndarray)):
+            return super(SMatrix, self).__setitem__(kargs[0], kargs[1])
+
+        elif len(kargs[0]) > 2:
+            raise ValueError('Two indices can be addressed')
+
+        # Passed indexes and value to set
+        i = kargs[0][0]
+        j = kargs[0][1]
+        value = kargs[1]
+
+        if np.ndim(i) or np.ndim(j):
+            k, diag = self.pair_indexes(i, j)
+            if np.any(diag):
+                raise ValueError('The diagonal elements cannot be set')
+            self.view(np.ndarray)[k] = value
+            return
+
+        # Total number of elements in the corresponding bi-dimensional symmetric matrix
+        n = self.mat_size()
+
+        if i > n - 1:
+            raise ValueError('First index out of bound')
+        if j > n - 1:
+            raise ValueError('Second index out of bound')
+
+        if i < j:
+            k = (n * (n - 1)) // 2 - ((n - i) * (n - i - 1)) // 2 + j - i - 1
+        else:
+            k = (n * (n - 1)) // 2 - ((n - j) * (n - j - 1)) // 2 + i - j - 1
+        super(SMatrix, self).__setitem__(int(k), value)
+
+    def pair_indexes(self, i, j):
+        """
+        This function converts the arrays of row and column indexes i, j into
+        linear indexes
+
+        Returns
+        -------
+        k : numpy array of int
+           the linear indexes, not valid for the diagonal elements
+        diag : numpy array of bool
+           the diagonal elements mask
+
+        """
+
+        n = self.mat_size()
+
+        i, j = np.broadcast_arrays(np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64))
+
+        if np.any((i < 0) | (i > n - 1)):
+            raise ValueError('First index out of bound')
+        if np.any((j < 0) | (j > n - 1)):
+            raise ValueError('Second index out of bound')
+
+        return pair_to_linear(i, j, n), i == j
+
+    def condensed(self):
+        """
+        This function returns the linear array of the matrix as a contiguous
+        plain numpy array. Its layout is the condensed distance matrix layout
+        of scipy.spatial.distance. The matrices of the score stores and the
+        memory mapped ones are contiguous and returned without a copy, a
+        strided view of another array is copied
+
+        """
+
+        return np.ascontiguousarray(self.view(np.ndarray))
+
+    def row(self, i):
+        """
+        This function returns the row i of the symmetric matrix
+
+        Returns
+        -------
+        values : numpy array
+           the n elements of the row, the diagonal one set to zero
+
+        """
+
+        n = self.mat_size()
+        data = self.view(np.ndarray)
+
+        values = np.zeros(n, dtype=self.dtype)
+
+        # The elements (i, j > i) are contiguous in the linear array, while the
+        # elements (j < i, i) are one per row
+        start = i * n - i * (i + 1) // 2
+        values[i + 1:] = data[start:start + n - i - 1]
+        if i > 0:
+            values[:i] = data[pair_to_linear(np.arange(i), i, n)]
+
+        return values
+
+    def top_k(self, i, k):
+        """
+        This function returns the k largest elements of the row i, the
+        diagonal one excluded
+
+        Returns
+        -------
+        cols, values : numpy arrays
+           the column indexes and the values of the elements, by decreasing
+           value and increasing column for equal values
+
+        """
+
+        return row_top_k(self.row(i), i, k)
+
+    def pairs_above(self, threshold=0.0):
+        """
+        This function returns the elements greater than threshold
+
+        Returns
+        -------
+        i, j, values : numpy arrays
+           the row indexes, the column indexes (i < j) and the values of the
+           elements, in linear array order
+
+        """
+
+        data = self.view(np.ndarray)
+        ks = np.flatnonzero(data > threshold)
+        i, j = linear_to_pair(ks, self.mat_size())
+
+        return i, j, data[ks]
+
+    def to_numpy_2D_array(self):
+        """
+        This function returns the symmetric similarity score numpy matrix 
+        generated from the linear array
+        
+        Returns
+        -------
+        np_mat : numpy matrix
+           the symmetric similarity score numpy matrix built by using the linear
+           array 
+        
+        """
+
+        # Total number of elements in the corresponding bi-dimensional symmetric matrix
+        n = self.mat_size()
+
+        # The linear array holds the upper triangle in row order
+        np_mat = np.zeros((n, n))
+        np_mat[np.triu_indices(n, 1)] = self.view(np.ndarray)
+        np_mat += np_mat.T
+
+        return np_mat
+
+    def mat_size(self):
+        """
+        This function returns the size of the square similarity score matrix 
+        
+        Returns
+        -------
+        n : int
+           the size of the similarity score matrix
+        
+        """
+
+        # Length of the linear array 
+        l = self.size
+
+        # Total number of elements in the corresponding bi-dimensional symmetric matrix
+        n = (1 + math.isqrt(1 + 8 * l)) // 2
+
+        return n
+
+    @classmethod
+    def memmap(cls, fname, n=None, mode='r'):
+        """
+        This function returns a symmetric matrix stored in a file, which is
+        memory mapped rather than loaded. The file holds the linear array as
+        raw float64 values, so it can be read back by numpy.memmap or numpy.fromfile
+
+        Parameters
+        ----------
+        fname : str
+           the matrix file name
+        n : int
+           the size of the square matrix. Only used to create the file
+        mode : str
+           'w+' creates the file filled with zeros, 'r+' opens an existing file
+           for reading and writing and 'r' opens it read only
+
+        Returns
+        -------
+        mat : SMatrix
+           the file backed matrix
+
+        """
+
+        if mode == 'w+':
+            if n is None:
+                raise ValueError('The matrix size is required to create the matrix file')
+            l = n * (n - 1) // 2
+            if l == 0:
+                # An empty file cannot be mapped
+                open(fname, 'wb').close()
+                return SMatrix(shape=(n,))
+            mm = np.memmap(fname, dtype=float, mode='w+', shape=(l,))
+        else:
+            if os.path.getsize(fname) == 0:
+                return SMatrix(shape=(0,))
+            mm = np.memmap(fname, dtype=float, mode=mode)
+
+        return mm.view(cls)
+
+    def _memmap_base(self):
+        # The memory map holding the elements of a file backed matrix, or None
+        base = self.base
+        while base is not None and not isinstance(base, np.memmap):
+            base = getattr(base, 'base', None)
+        return base
+
+    def flush(self):
+        """
+        This function writes the changes of a file backed matrix to disk. It
+        does nothing for the matrices held in memory
+        """
+
+        base = self._memmap_base()
+        if base is not None:
+            base.flush()
+
+    def __reduce__(self):
+        # A file backed matrix is pickled as a reference to its file, which is
+        # opened read only when loaded
+        base = self._memmap_base()
+        if base is not None and base.filename is not None and base.size == self.size:
+            self.flush()
+            return (SMatrix.memmap, (base.filename, None, 'r'))
+
+        return super(SMatrix, self).__reduce__()
+
+    def expand(self, new_n, fname=None):
+        """
+        This function returns a larger symmetric matrix holding the elements of
+        this matrix. The elements involving the new rows are set to zero
+
+        Parameters
+        ----------
+        new_n : int
+           the size of the new square similarity score matrix
+        fname : str
+           if set, the expanded matrix is created in this memory mapped file
+           and filled without a copy in memory
+
+        Returns
+        -------
+        new_mat : SMatrix
+           the expanded matrix
+
+        """
+
+        n = self.mat_size() if self.size > 0 else 0
+
+        if new_n < n:
+            raise ValueError('The new matrix size is smaller than the current one')
+
+        if fname is not None:
+            new_mat = SMatrix.memmap(fname, new_n, mode='w+')
+        else:
+            new_mat = SMatrix(shape=(new_n,))
+        expand_condensed(self.view(np.ndarray), n, new_n, out=new_mat.view(np.ndarray))
+
+        return new_mat
+
+
+class SparseSMatrix(object):
+    """
+    This class implements a symmetric matrix storing only its non zero
+    elements, or the elements above a floor value. It has the same interface
+    as SMatrix: the elements are accessed by using the two indeces notation
+    A[i,j] or the linear index A[k] of the corresponding SMatrix, whose
+    length is returned by size. The elements are stored as sorted arrays of
+    linear indexes and values, and the rows are available without scanning
+    the whole matrix
+
+    """
+
+    def __init__(self, shape, dtype=float, floor=0.0):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        shape : tuple
+           the matrix shape (n,) or (n, n)
+        dtype : numpy data type
+           the type of the stored values
+        floor : float
+           the elements whose absolute value is not greater than floor are
+           not stored and read as zero
+
+        """
+
+        if len(shape) > 2:
+            raise ValueError('The matrix shape is greater than two')
+
+        elif len(shape) == 2:
+            if shape[0] != shape[1]:
+                raise ValueError('The matrix must be a squre matrix')
+
+        self.n = int(shape[0])
+        self.size = self.n * (self.n - 1) // 2
+        self.dtype = np.dtype(dtype)
+        self.floor = floor
+
+        # Sorted linear indexes of the stored elements and their values
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros(0, dtype=self.dtype)
+
+        # Elements set one at a time are buffered and merged on the next read
+        self.__pending = {}
+
+        # Symmetric row layout (row pointers, columns, values) built on demand
+        self.__rows = None
+
+    def __getstate__(self):
+        self.consolidate()
+        state = self.__dict__.copy()
+        state['_SparseSMatrix__rows'] = None
+        return state
+
+    def __len__(self):
+        return self.size
+
+    def nnz(self):
+        """
+        Return the number of stored elements
+        """
+
+        self.consolidate()
+        return len(self.keys)
+
+    def mat_size(self):
+        """
+        This function returns the size of the square similarity score matrix
+        """
+
+        return self.n
+
+    def linear_index(self, i, j):
+        # Linear index of the element i,j, with the bound checks of SMatrix
+        if i > self.n - 1:
+            raise ValueError('First index out of bound')
+        if j > self.n - 1:
+            raise ValueError('Second index out of bound')
+
+        return int(pair_to_linear(i, j, self.n))
+
+    def __getitem__(self, key):
+        """
+        This function retrieves the element A[i,j] or A[k] of the matrix. As
+        for SMatrix, i and j can be integer arrays
+        """
+
+        if isinstance(key, tuple):
+            if len(key) > 2:
+                raise ValueError('Two indices can be addressed')
+            i, j = key
+            if np.ndim(i) or np.ndim(j):
+                return self.take_pairs(i, j)
+            if i == j:
+                return 0.0
+            k = self.linear_index(i, j)
+        else:
+            k = int(key)
+            if k < 0:
+                k += self.size
+            if k < 0 or k >= self.size:
+                raise IndexError('Index out of bound')
+
+        if k in self.__pending:
+            return self.__pending[k]
+
+        pos = np.searchsorted(self.keys, k)
+        if pos < len(self.keys) and self.keys[pos] == k:
+            return self.values[pos]
+
+        return self.dtype.type(0)
+
+    def __setitem__(self, key, value):
+        """
+        This function sets the element A[i,j] or A[k] of the matrix
+        """
+
+        if isinstance(key, tuple):
+            if len(key) > 2:
+                raise ValueError('Two indices can be addressed')
+            if np.ndim(key[0]) or np.ndim(key[1]):
+                k, diag = self.pair_indexes(*key)
+                if np.any(diag):
+                    raise ValueError('The diagonal elements cannot be set')
+                return self.put(k, value)
+            k = self.linear_index(*key)
+        else:
+            k = int(key)
+            if k < 0:
+                k += self.size
+            if k < 0 or k >= self.size:
+                raise IndexError('Index out of bound')
+
+        self.__pending[k] = self.dtype.type(value)
+        self.__rows = None
+
+    def pair_indexes(self, i, j):
+        """
+        This function converts the arrays of row and column indexes i, j into
+        linear indexes, see SMatrix.pair_indexes
+        """
+
+        i, j = np.broadcast_arrays(np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64))
+
+        if np.any((i < 0) | (i > self.n - 1)):
+            raise ValueError('First index out of bound')
+        if np.any((j < 0) | (j > self.n - 1)):
+            raise ValueError('Second index out of bound')
+
+        return pair_to_linear(i, j, self.n), i == j
+
+    def take_pairs(self, i, j):
+        # The elements of the arrays of row and column indexes i, j
+        self.consolidate()
+
+        k, diag = self.pair_indexes(i, j)
+
+        pos = np.minimum(np.searchsorted(self.keys, k), max(len(self.keys) - 1, 0))
+        values = np.zeros(k.shape, dtype=self.dtype)
+        if len(self.keys):
+            found = (self.keys[pos] == k) & ~diag
+            values[found] = self.values[pos[found]]
+
+        return values
+
+    def put(self, ks, values):
+        """
+        This function sets the elements of the linear indexes ks, as
+        numpy.ndarray.put does for SMatrix
+
+        Parameters
+        ----------
+        ks : numpy array of int
+           the linear indexes of the elements
+        values : numpy array or float
+           the element values
+
+        """
+
+        self.consolidate()
 
-        elif isinstance(kargs[0], slice):
-            start, stop, step = kargs[0].indices(len(self))
-            value = kargs[1]
-            return super(SMatrix, self).__setitem__(kargs[0], value)
+        ks = np.asarray(ks, dtype=np.int64).ravel()
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), ks.shape)
 
-        elif len(kargs[0]) > 2:
-            raise ValueError('Two indices can be addressed')
+        if len(ks) and (ks.min() < 0 or ks.max() >= self.size):
+            raise IndexError('Index out of bound')
 
-        # Passed indexes and value to set
-        i = kargs[0][0]
-        j = kargs[0][1]
-        value = kargs[1]
+        self.merge(ks, values)
 
-        # Length of the linear array 
-        l = self.size
+    def consolidate(self):
+        """
+        Merge the buffered elements into the sorted arrays
+        """
 
-        # Total number of elements in the corresponding bi-dimensional symmetric matrix
-        n = int((1 + math.sqrt(1 + 8 * l)) / 2)
+        if not self.__pending:
+            return
 
-        if i > n - 1:
-            raise ValueError('First index out of bound')
-        if j > n - 1:
-            raise ValueError('Second index out of bound')
+        ks = np.fromiter(self.__pending.keys(), dtype=np.int64, count=len(self.__pending))
+        values = np.fromiter(self.__pending.values(), dtype=self.dtype, count=len(self.__pending))
+        self.__pending = {}
 
-        if i < j:
-            k = int((n * (n - 1) / 2) - (n - i) * ((n - i) - 1) / 2 + j - i - 1)
-        else:
-            k = int((n * (n - 1) / 2) - (n - j) * ((n - j) - 1) / 2 + i - j - 1)
-        super(SMatrix, self).__setitem__(k, value)
+        self.merge(ks, values)
 
-    def to_numpy_2D_array(self):
+    def merge(self, ks, values):
+        # The last value of a repeated index is kept, as with a sequence of assignments
+        order = np.argsort(ks, kind='stable')
+        ks = ks[order]
+        values = values[order]
+        last = np.append(ks[1:] != ks[:-1], True)
+        ks = ks[last]
+        values = values[last]
+
+        old = ~np.isin(self.keys, ks, assume_unique=True)
+        keys = np.concatenate((self.keys[old], ks))
+        vals = np.concatenate((self.values[old], values))
+
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        vals = vals[order]
+
+        stored = np.abs(vals) > self.floor
+        self.keys = keys[stored]
+        self.values = vals[stored]
+        self.__rows = None
+
+    def row_layout(self):
         """
-        This function returns the symmetric similarity score numpy matrix 
-        generated from the linear array
-        
+        This function returns the stored elements grouped by row, both halves
+        of the symmetric matrix included
+
         Returns
         -------
-        np_mat : numpy matrix
-           the symmetric similarity score numpy matrix built by using the linear
-           array 
-        
+        indptr, cols, values : numpy arrays
+           the columns and values of the row i are cols[indptr[i]:indptr[i+1]]
+           and values[indptr[i]:indptr[i+1]], sorted by column
+
         """
 
-        # Length of the linear array 
-        l = self.size
+        self.consolidate()
 
-        # Total number of elements in the corresponding bi-dimensional symmetric matrix
-        n = int((1 + math.sqrt(1 + 8 * l)) / 2)
+        if self.__rows is None:
+            i, j = linear_to_pair(self.keys, self.n)
+            rows = np.concatenate((i, j))
+            cols = np.concatenate((j, i))
+            values = np.concatenate((self.values, self.values))
 
-        np_mat = np.zeros((n, n))
+            order = np.lexsort((cols, rows))
+            indptr = np.zeros(self.n + 1, dtype=np.int64)
+            np.cumsum(np.bincount(rows, minlength=self.n), out=indptr[1:])
+
+            self.__rows = (indptr, cols[order], values[order])
+
+        return self.__rows
+
+    def row(self, i):
+        """
+        This function returns the row i of the symmetric matrix
+
+        Returns
+        -------
+        values : numpy array
+           the n elements of the row, the diagonal one set to zero
+
+        """
+
+        indptr, cols, values = self.row_layout()
+
+        row = np.zeros(self.n, dtype=self.dtype)
+        row[cols[indptr[i]:indptr[i + 1]]] = values[indptr[i]:indptr[i + 1]]
+
+        return row
+
+    def top_k(self, i, k):
+        """
+        This function returns the k largest elements of the row i, see SMatrix.top_k
+        """
+
+        return row_top_k(self.row(i), i, k)
+
+    def pairs_above(self, threshold=0.0):
+        """
+        This function returns the stored elements greater than threshold, see
+        SMatrix.pairs_above. The threshold must not be negative, as the
+        elements which are not stored are not returned
+        """
+
+        self.consolidate()
+
+        above = self.values > threshold
+        i, j = linear_to_pair(self.keys[above], self.n)
+
+        return i, j, self.values[above]
+
+    def iter_rows(self):
+        """
+        Row generator, yielding the tuples (i, cols, values) of all the rows
+        """
+
+        indptr, cols, values = self.row_layout()
+        for i in range(0, self.n):
+            yield i, cols[indptr[i]:indptr[i + 1]], values[indptr[i]:indptr[i + 1]]
+
+    def to_dense(self):
+        """
+        This function returns the matrix as a dense SMatrix
+        """
+
+        self.consolidate()
+
+        mat = SMatrix(shape=(self.n,), dtype=self.dtype)
+        mat.put(self.keys, self.values)
+
+        return mat
+
+    @classmethod
+    def from_dense(cls, mat, floor=0.0):
+        """
+        This function builds a sparse matrix from a dense SMatrix
+        """
+
+        n = mat.mat_size() if mat.size > 0 else 0
+        sparse = cls(shape=(n,), dtype=mat.dtype, floor=floor)
+
+        values = mat.view(np.ndarray)
+        stored = np.flatnonzero(np.abs(values) > floor)
+        sparse.keys = stored.astype(np.int64)
+        sparse.values = values[stored].copy()
+
+        return sparse
+
+    def to_numpy_2D_array(self):
+        """
+        This function returns the symmetric similarity score numpy matrix
+        """
+
+        indptr, cols, values = self.row_layout()
 
-        for i in range(0, n):
-            for j in range(0, n):
-                np_mat[i, j] = self[i, j]
+        np_mat = np.zeros((self.n, self.n))
+        rows = np.repeat(np.arange(self.n), np.diff(indptr))
+        np_mat[rows, cols] = values
 
         return np_mat
 
-    def mat_size(self):
+    def expand(self, new_n):
         """
-        This function returns the size of the square similarity score matrix 
-        
+        This function returns a larger symmetric matrix holding the elements of
+        this matrix. The elements involving the new rows are set to zero
+
+        Parameters
+        ----------
+        new_n : int
+           the size of the new square similarity score matrix
+
         Returns
         -------
+        new_mat : SparseSMatrix
+           the expanded matrix
+
+        """
+
+        if new_n < self.n:
+            raise ValueError('The new matrix size is smaller than the current one')
+
+        self.consolidate()
+
+        new_mat = SparseSMatrix(shape=(new_n,), dtype=self.dtype, floor=self.floor)
+        i, j = linear_to_pair(self.keys, self.n)
+        # The element order is kept, as the rows are laid out in the same order
+        new_mat.keys = np.asarray(pair_to_linear(i, j, new_n), dtype=np.int64)
+        new_mat.values = self.values.copy()
+
+        return new_mat
+
+
+class ScoreStore(object):
+    """
+    This class stores the similarity scores of all the molecule pairs once, in
+    a single linear array laid out as the SMatrix one. The strict and loose
+    scores are the same, so the strict and loose matrices are SMatrix views of
+    the score array. The true strict matrix only differs from them for the links
+    forced into the graph, which are read as 1.0 in the strict and loose
+    matrices: these few pairs are kept in a sorted array of linear indexes, and
+    their true scores aside. The store takes a third of the memory of the three
+    matrices in the same precision
+
+    """
+
+    # Flag of the forced links, in the stores written with a flags field
+    FORCED = 1
+
+    def __init__(self, n, dtype=np.float64):
+        """
+        Initialization function
+
+        Parameters
+        ----------
         n : int
-           the size of the similarity score matrix
-        
+           the size of the square matrices
+        dtype : numpy data type
+           the type of the stored scores
+
         """
 
-        # Length of the linear array 
-        l = self.size
+        self.n = n
+        self.data = np.zeros(n * (n - 1) // 2, dtype=dtype)
 
-        # Total number of elements in the corresponding bi-dimensional symmetric matrix
-        n = int((1 + math.sqrt(1 + 8 * l)) / 2)
+        # Sorted linear indexes of the forced links, and their true scores by linear index
+        self.forced = np.zeros(0, dtype=np.int64)
+        self.true_scores = {}
 
-        return n
+    def __setstate__(self, state):
+        # The pair flags of the stores written before were held by a field of the score array
+        self.__dict__.update(state)
+        if self.data.dtype.names:
+            self.forced = np.flatnonzero(self.data['flags'] & ScoreStore.FORCED).astype(np.int64)
+            self.data = np.ascontiguousarray(self.data['score'])
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def scores(self):
+        """
+        This function returns the score array as an SMatrix, without a copy
+        """
+
+        return self.data.view(SMatrix)
+
+    def matrices(self):
+        """
+        This function returns the strict, loose and true strict similarity
+        score matrices, which are views of the store
+        """
+
+        return self.scores(), self.scores(), TrueScoreMatrix(self)
+
+    def set_forced(self, ks):
+        """
+        This function flags the pairs of the linear indexes ks as forced links.
+        Their true scores are then written aside by the true strict matrix
+        """
+
+        self.forced = np.union1d(self.forced, np.asarray(ks, dtype=np.int64))
+
+    def is_forced(self, ks):
+        """
+        This function returns the mask of the linear indexes ks which are forced links
+        """
+
+        return np.isin(ks, self.forced)
+
+    def expand(self, new_n):
+        """
+        This function returns a larger store holding the elements of this one.
+        The elements involving the new rows are set to zero
+        """
+
+        if new_n < self.n:
+            raise ValueError('The new matrix size is smaller than the current one')
+
+        new_store = ScoreStore(new_n, dtype=self.data.dtype)
+        new_store.data = expand_condensed(self.data, self.n, new_n)
+        if len(self.forced):
+            i, j = linear_to_pair(self.forced, self.n)
+            new_store.forced = np.sort(np.asarray(pair_to_linear(i, j, new_n), dtype=np.int64))
+        for k, value in self.true_scores.items():
+            i, j = linear_to_pair(k, self.n)
+            new_store.true_scores[int(pair_to_linear(i, j, new_n))] = value
+
+        return new_store
+
+
+class TrueScoreMatrix(object):
+    """
+    This class implements the true strict similarity score matrix of a
+    ScoreStore. It reads the store scores, except for the forced links whose
+    true scores are kept aside. It supports the element access of SMatrix
+
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    @property
+    def size(self):
+        return self.store.size
+
+    def __len__(self):
+        return self.store.size
+
+    def mat_size(self):
+        return self.store.n
+
+    def linear_indexes(self, key):
+        # Linear indexes of the passed key and the diagonal elements mask
+        if isinstance(key, tuple):
+            if len(key) > 2:
+                raise ValueError('Two indices can be addressed')
+            return self.store.scores().pair_indexes(*key)
+
+        if isinstance(key, slice):
+            k = np.arange(*key.indices(self.size))
+        else:
+            k = np.asarray(key, dtype=np.int64)
+            k = np.where(k < 0, k + self.size, k)
+
+        return k, np.zeros(k.shape, dtype=bool)
+
+    def __getitem__(self, key):
+        """
+        This function retrieves the element A[i,j] or A[k] of the matrix, or
+        the elements of integer arrays of indexes as SMatrix does
+        """
+
+        values = self.store.scores()[key]
+
+        if not self.store.true_scores:
+            return values
+
+        k, diag = self.linear_indexes(key)
+
+        if np.ndim(values) == 0:
+            if diag:
+                return values
+            return self.store.true_scores.get(int(k), values)
+
+        values = np.array(values)
+        forced = np.isin(k, np.fromiter(self.store.true_scores.keys(), dtype=np.int64)) & ~diag
+        values[forced] = [self.store.true_scores[int(kk)] for kk in k[forced]]
+
+        return values
+
+    def __setitem__(self, key, value):
+        """
+        This function sets the element A[i,j] or A[k] of the matrix, or the
+        elements of integer arrays of indexes
+        """
+
+        k, diag = self.linear_indexes(key)
+        if np.any(diag):
+            raise ValueError('The diagonal elements cannot be set')
+
+        self.put(k, value)
+
+    def put(self, ks, values):
+        """
+        This function sets the elements of the linear indexes ks. The scores of
+        the forced links are kept aside, the other ones are written to the store
+        """
+
+        ks = np.asarray(ks, dtype=np.int64).ravel()
+        values = np.broadcast_to(np.asarray(values, dtype=self.store.data.dtype), ks.shape)
+
+        if len(ks) and (ks.min() < 0 or ks.max() >= self.size):
+            raise IndexError('Index out of bound')
+
+        forced = self.store.is_forced(ks)
+        for k, value in zip(ks[forced], values[forced]):
+            self.store.true_scores[int(k)] = value
+
+        self.store.data[ks[~forced]] = values[~forced]
+
+    def row(self, i):
+        """
+        This function returns the row i of the symmetric matrix
+        """
+
+        return self[np.full(self.store.n, i), np.arange(self.store.n)]
+
+    def to_numpy_2D_array(self):
+        """
+        This function returns the symmetric similarity score numpy matrix
+        """
+
+        np_mat = self.store.scores().to_numpy_2D_array()
+        for k, value in self.store.true_scores.items():
+            i, j = linear_to_pair(k, self.store.n)
+            np_mat[i, j] = np_mat[j, i] = value
+
+        return np_mat
+
+
+def linear_to_pair(k, n):
+    """
+    This function converts the linear indexes of a symmetric n x n matrix
+    stored as a linear array into its row and column indexes (i < j)
+
+    Parameters
+    ----------
+    k : numpy array of int
+       the linear indexes
+    n : int
+       the size of the square matrix
+
+    Returns
+    -------
+    i, j : numpy arrays of int
+       the row and column indexes
+
+    """
+
+    k = np.asarray(k, dtype=np.int64)
+
+    i = (n - 2 - np.floor(np.sqrt(np.maximum(-8.0 * k + 4.0 * n * (n - 1) - 7, 0.0)) / 2.0 - 0.5)).astype(np.int64)
+    i = np.clip(i, 0, max(n - 2, 0))
+
+    # The floating point estimate of the row can be off by one for very large
+    # matrices, so it is corrected with exact integer arithmetic. The row i
+    # starts at the linear index i * n - i * (i + 1) / 2
+    def row_start(r):
+        return r * n - r * (r + 1) // 2
+
+    while True:
+        below = row_start(i) > k
+        above = row_start(i + 1) <= k
+        if not (np.any(below) or np.any(above)):
+            break
+        i = i - below + above
+
+    j = k - row_start(i) + i + 1
+
+    return i, j
+
+
+def row_top_k(values, i, k):
+    """
+    This function returns the k largest elements of the matrix row i, given
+    as an array, the diagonal element excluded. The elements are sorted by
+    decreasing value and increasing column index
+    """
+
+    values = np.asarray(values, dtype=float).copy()
+    values[i] = -np.inf
+
+    k = max(0, min(k, len(values) - 1))
+    cols = np.argsort(-values, kind='stable')[:k]
+
+    return cols, values[cols]
+
+
+def pair_to_linear(i, j, n):
+    """
+    This function converts the row and column indexes i, j (i != j) of a
+    symmetric n x n matrix into the index of its linear array. Both int and
+    numpy arrays of int are accepted
+    """
+
+    i, j = np.minimum(i, j), np.maximum(i, j)
+
+    return n * (n - 1) // 2 - (n - i) * ((n - i) - 1) // 2 + j - i - 1
+
+
+def expand_condensed(values, n, new_n, out=None):
+    """
+    This function copies the linear array of a symmetric n x n matrix into the
+    linear array of a larger new_n x new_n matrix. The elements involving the
+    new rows are set to zero
+
+    Parameters
+    ----------
+    values : numpy array
+       the linear array of the n x n matrix
+    n : int
+       the size of the square matrix
+    new_n : int
+       the size of the new square matrix
+    out : numpy array
+       if set, the zero filled linear array of the new matrix to write to
+
+    Returns
+    -------
+    new_values : numpy array
+       the linear array of the new matrix, with the same dtype
+
+    """
+
+    if out is None:
+        new_values = np.zeros(new_n * (new_n - 1) // 2, dtype=values.dtype)
+    else:
+        new_values = out
+
+    # Each row of the linear array is copied as a contiguous block
+    for i in range(0, n - 1):
+        start = i * n - i * (i + 1) // 2
+        new_start = i * new_n - i * (i + 1) // 2
+        new_values[new_start:new_start + n - i - 1] = values[start:start + n - i - 1]
+
+    return new_values
 
     # *************************
 
@@ -922,7 +2662,8 @@ class SMatrix(np.ndarray):
 class Molecule(object):
     """
     This Class stores the Rdkit molecule objects, their identification number 
-    and the total number of instantiated molecules 
+    and the total number of instantiated molecules. The molecules are held in
+    the compact RDKit binary form and materialized on demand
 
     """
 
@@ -936,8 +2677,10 @@ class Molecule(object):
         
         Parameters
         ----------
-        molecule : Rdkit molecule object
-           the molecule
+        molecule : Rdkit molecule object, bytes or memoryview
+           the molecule, or its RDKit binary form. A memoryview can refer to a
+           molecule block in shared memory or in a memory mapped file, which is
+           then read when the molecule is materialized
 
         mol_id : int
            the molecule identification number
@@ -948,15 +2691,23 @@ class Molecule(object):
         """
 
         # Check Inputs
-        if not isinstance(molecule, Chem.rdchem.Mol):
+        if not isinstance(molecule, (Chem.rdchem.Mol, bytes, memoryview)):
             raise ValueError('The passed molecule object is not a RdKit molecule')
 
         if not isinstance(molname, str):
             raise ValueError('The passed molecule name must be a string')
 
-        # The variable __molecule saves the current RDkit molecule object
+        # The variable __binary saves the RDkit binary form of the molecule. All the
+        # properties are kept, as the electrostatic rule uses the mol2 partial charges
+        # The variable is defined as private
+        if isinstance(molecule, Chem.rdchem.Mol):
+            molecule = molecule.ToBinary(Chem.PropertyPickleOptions.AllProps)
+        self.__binary = molecule
+
+        # The variable __molecule saves the read only RDkit molecule object, which is
+        # materialized on demand
         # The variable is defined as private
-        self.__molecule = molecule
+        self.__molecule = None
 
         # The variable __ID saves the molecule identification number 
         # The variable is defined as private
@@ -970,6 +2721,21 @@ class Molecule(object):
         # The variable is defined as private
         self.__active = False
 
+    def __getstate__(self):
+        # The materialized molecule is rebuilt on demand rather than stored
+        state = self.__dict__.copy()
+        state['_Molecule__binary'] = bytes(self.__binary)
+        state['_Molecule__molecule'] = None
+        state.pop('_Molecule__prepared', None)
+        return state
+
+    def __setstate__(self, state):
+        # Molecules saved before the binary form was introduced hold the RDkit molecule
+        if '_Molecule__binary' not in state:
+            state['_Molecule__binary'] = state['_Molecule__molecule'].ToBinary(Chem.PropertyPickleOptions.AllProps)
+            state['_Molecule__molecule'] = None
+        self.__dict__.update(state)
+
 
     def getID(self):
         """
@@ -983,19 +2749,45 @@ class Molecule(object):
         """
         return self.__ID
 
-    def getMolecule(self):
+    def getMolecule(self, copy=True):
         """
         Get the Rdkit molecule object
 
+        Parameters
+        ----------
+        copy : bool
+           if True a new RDkit molecule is returned, which can be modified.
+           Otherwise the molecule is materialized once and shared between the
+           calls, so it must not be modified
+
         Returns
         -------
         mol_copy : Rdkit molecule object
-           The copy of the RDkit molecule
+           The copy of the RDkit molecule, or the read only molecule
 
         """
-        mol_copy = Chem.Mol(self.__molecule)
+
+        if not copy:
+            if self.__molecule is None:
+                self.__molecule = Chem.Mol(bytes(self.__binary))
+            return self.__molecule
+
+        mol_copy = Chem.Mol(bytes(self.__binary))
         return mol_copy
 
+    def getBinary(self):
+        """
+        Get the RDkit binary form of the molecule, with all its properties
+
+        Returns
+        -------
+           : bytes or memoryview
+           the molecule binary
+
+        """
+
+        return self.__binary
+
     def getName(self):
         """
         Get the molecule file name
@@ -1030,16 +2822,45 @@ class Molecule(object):
 
         self.__active=active
 
+def score_worker(w, next_batch, l, batch_size, results, pairs, store_name, context):
+    """
+    Entry point of the parallel scoring processes. The process attaches to the
+    shared memory molecule block and runs DBMolecules.score_worker on it
+
+    Parameters
+    ----------
+    store_name : str
+        the name of the shared memory molecule block
+    context : tuple
+        the options, prespecified links, score cache, score cache molecule
+        keys and molecule charges of the parent database
+
+    See DBMolecules.score_worker for the other parameters
+
+    """
+
+    set_logging(context[0].verbose)
+
+    store = molstore.SharedMoleculeStore.attach(store_name)
+    try:
+        db_mol = DBMolecules.scoring_view(store.block, *context)
+        db_mol.score_worker(w, next_batch, l, batch_size, results, pairs)
+        del db_mol
+    finally:
+        store.close()
+
+
 class CheckDir(argparse.Action):
     # Classes used to check some of the passed user options in the main function
-    # Class used to check the input directory
-    def __call__(self, parser, namespace, directory, option_string=None):
-        if not os.path.isdir(directory):
-            raise argparse.ArgumentTypeError('The directory name is not a valid path: %s' % directory)
-        if os.access(directory, os.R_OK):
-            setattr(namespace, self.dest, directory)
-        else:
-            raise argparse.ArgumentTypeError('The directory name is not readable: %s' % directory)
+    # Class used to check the input directories, files or glob patterns
+    def __call__(self, parser, namespace, sources, option_string=None):
+        for source in sources:
+            if not os.path.exists(source):
+                if not readers.molecule_files(source):
+                    raise argparse.ArgumentTypeError('The input name is not a valid path or pattern: %s' % source)
+            elif not os.access(source, os.R_OK):
+                raise argparse.ArgumentTypeError('The input name is not readable: %s' % source)
+        setattr(namespace, self.dest, sources)
 
 
 class CheckPos(argparse.Action):
@@ -1050,6 +2871,14 @@ class CheckPos(argparse.Action):
         setattr(namespace, self.dest, value)
 
 
+class CheckNonNeg(argparse.Action):
+    # Class used to check the score report top user option, where 0 means all the pairs
+    def __call__(self, parser, namespace, value, option_string=None):
+        if value < 0:
+            raise argparse.ArgumentTypeError('%s is not a non negative integer number' % value)
+        setattr(namespace, self.dest, value)
+
+
 class CheckCutoff(argparse.Action):
     # Class used to check the cutoff user option
     def __call__(self, parser, namespace, value, option_string=None):
@@ -1066,17 +2895,52 @@ class CheckEcrscore(argparse.Action):
         setattr(namespace, self.dest, value)
 
 
+def set_logging(verbose):
+    # Set the logging level from the verbose user option
+    if verbose == 'off':
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+
+    if verbose == 'info':
+        logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+    if verbose == 'pedantic':
+        logging.basicConfig(format='%(message)s', level=logging.DEBUG)
+        # logging.basicConfig(format='%(levelname)s:\t%(message)s', level=logging.DEBUG)
+
+
+def prepare(args=None):
+    # Options and arguments passed by the user to lomap prepare
+    ops = prepare_parser.parse_args(args)
+
+    # The molecules are read and validated once, and written with their per-molecule data
+    db_mol = DBMolecules(ops.directory, ops.parallel, ops.verbose, known_actives_file=ops.known_actives_file)
+    db_mol.write_database(ops.database)
+
+
 def startup():
+    # The prepare subcommand writes a molecule database rather than planning the calculations
+    if len(sys.argv) > 1 and sys.argv[1] == 'prepare':
+        return prepare(sys.argv[2:])
+
     # Options and arguments passed by the user
     ops = parser.parse_args()
 
-    # Molecule DataBase initialized with the passed user options
-    db_mol = DBMolecules(ops.directory, ops.parallel, ops.verbose, ops.time, ops.ecrscore, ops.threed, ops.max3d, 
-                         ops.output, ops.name, ops.output_no_images, ops.output_no_graph, ops.display, 
-                         ops.allow_tree, ops.max, ops.cutoff, ops.radial, ops.hub, ops.fast, ops.links_file, 
-                         ops.known_actives_file, ops.max_dist_from_actives)
-    # Similarity score linear array generation
-    strict, loose = db_mol.build_matrices()
+    if ops.incremental:
+        # The molecule database of a previous run is extended with the molecules
+        # which are not part of it yet. Only the new pairs are scored
+        db_mol = DBMolecules.load(ops.incremental, ops)
+        new_mols = [mol for mol in db_mol.read_molecule_files() if mol.getName() not in db_mol.inv_dic_mapping]
+        strict, loose = db_mol.add_molecules(new_mols)
+    else:
+        # Molecule DataBase initialized with the passed user options
+        db_mol = DBMolecules(ops.directory, ops.parallel, ops.verbose, ops.time, ops.ecrscore, ops.threed, ops.max3d, 
+                             ops.output, ops.name, ops.output_no_images, ops.output_no_graph, ops.display, 
+                             ops.allow_tree, ops.max, ops.cutoff, ops.radial, ops.hub, ops.fast, ops.links_file, 
+                             ops.known_actives_file, ops.max_dist_from_actives, ops.score_cache, ops.score_cache_size,
+                             ops.batch_size, ops.fp_cutoff, ops.prune_cutoff, ops.sparse, ops.sparse_floor,
+                             ops.matrix_dir, ops.score_precision, ops.score_report_top)
+        # Similarity score linear array generation
+        strict, loose = db_mol.build_matrices()
 
     # Get the 2D numpy matrices
     # strict.to_numpy_2D_array()
@@ -1093,12 +2957,20 @@ def startup():
 # ----------------------------------------------------------------
 parser = argparse.ArgumentParser(description='Lead Optimization Mapper 2. A program to plan alchemical relative '
                                              'binding affinity calculations',
-                                 prog='LOMAP v. %s' % get_versions()['version'])
-parser.add_argument('directory', action=CheckDir, \
-                    help='The mol2/sdf file directory')
+                                 prog='LOMAP v. %s' % get_versions()['version'],
+                                 epilog='Run "lomap prepare -h" for the preparation of a molecule database, which '
+                                        'is opened faster than the mol2/sdf files')
+parser.add_argument('directory', nargs='+', action=CheckDir, \
+                    help='The mol2/sdf file directory. Several directories, mol2/sdf files or glob patterns can be '
+                         'passed. The files can be gzipped (.sdf.gz, .mol2.gz) and hold several molecules each, '
+                         'which are then named after the record titles. A molecule database written by lomap '
+                         'prepare can be passed instead')
 parser.add_argument('-p', '--parallel', default=1, action=CheckPos, type=int, \
                     help='Set the parallel mode. If an integer number N is specified, N processes will be executed to '
                          'build the similarity matrices')
+parser.add_argument('--batch-size', default=4, action=CheckPos, type=int, \
+                    help='In parallel mode, the number of molecule pairs each process takes at a time from the shared '
+                         'queue of the pairs to score. Smaller batches give a better load balance')
 parser.add_argument('-v', '--verbose', default='info', type=str, \
                     choices=['off', 'info', 'pedantic'], help='verbose mode selection')
 
@@ -1111,6 +2983,41 @@ mcs_group.add_argument('-3', '--threed', default=False, action='store_true', \
                        help='Use the input 3D coordinates to guide the preferred MCS mappings')
 mcs_group.add_argument('-x', '--max3d', default=1000, type=float, \
                        help='The MCS is trimmed to remove atoms which are further apart than this distance')
+mcs_group.add_argument('--score-cache', type=str, default='', \
+                       help='Specify a file used to cache the pair scores and MCS maps between runs. Molecule pairs '
+                       'already scored with the same MCS settings are read from the cache instead of being recomputed. '
+                       'The file can be shared by concurrent runs on the same filesystem')
+mcs_group.add_argument('--score-cache-size', default=1000000, action=CheckPos, type=int, \
+                       help='The maximum number of molecule pairs kept in the score cache. The least recently used '
+                       'pairs are evicted first')
+mcs_group.add_argument('--fp-cutoff', default=0.0, action=CheckCutoff, type=float, \
+                       help='Skip the MCS of the molecule pairs whose skeleton fingerprint Tanimoto similarity is below '
+                       'this value, giving them a score of 0. A value of 0.3 typically keeps all the pairs scoring above the '
+                       'default cutoff. '
+                       'The default of 0.0 disables the prefilter')
+mcs_group.add_argument('--prune-cutoff', default=0.0, action=CheckCutoff, type=float, \
+                       help='Skip the MCS of the molecule pairs whose score cannot reach this value, giving them a '
+                       'score of 0. The pairs are pruned with an upper bound of the score computed from the atom '
+                       'counts, so setting it to the graph cutoff does not change the resulting graph. The default of '
+                       '0.0 disables the pruning')
+mcs_group.add_argument('--sparse', default=False, action='store_true', \
+                       help='Store only the non zero similarity scores. This saves most of the memory of the score '
+                       'matrices for large molecule sets, where most of the molecule pairs have a score of 0')
+mcs_group.add_argument('--sparse-floor', default=0.0, action=CheckCutoff, type=float, \
+                       help='In sparse mode, the similarity scores not greater than this value are not stored and '
+                       'are read as 0. The default of 0.0 only drops the zero scores')
+mcs_group.add_argument('--matrix-dir', type=str, default='', \
+                       help='Store the similarity score matrices as memory mapped files in this directory, rather '
+                       'than in memory. The scoring processes write the scores directly into the files, and matrices '
+                       'larger than the memory can be built. The files can be opened later with SMatrix.memmap')
+mcs_group.add_argument('--score-precision', default='float64', type=str, choices=['float32', 'float64'], \
+                       help='The floating point type of the similarity scores held in memory. The scores are stored '
+                       'once per molecule pair, with float32 taking half the memory of float64. Close scores can '
+                       'become equal in float32, which changes the order the edges are removed in and the graph')
+mcs_group.add_argument('-I', '--incremental', type=str, default='', \
+                       help='Specify the .pickle file written by a previous run. The molecules of the directory which '
+                       'are not part of that run are appended to it, and only their pairs are scored. The links and '
+                       'known actives of the previous run are kept')
 
 out_group = parser.add_argument_group('Output setting')
 out_group.add_argument('-o', '--output', default=True, action='store_true', \
@@ -1121,6 +3028,9 @@ out_group.add_argument('--output-no-images', default=False, action='store_true',
                        help='Disable the generation on the image files, removed the dependency on Pillow')
 out_group.add_argument('--output-no-graph', default=False, action='store_true', \
                        help='Disable the generation on the graph (.dot) file, removed the dependency on pygraphviz')
+out_group.add_argument('--score-report-top', default=0, action=CheckNonNeg, type=int, \
+                       help='List only the graph edges and this number of best scored partners of each molecule in '
+                       'the _score_with_connection.txt report. The default of 0 lists all the molecule pairs')
 
 parser.add_argument('-d', '--display', default=False, action='store_true', \
                     help='Display the generated graph by using Matplotlib')
@@ -1150,6 +3060,24 @@ graph_group.add_argument('-l', '--links-file', type=str, default='', \
 graph_group.add_argument('-k', '--known-actives-file', type=str, default='', \
                           help='Specify a filename listing the molecule files that should be initialised as "known actives", one per line')
 
+
+# Command line user interface of lomap prepare
+# ----------------------------------------------------------------
+prepare_parser = argparse.ArgumentParser(description='Read and validate the molecules once, and write them with the '
+                                                     'per-molecule data used by the scoring to a molecule database. '
+                                                     'The database is passed to lomap instead of the mol2/sdf files',
+                                         prog='lomap prepare')
+prepare_parser.add_argument('directory', nargs='+', action=CheckDir, \
+                            help='The mol2/sdf file directories, files or glob patterns')
+prepare_parser.add_argument('-o', '--output', dest='database', required=True, type=str, \
+                            help='The molecule database file name')
+prepare_parser.add_argument('-p', '--parallel', default=1, action=CheckPos, type=int, \
+                            help='The number of processes parsing the molecules')
+prepare_parser.add_argument('-v', '--verbose', default='info', type=str, \
+                            choices=['off', 'info', 'pedantic'], help='verbose mode selection')
+prepare_parser.add_argument('--known-actives-file', type=str, default='', \
+                            help='File of the known active molecules, which are flagged as active in the database')
+
 # ------------------------------------------------------------------
 
 
@@ -45,10 +45,11 @@ potential ligands within a substantial of compounds.
 from rdkit import Chem
 from rdkit.Chem import rdFMCS
 from rdkit.Chem import AllChem
+from rdkit.Chem import rdFingerprintGenerator
 from rdkit.Chem.Draw.MolDrawing import DrawingOptions
 from rdkit.Chem import Draw
 from rdkit import DataStructs
-from rdkit.Chem.Fingerprints import FingerprintMols
+import numpy as np
 import sys
 import math
 from rdkit import RDLogger
@@ -60,7 +61,70 @@ import argparse
 # *******************************
 
 
-__all__ = ['FIGUREPRINT']
+__all__ = ['Figureprint', 'skeleton_fingerprint', 'bulk_tanimoto']
+
+
+# Path fingerprint generator used by the MCS prefilter
+_skeleton_fp_generator = rdFingerprintGenerator.GetRDKitFPGenerator(maxPath=5, fpSize=2048)
+
+
+def skeleton_fingerprint(mol):
+    """
+    This function computes a path fingerprint of the molecular skeleton. The
+    Lomap MCS compares any atom and bond types, but only matches ring atoms to
+    ring atoms, so the fingerprint is computed on the heavy atom graph with
+    the atoms labelled only as ring or chain atoms and all single bonds. Its
+    Tanimoto similarity is used as a cheap estimate of the MCS overlap
+
+    Parameters
+    ----------
+    mol : RDKit molecule object
+        the molecule
+
+    Returns
+    -------
+    fp : RDKit ExplicitBitVect
+        the skeleton fingerprint
+
+    """
+
+    mol_noh = Chem.RemoveHs(mol, sanitize=False)
+    Chem.FastFindRings(mol_noh)
+    ring_info = mol_noh.GetRingInfo()
+
+    skeleton = Chem.RWMol()
+    for at in mol_noh.GetAtoms():
+        skeleton.AddAtom(Chem.Atom(6 if ring_info.NumAtomRings(at.GetIdx()) else 7))
+    for bd in mol_noh.GetBonds():
+        skeleton.AddBond(bd.GetBeginAtomIdx(), bd.GetEndAtomIdx(), Chem.BondType.SINGLE)
+
+    skeleton = skeleton.GetMol()
+    skeleton.UpdatePropertyCache(strict=False)
+    Chem.FastFindRings(skeleton)
+
+    return _skeleton_fp_generator.GetFingerprint(skeleton)
+
+
+def bulk_tanimoto(fp, fps):
+    """
+    This function computes the Tanimoto similarities between a fingerprint
+    and a list of fingerprints
+
+    Parameters
+    ----------
+    fp : RDKit ExplicitBitVect
+        the query fingerprint
+    fps : list of RDKit ExplicitBitVect
+        the fingerprints to compare with
+
+    Returns
+    -------
+    sim : numpy array
+        the Tanimoto similarities
+
+    """
+
+    return np.array(DataStructs.BulkTanimotoSimilarity(fp, fps), dtype=float)
 
 
 class Figureprint(object):
@@ -71,7 +135,7 @@ class Figureprint(object):
     
     """
 
-    def __init__(self, moli, molj):
+    def __init__(self, moli, molj, options=argparse.Namespace(verbose='info')):
         """
         Inizialization function
     
@@ -98,6 +162,9 @@ class Figureprint(object):
             lg = RDLogger.logger()
             lg.setLevel(RDLogger.CRITICAL)
 
+        # Imported here, as the module is deprecated
+        from rdkit.Chem.Fingerprints import FingerprintMols
+
         self.fps_moli = FingerprintMols.FingerprintMol(self.moli)
         self.fps_molj = FingerprintMols.FingerprintMol(self.molj)
         self.fps_tan = DataStructs.FingerprintSimilarity(self.fps_moli, self.fps_molj)
@@ -62,6 +62,400 @@ import traceback
 __all__ = ['GraphGen']
 
 
+class DistanceMatrix(object):
+    """
+    This class holds the shortest path lengths between all the nodes of a
+    connected graph. Removing an edge only changes the distances from the
+    nodes which have the edge on one of their shortest path trees, so only
+    these rows are recomputed when an edge removal is checked. The lengths
+    are stored in the smallest integer type holding the number of nodes
+
+    """
+
+    def __init__(self, graph):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        graph : NetworkX graph obj
+            the connected graph, which is then modified by the caller
+
+        """
+
+        self.graph = graph
+        self.nodes = list(graph.nodes())
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+
+        n = len(self.nodes)
+
+        # The lengths are at most n, which also marks the unreachable nodes. The
+        # type is signed, as the eccentricities are negated to sort them
+        self.dtype = np.min_scalar_type(-(n + 1))
+        self.dist = np.zeros((n, n), dtype=self.dtype)
+        for node, lengths in nx.all_pairs_shortest_path_length(graph):
+            row = self.dist[self.index[node]]
+            row[:] = n
+            row[[self.index[k] for k in lengths]] = list(lengths.values())
+
+        # Eccentricity of each node
+        self.ecc = self.dist.max(axis=1) if n else np.zeros(0, dtype=self.dtype)
+
+        # Rows recomputed by the last check, applied by commit()
+        self.__pending = None
+
+    def check_removed_edge(self, u, v, max_distance):
+        """
+        This function checks that all the nodes are still within max_distance
+        edges of each other once the edge u-v has been removed from the graph.
+        The check stops at the first node found out of range
+
+        Parameters
+        ----------
+        u, v : graph nodes
+            the nodes of the edge, already removed from the graph
+        max_distance : int
+            the maximum path length between two nodes
+
+        Returns
+        -------
+        node : graph node or None
+            a node with another node out of range, None if there is none
+
+        """
+
+        self.__pending = None
+
+        # Removing an edge never shortens a path
+        if len(self.ecc) and self.ecc.max() > max_distance:
+            return self.nodes[int(np.argmax(self.ecc))]
+
+        iu, iv = self.index[u], self.index[v]
+
+        # The distances from s only change if u-v lies on a shortest path from s,
+        # i.e. if u and v are not at the same distance from s. The sources with the
+        # largest eccentricity are checked first, as they are the most likely to fail
+        affected = np.flatnonzero(self.dist[:, iu] != self.dist[:, iv])
+        affected = affected[np.argsort(-self.ecc[affected], kind='stable')]
+
+        rows = {}
+        for i in affected:
+            lengths = nx.single_source_shortest_path_length(self.graph, self.nodes[i], cutoff=max_distance)
+            if len(lengths) < len(self.nodes):
+                return self.nodes[i]
+            row = np.empty(len(self.nodes), dtype=self.dtype)
+            row[[self.index[k] for k in lengths]] = list(lengths.values())
+            rows[int(i)] = row
+
+        self.__pending = (u, v, rows)
+
+        return None
+
+    def commit(self, u, v):
+        """
+        This function updates the distances once the removal of the edge u-v,
+        checked by check_removed_edge(), has been accepted
+        """
+
+        if self.__pending is None or self.__pending[:2] != (u, v):
+            raise ValueError('The removal of the edge %s-%s has not been checked' % (u, v))
+
+        for i, row in self.__pending[2].items():
+            self.dist[i, :] = row
+            self.dist[:, i] = row
+
+        self.ecc = self.dist.max(axis=1)
+        self.__pending = None
+
+
+def component_labels(n, i, j):
+    """
+    This function finds the connected components of a graph given as arrays
+    of edges. The component of each node is hooked to the smaller one across
+    the edges, and the labels are then compressed, until all the edges are
+    inside components
+
+    Parameters
+    ----------
+    n : int
+        the number of nodes, numbered from 0
+    i, j : numpy arrays
+        the nodes of the edges
+
+    Returns
+    -------
+    labels : numpy array
+        the smallest node of the component of each node
+
+    """
+
+    labels = np.arange(n)
+
+    while True:
+        low = np.minimum(labels[i], labels[j])
+        np.minimum.at(labels, labels[i], low)
+        np.minimum.at(labels, labels[j], low)
+
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+        if np.array_equal(labels[i], labels[j]):
+            return labels
+
+
+def active_distances(graph, cutoff):
+    """
+    This function computes the distance of the nodes to their closest active
+    node, by a breadth first search started from all the active nodes at once
+
+    Parameters
+    ----------
+    graph : NetworkX graph obj
+        the graph, whose nodes have the "active" attribute
+    cutoff : int
+        the search stops at this distance
+
+    Returns
+    -------
+    lengths : dict
+        the distances of the nodes within cutoff edges of an active node
+
+    """
+
+    frontier = [node for node, active in graph.nodes(data='active') if active]
+    lengths = dict.fromkeys(frontier, 0)
+
+    for level in range(1, cutoff + 1):
+        next_frontier = []
+        for a in frontier:
+            for b in graph.neighbors(a):
+                if b not in lengths:
+                    lengths[b] = level
+                    next_frontier.append(b)
+        frontier = next_frontier
+
+    return lengths
+
+
+class ActiveDistances(object):
+    """
+    This class holds the distances of the nodes of a graph to their closest
+    active node, up to a cutoff. Removing an edge only lengthens the distances
+    of the nodes whose all shortest paths to the actives go through the edge,
+    so only these nodes are searched again when an edge removal is checked
+
+    """
+
+    def __init__(self, graph, cutoff):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        graph : NetworkX graph obj
+            the graph, which is then modified by the caller
+        cutoff : int
+            the maximum distance of a node from an active node
+
+        """
+
+        self.graph = graph
+        self.cutoff = cutoff
+        self.lengths = active_distances(graph, cutoff)
+        self.failures = graph.number_of_nodes() - len(self.lengths)
+
+        # Distances changed by the last check, applied by commit()
+        self.__pending = None
+
+    def check_removed_edge(self, u, v):
+        """
+        This function counts the nodes out of range of the actives once the
+        edge u-v has been removed from the graph
+
+        Parameters
+        ----------
+        u, v : graph nodes
+            the nodes of the edge, already removed from the graph
+
+        Returns
+        -------
+        failures : int
+            the number of nodes farther than cutoff edges from any active node
+
+        """
+
+        lengths = self.lengths
+        far = self.cutoff + 1
+        du, dv = lengths.get(u, far), lengths.get(v, far)
+
+        self.__pending = (u, v, {}, self.failures)
+
+        # The edge only lies on a shortest path to the actives if the distances of
+        # its nodes differ, and v then only moves away if u was its last neighbour
+        # one step closer
+        if du > dv:
+            u, v, du, dv = v, u, dv, du
+        if du == dv or dv == far or any(lengths.get(c, far) == dv - 1 for c in self.graph.neighbors(v)):
+            return self.failures
+
+        # The nodes which lose all their neighbours one step closer to the actives.
+        # They are found level by level, so that all the lost nodes of a level are
+        # known before the next one is checked
+        lost = {v}
+        frontier = [v]
+        while frontier:
+            next_frontier = []
+            for a in frontier:
+                for b in self.graph.neighbors(a):
+                    db = lengths.get(b, far)
+                    if db != lengths[a] + 1 or db == far or b in lost:
+                        continue
+                    if all(c in lost or lengths.get(c, far) != db - 1 for c in self.graph.neighbors(b)):
+                        lost.add(b)
+                        next_frontier.append(b)
+            frontier = next_frontier
+
+
+        # The lost nodes are reached again from their neighbours, in order of distance
+        buckets = [[] for _ in range(far + 1)]
+        changed = {}
+        for a in lost:
+            d = min([lengths.get(c, far) + 1 for c in self.graph.neighbors(a) if c not in lost] + [far])
+            changed[a] = d
+            buckets[d].append(a)
+
+        for d in range(far):
+            for a in buckets[d]:
+                if changed[a] != d:
+                    continue
+                for b in self.graph.neighbors(a):
+                    if b in changed and changed[b] > d + 1:
+                        changed[b] = d + 1
+                        buckets[d + 1].append(b)
+
+        failures = self.failures + sum(1 for d in changed.values() if d == far)
+        self.__pending = (u, v, changed, failures)
+
+        return failures
+
+    def commit(self, u, v):
+        """
+        This function updates the distances once the removal of the edge u-v,
+        checked by check_removed_edge(), has been accepted
+        """
+
+        if self.__pending is None or set(self.__pending[:2]) != {u, v}:
+            raise ValueError('The removal of the edge %s-%s has not been checked' % (u, v))
+
+        for node, d in self.__pending[2].items():
+            if d > self.cutoff:
+                self.lengths.pop(node, None)
+            else:
+                self.lengths[node] = d
+
+        self.failures = self.__pending[3]
+        self.__pending = None
+
+
+def nodes_connected(graph, u, v):
+    """
+    This function checks whether two nodes are connected. The search is
+    bidirectional: the smaller of the frontiers grown from u and from v is
+    expanded, until they meet or one of them is exhausted
+
+    Parameters
+    ----------
+    graph : NetworkX graph obj
+        the graph
+    u, v : graph nodes
+        the nodes to check
+
+    Returns
+    -------
+    connected : bool
+        True if there is a path between u and v
+
+    """
+
+    if u == v:
+        return True
+
+    seen_u, seen_v = {u}, {v}
+    frontier_u, frontier_v = [u], [v]
+
+    while frontier_u and frontier_v:
+        if len(frontier_u) > len(frontier_v):
+            frontier_u, frontier_v = frontier_v, frontier_u
+            seen_u, seen_v = seen_v, seen_u
+
+        next_frontier = []
+        for a in frontier_u:
+            for b in graph.neighbors(a):
+                if b in seen_v:
+                    return True
+                if b not in seen_u:
+                    seen_u.add(b)
+                    next_frontier.append(b)
+        frontier_u = next_frontier
+
+    return False
+
+
+def two_edge_connected(graph, u, v):
+    """
+    This function checks whether two nodes are joined by two edge disjoint
+    paths, i.e. whether no single edge removal separates them. Two augmenting
+    paths are searched from u, each search stopping as soon as v is reached,
+    so that the cost only depends on the part of the graph around the nodes
+
+    Parameters
+    ----------
+    graph : NetworkX graph obj
+        the graph
+    u, v : graph nodes
+        the nodes to check
+
+    Returns
+    -------
+    connected : bool
+        True if u and v are joined by two edge disjoint paths
+
+    """
+
+    # Arcs used by the first path. The second path can use an edge in the
+    # opposite direction, which cancels the flow of the first one
+    used = set()
+
+    for _ in range(2):
+        parents = {u: None}
+        frontier = [u]
+        while frontier and v not in parents:
+            next_frontier = []
+            for a in frontier:
+                for b in graph.neighbors(a):
+                    if b not in parents and (a, b) not in used:
+                        parents[b] = a
+                        next_frontier.append(b)
+            frontier = next_frontier
+
+        if v not in parents:
+            return False
+
+        b = v
+        while parents[b] is not None:
+            a = parents[b]
+            if (b, a) in used:
+                used.discard((b, a))
+            else:
+                used.add((a, b))
+            b = a
+
+    return True
+
+
 # *************************
 # Graph Class
 # *************************
@@ -111,6 +505,12 @@ class GraphGen(object):
         # of an active
         self.distanceToActiveFailures = 0
 
+        # The distances between the nodes of the subgraph being minimized
+        self.distances = None
+
+        # The distances of the nodes of the subgraph being minimized to the actives
+        self.activeDistances = None
+
         # Draw Parameters
 
         # THIS PART MUST BE CHANGED
@@ -135,12 +535,6 @@ class GraphGen(object):
         else:
             self.initialSubgraphList = self.generate_initial_subgraph_list()
 
-        # A list of elements made of [edge, weights] for each subgraph
-        self.subgraphScoresLists = self.generate_subgraph_scores_lists(self.initialSubgraphList)
-
-        # Eliminates from each subgraph those edges whose weights are less than the hard limit
-        self.remove_edges_below_hard_limit()
-
         # Make a new master list of subgraphs now that there may be more disconnected components
         self.workingSubgraphsList = self.generate_working_subgraphs_list()
 
@@ -197,9 +591,8 @@ class GraphGen(object):
             # complete radial option. Pick the compound with the highest total similarity to all other compounds to use as a hub
             all_sum_i = []
             for i in range(0, self.dbase.nums()):
-                sum_i = 0
-                for j in range(0, self.dbase.nums()):
-                    sum_i += self.dbase.strict_mtx[i, j]
+                # The row is summed in double precision, whatever the precision of the scores
+                sum_i = self.dbase.strict_mtx.row(i).sum(dtype=np.float64)
                 all_sum_i.append(sum_i)
             max_value = max(all_sum_i)
             max_index = [i for i, x in enumerate(all_sum_i) if x == max_value]
@@ -210,7 +603,11 @@ class GraphGen(object):
 
         """
         This function generates a starting graph connecting with edges all the 
-        compounds with a positive strict similarity score  
+        compounds with a positive strict similarity score. The edges whose
+        similarity is less than the hard limit are left out of the subgraphs, so
+        that the subgraphs may be disconnected. The components are found on the
+        edges taken from the score matrix, and only the edges kept become graph
+        edges
         
         Returns
         -------
@@ -219,43 +616,53 @@ class GraphGen(object):
             the list of connected component graphs     
         
         """
-        compound_graph = nx.Graph()
 
-        if (self.dbase.nums() * (self.dbase.nums() - 1) / 2) != self.dbase.strict_mtx.size:
+        n = self.dbase.nums()
+
+        if (n * (n - 1) / 2) != self.dbase.strict_mtx.size:
             raise ValueError("There are errors in the similarity score matrices")
 
         if not fast_map:
             # if not fast map option, connect all possible nodes to generate the initial graph
-            for i in range(0, self.dbase.nums()):
-                if i == 0:
-                    compound_graph.add_node(i, ID=self.dbase[i].getID(),
-                            fname_comp=os.path.basename(self.dbase[i].getName()),
-                            active=self.dbase[i].isActive())
+            idsOfI, idsOfJ, weights = self.dbase.strict_mtx.pairs_above(0.0)
+        else:
+            # if fast map option, then add all possible radial edges as the initial graph
+            row = self.dbase.strict_mtx.row(self.lead_index)
+            others = np.flatnonzero(row > 0)
+            weights = row[others]
+            idsOfI = np.minimum(others, self.lead_index)
+            idsOfJ = np.maximum(others, self.lead_index)
 
-                for j in range(i + 1, self.dbase.nums()):
+        labels = component_labels(n, idsOfI, idsOfJ)
 
-                    if i == 0:
-                        compound_graph.add_node(j, ID=self.dbase[j].getID(),
-                            fname_comp=os.path.basename(self.dbase[j].getName()),
-                            active=self.dbase[j].isActive())
+        # Eliminates those edges whose weights are less than the hard limit
+        keep = ~(weights < self.similarityScoresLimit)
+        idsOfI, idsOfJ, weights = idsOfI[keep], idsOfJ[keep], weights[keep]
 
-                    wgt = self.dbase.strict_mtx[i, j]
+        # The components come in order of their first node. Their nodes and edges
+        # are added in order, as in the graph of all the nodes
+        components = np.unique(labels)
+        nodesByComponent = np.argsort(labels, kind='stable')
+        edgesByComponent = np.argsort(labels[idsOfI], kind='stable')
+        nodeBounds = np.r_[np.searchsorted(labels[nodesByComponent], components), n]
+        edgeBounds = np.r_[np.searchsorted(labels[idsOfI][edgesByComponent], components), len(idsOfI)]
 
-                    if wgt > 0.0:
-                        compound_graph.add_edge(i, j, similarity=wgt, strict_flag=True)
-        else:
-            # if fast map option, then add all possible radial edges as the initial graph
-            for i in range(0, self.dbase.nums()):
-                # add the node for i
-                compound_graph.add_node(i, ID=self.dbase[i].getID(),
-                                        fname_comp=os.path.basename(self.dbase[i].getName()))
-                if i != self.lead_index:
-                    wgt = self.dbase.strict_mtx[i, self.lead_index]
-                    if wgt > 0:
-                        compound_graph.add_edge(i, self.lead_index, similarity=wgt, strict_flag=True)
+        initialSubgraphList = []
+
+        for c in range(len(components)):
+            subgraph = nx.Graph()
+
+            for i in nodesByComponent[nodeBounds[c]:nodeBounds[c + 1]]:
+                mol = self.dbase[int(i)]
+                attributes = dict(ID=mol.getID(), fname_comp=os.path.basename(mol.getName()))
+                if not fast_map:
+                    attributes['active'] = mol.isActive()
+                subgraph.add_node(int(i), **attributes)
 
-        initialSubgraphGen = [compound_graph.subgraph(c).copy() for c in nx.connected_components(compound_graph)]
-        initialSubgraphList = [x for x in initialSubgraphGen]
+            for k in edgesByComponent[edgeBounds[c]:edgeBounds[c + 1]]:
+                subgraph.add_edge(int(idsOfI[k]), int(idsOfJ[k]), similarity=weights[k], strict_flag=True)
+
+            initialSubgraphList.append(subgraph)
 
         return initialSubgraphList
 
@@ -289,33 +696,6 @@ class GraphGen(object):
 
         return subgraphScoresLists
 
-    def remove_edges_below_hard_limit(self):
-        """
-        
-        This function removes edges below the set hard limit from each subGraph 
-        and from each weightsList
-        
-        """
-
-        totalEdges = 0
-
-        for subgraph in self.initialSubgraphList:
-
-            weightsList = self.subgraphScoresLists[self.initialSubgraphList.index(subgraph)]
-
-            index = 0
-
-            for edge in weightsList:
-
-                if edge[2] < self.similarityScoresLimit:
-                    subgraph.remove_edge(edge[0], edge[1])
-
-                    index = weightsList.index(edge)
-
-            del weightsList[:index + 1]
-
-            totalEdges = totalEdges + subgraph.number_of_edges()
-
     def generate_working_subgraphs_list(self):
         """
         After the deletition of the edges that have a weigth less than the 
@@ -362,6 +742,11 @@ class GraphGen(object):
 
             if len(subgraph.edges()) > 2:  # Graphs must have at least 3 edges to be minimzed
 
+                # The distances are computed once and updated as the edges are removed
+                self.distances = DistanceMatrix(subgraph)
+                if any(active for node, active in subgraph.nodes(data='active')):
+                    self.activeDistances = ActiveDistances(subgraph, self.maxDistFromActive)
+
                 for edge in weightsList:
                     if self.lead_index is not None:
                         # Here the radial option is appplied, will check if the remove_edge is connect to
@@ -369,18 +754,34 @@ class GraphGen(object):
                         # then add it back into the graph.
                         if self.lead_index not in [edge[0], edge[1]]:
                             subgraph.remove_edge(edge[0], edge[1])
-                            if self.check_constraints(subgraph, numberOfComponents) == False:
+                            if self.check_constraints(subgraph, numberOfComponents, edge) == False:
                                 subgraph.add_edge(edge[0], edge[1], similarity=edge[2], strict_flag=True)
+                            else:
+                                self.commit_removed_edge(edge)
                     elif edge[2] < 1.0:  # Don't remove edges with similarity 1
                         logging.info("Trying to remove edge %d-%d with similarity %f" % (edge[0],edge[1],edge[2]))
                         subgraph.remove_edge(edge[0], edge[1])
-                        if self.check_constraints(subgraph, numberOfComponents) == False:
+                        if self.check_constraints(subgraph, numberOfComponents, edge) == False:
                             subgraph.add_edge(edge[0], edge[1], similarity=edge[2], strict_flag=True)
                         else:
+                            self.commit_removed_edge(edge)
                             logging.info("Removed edge %d-%d" % (edge[0],edge[1]))
                     else:
                         logging.info("Skipping edge %d-%d as it has similarity 1" % (edge[0],edge[1]))
 
+                self.distances = None
+                self.activeDistances = None
+
+    def commit_removed_edge(self, edge):
+        """
+        Update the distances held for the subgraph being minimized once the
+        removal of the edge has been accepted
+        """
+
+        self.distances.commit(edge[0], edge[1])
+        if self.activeDistances is not None:
+            self.activeDistances.commit(edge[0], edge[1])
+
     def add_surrounding_edges(self):
         """
         Add surrounding edges in each subgraph to make sure all nodes are in cycle
@@ -393,16 +794,13 @@ class GraphGen(object):
                 self.nonCycleEdgesSet = self.find_non_cyclic_edges(subgraph)
                 for node in self.nonCycleNodesSet:
                     # for each node in the noncyclenodeset, find the similarity compare to all other surrounding nodes and pick the one with the max score and connect them
-                    node_score_list = []
-                    for i in range(0, self.dbase.nums()):
-                        if i != node and i != self.lead_index:
-                            node_score_list.append(self.dbase.strict_mtx[node, i])
-                        else:
-                            node_score_list.append(0.0)
-                    max_value = max(node_score_list)
+                    node_score_list = self.dbase.strict_mtx.row(node)
+                    node_score_list[node] = 0.0
+                    node_score_list[self.lead_index] = 0.0
+                    max_value = node_score_list.max()
                     if max_value > self.similarityScoresLimit:
-                        max_index = [i for i, x in enumerate(node_score_list) if x == max_value]
-                        max_index_final = max_index[0]
+                        # The first of the nodes with the max score
+                        max_index_final = int(np.argmax(node_score_list))
                         subgraph.add_edge(node, max_index_final,
                                           similarity=self.dbase.strict_mtx[node, max_index_final], strict_flag=True)
                 return subgraph
@@ -425,11 +823,13 @@ class GraphGen(object):
 
         missingNodesSet = set()
 
-        cycleNodes = []
-
-        cycleList = nx.cycle_basis(subgraph)
+        # A node is in a cycle if one of its edges is not a bridge
+        bridges = self.find_non_cyclic_edges(subgraph)
 
-        cycleNodes = [node for cycle in cycleList for node in cycle]
+        cycleNodes = set()
+        for u, v in subgraph.edges():
+            if (u, v) not in bridges and (v, u) not in bridges:
+                cycleNodes.update((u, v))
 
         missingNodesSet = set([node for node in subgraph.nodes() if node not in cycleNodes])
 
@@ -456,7 +856,7 @@ class GraphGen(object):
 
         return missingEdgesSet
 
-    def check_constraints(self, subgraph, numComp):
+    def check_constraints(self, subgraph, numComp, edge=None):
         """
         Determine if the given subgraph still meets the constraints
         
@@ -469,6 +869,9 @@ class GraphGen(object):
         numComp : int
             the number of connected componets
 
+        edge : tuple or None
+            the edge just removed from the subgraph, if known
+
         Returns
         -------
         constraintsMet : bool
@@ -477,28 +880,30 @@ class GraphGen(object):
 
         constraintsMet = True
 
-        if not self.remains_connected(subgraph, numComp):
+        if not self.remains_connected(subgraph, numComp, edge):
             constraintsMet = False
 
         # The requirement to keep a cycle covering is now optional
         if constraintsMet and self.requireCycleCovering:
-            if not self.check_cycle_covering(subgraph):
+            if not self.check_cycle_covering(subgraph, edge):
                 constraintsMet = False
 
         if constraintsMet:
-            if not self.check_max_distance(subgraph):
+            if not self.check_max_distance(subgraph, edge):
                 constraintsMet = False
 
         if constraintsMet:
-            if not self.check_distance_to_active(subgraph):
+            if not self.check_distance_to_active(subgraph, edge):
                 constraintsMet = False
 
         return constraintsMet
 
-    def remains_connected(self, subgraph, numComponents):
+    def remains_connected(self, subgraph, numComponents, edge=None):
         """
         Determine if the subgraph remains connected after an edge has been 
-        removed
+        removed. If the removed edge u-v is passed, the subgraph is connected
+        if u and v still are. The bridges of the subgraph before the edge
+        removals stay bridges, so their removal is rejected without a search
         
         Parameters
         ---------
@@ -507,6 +912,9 @@ class GraphGen(object):
         
         numComp : int
             the number of connected componets
+
+        edge : tuple or None
+            the edge just removed from the subgraph, if known
         
         Returns
         -------
@@ -518,26 +926,39 @@ class GraphGen(object):
 
         isConnected = False
 
-        if numComponents == nx.number_connected_components(subgraph): 
+        if edge is not None:
+            u, v = edge[0], edge[1]
+            isConnected = (u, v) not in self.nonCycleEdgesSet and (v, u) not in self.nonCycleEdgesSet \
+                and nodes_connected(subgraph, u, v)
+        elif numComponents == nx.number_connected_components(subgraph): 
             isConnected = True
-        else:
+
+        if not isConnected:
             logging.info("Rejecting edge deletion on graph connectivity")
 
         return isConnected
 
-    def check_cycle_covering(self, subgraph):
+    def check_cycle_covering(self, subgraph, edge=None):
         """
         Checks if the subgraph has a cycle covering. Note that this has been extended from
         the original algorithm: we not only care if the number of acyclic nodes has
         increased, but we also care if the number of acyclic edges (bridges) has increased.
         Note that if the number of acyclic edges hasn't increased, then the number of
         acyclic nodes hasn't either, so that test is included in the edges test.
+
+        If the removed edge u-v is passed, the check is local: removing an edge
+        which is not a bridge only creates new bridges on the paths between u
+        and v, so none is created if u and v are still joined by two edge
+        disjoint paths
         
         Parameters
         ---------
         subgraph : NetworkX subgraph obj
             the subgraph to check for connection after the edge deletion
 
+        edge : tuple or None
+            the edge just removed from the subgraph, if known
+
         Returns
         -------
         hasCovering : bool
@@ -548,22 +969,31 @@ class GraphGen(object):
         hasCovering = True
 
         # Have we increased the number of non-cyclic edges?
-        if self.find_non_cyclic_edges(subgraph).difference(self.nonCycleEdgesSet): 
+        if edge is not None:
+            if not two_edge_connected(subgraph, edge[0], edge[1]):
+                hasCovering = False
+                logging.info("Rejecting edge deletion on cycle covering")
+        elif self.find_non_cyclic_edges(subgraph).difference(self.nonCycleEdgesSet): 
             hasCovering = False
             logging.info("Rejecting edge deletion on cycle covering")
 
         return hasCovering
 
-    def check_max_distance(self, subgraph):
+    def check_max_distance(self, subgraph, edge=None):
         """
         Check to see if the graph has paths from all compounds to all other 
-        compounds within the specified limit
+        compounds within the specified limit. If the removed edge is passed
+        while the subgraph distances are held, only the distances changed by
+        the removal are computed. The check stops at the first failure
 
         Parameters
         ---------
         subgraph : NetworkX subgraph obj
             the subgraph to check for the max distance between nodes
 
+        edge : tuple or None
+            the edge just removed from the subgraph, if known
+
         Returns
         -------
         withinMaxDistance : bool
@@ -573,11 +1003,20 @@ class GraphGen(object):
 
         withinMaxDistance = True
 
+        if edge is not None and self.distances is not None and self.distances.graph is subgraph:
+            node = self.distances.check_removed_edge(edge[0], edge[1], self.maxPathLength)
+            if node is not None:
+                withinMaxDistance = False
+                logging.info("Rejecting edge deletion on graph diameter for node %d" % (node))
+            return withinMaxDistance
+
         for node in subgraph:
-            eccentricity = nx.eccentricity(subgraph, node)
-            if eccentricity > self.maxPathLength: 
+            # Breadth first search up to the limit, which misses the nodes out of range
+            lengths = nx.single_source_shortest_path_length(subgraph, node, cutoff=self.maxPathLength)
+            if len(lengths) < subgraph.number_of_nodes():
                 withinMaxDistance = False
                 logging.info("Rejecting edge deletion on graph diameter for node %d" % (node))
+                break
 
         return withinMaxDistance
 
@@ -597,8 +1036,6 @@ class GraphGen(object):
             Number of nodes that are not within the max distance to any active node
         """
 
-        failures = 0
-
         hasActives=False
         for node in subgraph.nodes():
             if (subgraph.nodes[node]["active"]):
@@ -606,35 +1043,35 @@ class GraphGen(object):
         if (not hasActives):
             return 0     # No actives, so don't bother checking
 
-        paths = nx.shortest_path(subgraph)
-        for node in subgraph.nodes():
-            if (not subgraph.nodes[node]["active"]):
-                ok=False
-                for node2 in subgraph.nodes():
-                    if (subgraph.nodes[node2]["active"]):
-                        pathlen = len(paths[node][node2]) - 1   # No. edges is 1 less than no. nodes
-                        if (pathlen <= self.maxDistFromActive): ok=True
-                if (not ok): 
-                    failures = failures + 1
+        # One search from all the actives, up to the limit, which misses the nodes out of range
+        failures = subgraph.number_of_nodes() - len(active_distances(subgraph, self.maxDistFromActive))
 
         return failures
 
-    def check_distance_to_active(self, subgraph):
+    def check_distance_to_active(self, subgraph, edge=None):
         """
-        Check to see if we have increased the number of distance-to-active failures
+        Check to see if we have increased the number of distance-to-active failures.
+        If the removed edge is passed while the distances to the actives are
+        held, only the distances changed by the removal are computed
 
         Parameters
         ---------
         subgraph : NetworkX subgraph obj
             the subgraph to check for the max distance between nodes
 
+        edge : tuple or None
+            the edge just removed from the subgraph, if known
+
         Returns
         -------
         ok : bool
             True if we have not increased the number of failed nodes
         """
 
-        count = self.count_distance_to_active_failures(subgraph)
+        if edge is not None and self.activeDistances is not None and self.activeDistances.graph is subgraph:
+            count = self.activeDistances.check_removed_edge(edge[0], edge[1])
+        else:
+            count = self.count_distance_to_active_failures(subgraph)
         failed =  (count > self.distanceToActiveFailures)
         if (failed): logging.info("Rejecting edge deletion on distance-to-actives %d vs %d" % (count,self.distanceToActiveFailures))
         logging.info("Checking edge deletion on distance-to-actives %d vs %d" % (count,self.distanceToActiveFailures))
@@ -668,18 +1105,90 @@ class GraphGen(object):
         
         """
 
-        connectSuccess = self.connect_graph_components_brute_force()
-
-        while connectSuccess:
-            connectSuccess = self.connect_graph_components_brute_force()
+        self.connect_graph_components_brute_force()
 
         # WARNING: The self.workingSubgraphsList at this point is different from
         # the copy self.resultingSubgraphsList made before
 
-        connectSuccess = self.connect_graph_components_brute_force_2()
+        self.connect_graph_components_brute_force_2()
+
+    def join_components(self, subgraphsList, excluded=frozenset()):
+        """
+        Selects the edges joining the passed components, by decreasing loose
+        similarity and skipping those between components already joined, as in
+        Kruskal's algorithm. The candidate edges are taken from the loose matrix
+        at once. Equal similarities are taken in component and then node order
+
+        Parameters
+        ----------
+        subgraphsList : list of NetworkX graph obj
+            the components to join
+
+        excluded : set of tuples
+            the (ID, ID) edges which are skipped, in both orientations
 
-        while connectSuccess:
-            connectSuccess = self.connect_graph_components_brute_force_2()
+        Returns
+        -------
+        edges : list of tuples
+            the (ID, ID, similarity) edges, in the order they are selected. Each
+            edge goes from the component which comes first, where a joined
+            component comes at the place of its first component
+
+        """
+
+        # Component of each molecule and position of the molecule in it
+        component = np.full(self.dbase.nums(), -1, dtype=int)
+        position = np.zeros(self.dbase.nums(), dtype=int)
+        for c, subgraph in enumerate(subgraphsList):
+            ids = [ID for node, ID in subgraph.nodes(data='ID')]
+            component[ids] = c
+            position[ids] = np.arange(len(ids))
+
+        idsOfI, idsOfJ, similarities = self.dbase.loose_mtx.pairs_above(0.0)
+        compOfI, compOfJ = component[idsOfI], component[idsOfJ]
+        between = (compOfI >= 0) & (compOfJ >= 0) & (compOfI != compOfJ)
+        idsOfI, idsOfJ, similarities = idsOfI[between], idsOfJ[between], similarities[between]
+        compOfI, compOfJ = compOfI[between], compOfJ[between]
+
+        swap = compOfI > compOfJ
+        idsOfI, idsOfJ = np.where(swap, idsOfJ, idsOfI), np.where(swap, idsOfI, idsOfJ)
+        compOfI, compOfJ = np.minimum(compOfI, compOfJ), np.maximum(compOfI, compOfJ)
+        order = np.lexsort((position[idsOfJ], position[idsOfI], compOfJ, compOfI, -similarities))
+
+        # Only the best edges of each pair of components can be selected. The
+        # second best is kept, in case the best one is excluded, as the edges
+        # excluded are at most one per pair of components
+        pairs = (compOfI * len(subgraphsList) + compOfJ)[order]
+        byPair = np.argsort(pairs, kind='stable')
+        pairStarts = np.flatnonzero(np.r_[True, pairs[byPair][1:] != pairs[byPair][:-1]])
+        rank = np.arange(len(byPair)) - np.repeat(pairStarts, np.diff(np.r_[pairStarts, len(byPair)]))
+        order = order[np.sort(byPair[rank < 2])]
+
+        # The components joined so far and the first component of each, which
+        # gives the order of the joined components
+        components = nx.utils.UnionFind()
+        first = {}
+        edges = []
+
+        for k in order:
+            if len(edges) == len(subgraphsList) - 1:
+                break
+            rootOfI, rootOfJ = components[compOfI[k]], components[compOfJ[k]]
+            if rootOfI == rootOfJ:
+                continue
+            firstOfI, firstOfJ = first.get(rootOfI, rootOfI), first.get(rootOfJ, rootOfJ)
+
+            edge = (int(idsOfI[k]), int(idsOfJ[k]), similarities[k])
+            if firstOfI > firstOfJ:
+                edge = (edge[1], edge[0], edge[2])
+            if edge[:2] in excluded:
+                continue
+
+            components.union(rootOfI, rootOfJ)
+            first[components[rootOfI]] = min(firstOfI, firstOfJ)
+            edges.append(edge)
+
+        return edges
 
     def connect_graph_components_brute_force(self):
         """
@@ -694,65 +1203,29 @@ class GraphGen(object):
 
         """
 
-        generator_graph = [self.resultGraph.subgraph(c).copy() for c in nx.connected_components(self.resultGraph)]
-
-        self.workingSubgraphsList = [x for x in generator_graph]
+        self.workingSubgraphsList = [self.resultGraph.subgraph(c).copy() for c in nx.connected_components(self.resultGraph)]
 
         if len(self.workingSubgraphsList) == 1:
             return False
 
-        edgesToCheck = []
-        edgesToCheckAdditionalInfo = []
-        numzeros = 0
-
-        for i in range(0, len(self.workingSubgraphsList)):
-
-            nodesOfI = self.workingSubgraphsList[i].nodes()
-
-            for j in range(i + 1, len(self.workingSubgraphsList)):
-                nodesOfJ = self.workingSubgraphsList[j].nodes()
-
-                # change the following lines to be compatible with networkx 2.0
-                for k in nodesOfI.keys():
-
-                    for l in nodesOfJ.keys():
-                        # produce an edge from nodesOfI[k] and nodesofJ[l] if nonzero weights push
-                        # this edge into possibleEdgeList """
-
-                        # print 'Molecules (%d,%d)' % (nodesOfI[k],nodesOfJ[l])
-                        # I assumed that the score matrix is symmetric. In the Graph part this
-                        # does not seems to be true:
-
-                        similarity = self.dbase.loose_mtx[nodesOfI[k]["ID"], nodesOfJ[l]["ID"]]
-
-                        if similarity > 0.0:
-                            edgesToCheck.append((nodesOfI[k]["ID"], nodesOfJ[l]["ID"], similarity))
-                            edgesToCheckAdditionalInfo.append((nodesOfI[k]["ID"], nodesOfJ[l]["ID"], similarity, i, j))
-                        else:
-                            numzeros = numzeros + 1
+        edgesToAdd = self.join_components(self.workingSubgraphsList)
 
-        if len(edgesToCheck) > 0:
-
-            sortedList = sorted(edgesToCheck, key=itemgetter(2), reverse=True)
-            sortedListAdditionalInfo = sorted(edgesToCheckAdditionalInfo, key=itemgetter(2), reverse=True)
-            edgeToAdd = sortedList[0]
-            # self.edgeFile.write("\n" + str(edgeToAdd))
-            edgeToAddAdditionalInfo = sortedListAdditionalInfo[0]
+        for edgeToAdd in edgesToAdd:
             self.edgesAddedInFirstTreePass.append(edgeToAdd)
             self.resultGraph.add_edge(edgeToAdd[0], edgeToAdd[1], similarity=edgeToAdd[2], strict_flag=False)
 
+        if edgesToAdd:
             generator_graph = [self.resultGraph.subgraph(c).copy() for c in nx.connected_components(self.resultGraph)]
             self.workingSubgraphsList = [x for x in generator_graph]
 
-            return True
-
-        else:
-            return False
+        return len(edgesToAdd) > 0
 
     def connect_graph_components_brute_force_2(self):
         """
         Adds a second edge between each of the (former) components of the
-        resultGraph to try to provide cycles between (former) components
+        resultGraph to try to provide cycles between (former) components. The
+        former components are joined as in the first pass, skipping the edges
+        it added
         
         Returns
         -------
@@ -764,48 +1237,19 @@ class GraphGen(object):
         if len(self.resultingSubgraphsList) == 1:
             return False
 
-        edgesToCheck = []
-
-        for i in range(0, len(self.resultingSubgraphsList)):
-
-            nodesOfI = self.resultingSubgraphsList[i].nodes()
-
-            for j in range(i + 1, len(self.resultingSubgraphsList)):
-
-                nodesOfJ = self.resultingSubgraphsList[j].nodes()
-
-                for k in nodesOfI.keys():
-
-                    for l in nodesOfJ.keys():
-
-                        # produce an edge from nodesOfI[k] and nodesofJ[l] if
-                        # nonzero weights push this edge into possibleEdgeList """
-
-                        # print 'Molecules (%d,%d)' % (nodesOfI[k],nodesOfJ[l])
-                        # I assumed that the score matrix is symmetric. In the Graph part
-                        # this does not seems to be true: <<<<<<<<<<<<<DEBUG>>>>>>>>>>>>>>>
-                        similarity = self.dbase.loose_mtx[nodesOfI[k]["ID"], nodesOfJ[l]["ID"]]
-
-                        if similarity > 0.0:
-                            edgesToCheck.append((nodesOfI[k]["ID"], nodesOfJ[l]["ID"], similarity))
-
-        finalEdgesToCheck = [edge for edge in edgesToCheck if edge not in self.edgesAddedInFirstTreePass]
-
-        if len(finalEdgesToCheck) > 0:
-
-            sortedList = sorted(finalEdgesToCheck, key=itemgetter(2), reverse=True)
-            edgeToAdd = sortedList[0]
+        excluded = {edge[:2] for edge in self.edgesAddedInFirstTreePass}
+        excluded |= {(edge[1], edge[0]) for edge in excluded}
+        edgesToAdd = self.join_components(self.resultingSubgraphsList, excluded)
 
+        for edgeToAdd in edgesToAdd:
             self.resultGraph.add_edge(edgeToAdd[0], edgeToAdd[1], similarity=edgeToAdd[2], strict_flag=False)
             self.copyResultGraph.add_edge(edgeToAdd[0], edgeToAdd[1], similarity=edgeToAdd[2], strict_flag=False)
 
+        if edgesToAdd:
             generator_graph = [self.copyResultGraph.subgraph(c).copy() for c in nx.connected_components(self.copyResultGraph)]
             self.resultingSubgraphsList = [x for x in generator_graph]
 
-            return True
-
-        else:
-            return False
+        return len(edgesToAdd) > 0
 
     def get_graph(self):
         """
@@ -847,7 +1291,7 @@ class GraphGen(object):
             for n in temp_graph:
 
                 id_mol = temp_graph.nodes[n]['ID']
-                mol = self.dbase[id_mol].getMolecule()
+                mol = self.dbase[id_mol].getMolecule(copy=False)
                 max_dist = max_dist_mol(mol)
 
                 if max_dist < self.max_mol_size:
@@ -905,65 +1349,114 @@ class GraphGen(object):
 
     # The function to output the score and connectivity txt file
 
+    def report_partners(self, i):
+        """
+        Returns the molecules listed with the molecule i in the score report,
+        after it. Unless the report is limited to the best scored partners of
+        each molecule, all the following molecules are listed
+
+        Parameters
+        ----------
+        i : int
+            the molecule ID
+
+        Returns
+        -------
+        partners : iterable of int
+            the IDs of the partners j > i, in increasing order
+
+        """
+
+        n = len(self.dbase.dic_mapping)
+
+        if not self.reportTop:
+            return range(i + 1, n)
+
+        partners = {j for j in self.resultGraph.neighbors(i) if j > i} if i in self.resultGraph else set()
+        partners.update(j for j in self.reportTop.get(i, ()) if j > i)
+        partners.update(self.reportTopOf.get(i, ()))
+
+        return sorted(partners)
+
     def layout_info(self):
+        """
+        Writes the score report, listing the scores of the molecule pairs and
+        whether they are linked in the final graph. The lines are streamed to
+        the file one molecule at a time. If the score_report_top option is set,
+        only the graph edges and the best scored partners of each molecule are
+        listed. For radial graphs, the morph pairs are also written
+
+        """
+
         # pass the lead compound index if the radial option is on and generate the
         # morph type of output required by FESetup
         if self.lead_index is not None:
             morph_txt = open(self.dbase.options.name + "_morph.txt", "w")
-            morph_data = "morph_pairs = "
+            morph_data = ["morph_pairs = "]
+
+        n = len(self.dbase.dic_mapping)
+
+        # The best scored partners of each molecule, and the molecules listing each one
+        # among their best partners
+        top = self.dbase.options.score_report_top
+        self.reportTop = {}
+        self.reportTopOf = {}
+        if top:
+            for i in range(n):
+                cols, values = self.dbase.strict_mtx.top_k(i, top)
+                self.reportTop[i] = [int(j) for j in cols[values > 0.0]]
+                for j in self.reportTop[i]:
+                    if j < i:
+                        self.reportTopOf.setdefault(j, set()).add(i)
+
         with open(self.dbase.options.name + "_score_with_connection.txt", "w") as info_txt:
-            all_key_id = self.dbase.dic_mapping.keys()
-            data = ["%-10s,%-10s,%-25s,%-25s,%-15s,%-15s,%-15s,%-10s\n" % (
-            "Index_1", "Index_2", "Filename_1", "Filename_2", "Str_sim", "Eff_sim", "Loose_sim", "Connect")]
-            for i in range(len(all_key_id) - 1):
-                for j in range(i + 1, len(all_key_id)):
-                    morph_string = None
-                    connected = False
-                    similarity=0
-                    try:
-                        edgedata=[d for (u,v,d) in self.resultGraph.edges(data=True) if ((u==i and v==j) or (u==j and v==i))]
-                        similarity = edgedata[0]['similarity']
-                        connected = True
-                    except IndexError:
-                        pass
-                    Filename_i = self.dbase.dic_mapping[i]
+            info_txt.write("%-10s,%-10s,%-25s,%-25s,%-15s,%-15s,%-15s,%-10s\n" % (
+            "Index_1", "Index_2", "Filename_1", "Filename_2", "Str_sim", "Eff_sim", "Loose_sim", "Connect"))
+            for i in range(n - 1):
+                partners = self.report_partners(i)
+                if not partners:
+                    continue
+                # The rows of the matrices are read at once for each molecule
+                strict_row = self.dbase.strict_mtx.row(i)
+                loose_row = self.dbase.loose_mtx.row(i)
+                true_strict_row = self.dbase.true_strict_mtx.row(i)
+                Filename_i = self.dbase.dic_mapping[i]
+                data = []
+                for j in partners:
+                    connected = self.resultGraph.has_edge(i, j)
                     Filename_j = self.dbase.dic_mapping[j]
                     MCmap = self.dbase.get_MCSmap(i,j)
                     mapString=""
                     if MCmap is not None:
                         mapString = MCmap
-                    # print "Check the filename", Filename_i, Filename_j
-                    strict_similarity = self.dbase.strict_mtx[i, j]
-                    loose_similarity = self.dbase.loose_mtx[i, j]
-                    true_strict_similarity = self.dbase.true_strict_mtx[i, j]
-                    if connected:
-                        new_line = "%-10s,%-10s,%-25s,%-25s,%-15.5f,%-15.5f,%-15.5f,%-10s,%s\n" % (
-                        i, j, Filename_i, Filename_j, true_strict_similarity, strict_similarity, loose_similarity, "Yes",mapString)
-                        # generate the morph type, and pick the start ligand based on the similarity
-                        if self.lead_index is not None:
-                            morph_i = Filename_i.split(".")[0]
-                            morph_j = Filename_j.split(".")[0]
-                            if i == self.lead_index:
+                    strict_similarity = strict_row[j]
+                    loose_similarity = loose_row[j]
+                    true_strict_similarity = true_strict_row[j]
+                    new_line = "%-10s,%-10s,%-25s,%-25s,%-15.5f,%-15.5f,%-15.5f,%-10s,%s\n" % (
+                    i, j, Filename_i, Filename_j, true_strict_similarity, strict_similarity, loose_similarity,
+                    "Yes" if connected else "No", mapString)
+                    # generate the morph type, and pick the start ligand based on the similarity
+                    if connected and self.lead_index is not None:
+                        morph_i = Filename_i.split(".")[0]
+                        morph_j = Filename_j.split(".")[0]
+                        if i == self.lead_index:
+                            morph_string = "%s > %s, " % (morph_i, morph_j)
+                        elif j == self.lead_index:
+                            morph_string = "%s > %s, " % (morph_j, morph_i)
+                        else:
+                            # compare i and j with the lead compound, and
+                            # pick the one with the higher similarity as the start ligand
+                            similarity_i = self.dbase.strict_mtx[self.lead_index, i]
+                            similarity_j = self.dbase.strict_mtx[self.lead_index, j]
+                            if similarity_i > similarity_j:
                                 morph_string = "%s > %s, " % (morph_i, morph_j)
-                            elif j == self.lead_index:
-                                morph_string = "%s > %s, " % (morph_j, morph_i)
                             else:
-                                # compare i and j with the lead compound, and
-                                # pick the one with the higher similarity as the start ligand
-                                similarity_i = self.dbase.strict_mtx[self.lead_index, i]
-                                similarity_j = self.dbase.strict_mtx[self.lead_index, j]
-                                if similarity_i > similarity_j:
-                                    morph_string = "%s > %s, " % (morph_i, morph_j)
-                                else:
-                                    morph_string = "%s > %s, " % (morph_j, morph_i)
-                            morph_data += morph_string
-                    else:
-                        new_line = "%-10s,%-10s,%-25s,%-25s,%-15.5f,%-15.5f,%-15.5f,%-10s,%s\n" % (
-                        i, j, Filename_i, Filename_j, true_strict_similarity, strict_similarity, loose_similarity, "No",mapString)
+                                morph_string = "%s > %s, " % (morph_j, morph_i)
+                        morph_data.append(morph_string)
                     data.append(new_line)
-            info_txt.writelines(data)
+                info_txt.writelines(data)
             if self.lead_index is not None:
-                morph_txt.write(morph_data)
+                morph_txt.write(''.join(morph_data))
                 
 
     def write_graph(self, output_no_images, output_no_graph):
@@ -1120,7 +1613,7 @@ class GraphGen(object):
                 id_mol = self.resultGraph.nodes[each_node]['ID']
                 # skip remove Hs by rdkit if Hs cannot be removed
                 try:
-                    mol = AllChem.RemoveHs(self.dbase[id_mol].getMolecule())
+                    mol = AllChem.RemoveHs(self.dbase[id_mol].getMolecule(copy=False))
                 except:
                     ###### need to ask RDKit to fix this if possible, see the code
                     # issue tracker for more details######
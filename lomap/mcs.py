@@ -51,7 +51,9 @@ from rdkit.Chem import rdmolops
 from rdkit import DataStructs
 from rdkit.Geometry.rdGeometry import Point3D
 import sys
+import copy
 import math
+import numpy as np
 from rdkit import RDLogger
 import logging
 import argparse
@@ -61,7 +63,183 @@ import argparse
 # *******************************
 
 
-__all__ = ['MCS']
+__all__ = ['MCS', 'PreparedMolecule']
+
+
+# Number of coordinate differences held at once when the substructure matches
+# are compared by rmsd
+RMSD_CHUNK_ELEMENTS = 1 << 20
+
+
+def atom_hybridization(a):
+    """
+    RDKit has an un-useful hybridization definition. Instead, just look at the number
+    of multiple bonds from an atom
+    """
+    if a.GetIsAromatic(): return 2
+    xs=0
+    for b in a.GetBonds():
+        if b.GetBondType()==Chem.rdchem.BondType.AROMATIC: return 2
+        if b.GetBondType()==Chem.rdchem.BondType.DOUBLE: xs += 1
+        if b.GetBondType()==Chem.rdchem.BondType.TRIPLE: xs += 2
+        if b.GetBondType()==Chem.rdchem.BondType.ONEANDAHALF: xs += 0.5
+
+    # O- is sp2 to avoid problems with carboxylate etc
+    if a.GetAtomicNum()==8 and a.GetFormalCharge()<0: return 2 # sp2
+
+    if xs==0: return 3 # sp3
+    if xs>1.1: return 1 # sp
+    return 2  # sp2
+
+
+def set_ring_counter(mol):
+
+    """
+
+    This function is used to attach to each molecule atom a ring counter
+    rc. This parameter is used to asses if a ring has been broken or not
+    during the MCS mapping
+
+    Parameters
+    ----------
+    mol : RDKit Molecule obj
+        the molecule used to define the atom ring counters
+    """
+
+    # set to zero the atom ring counters
+    for at in mol.GetAtoms():
+        at.SetProp('rc', '0')
+
+    rginfo = mol.GetRingInfo()
+
+    rgs = rginfo.AtomRings()
+
+    # print rgs
+
+    rgs_set = set([e for l in rgs for e in l])
+
+    for idx in rgs_set:
+        for r in rgs:
+            if idx in r:
+                val = int(mol.GetAtomWithIdx(idx).GetProp('rc'))
+                val = val + 1
+                mol.GetAtomWithIdx(idx).SetProp('rc', str(val))
+    return
+
+
+class PreparedMolecule(object):
+    """
+
+    This class holds the per-molecule data used by the MCS calculation. It is
+    built once per molecule and passed to MCS for each molecule pair, so that
+    the sanitization, hydrogen removal and chirality perception are not
+    repeated for every pair
+
+    """
+
+    def __init__(self, mol, options=argparse.Namespace(verbose='info', threed=False)):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+
+        mol : RDKit molecule object
+            the molecule to prepare. It is sanitized in place
+        options : argparse python object
+            the list of user options
+
+        """
+
+        if not options.verbose == 'pedantic':
+            lg = RDLogger.logger()
+            lg.setLevel(RDLogger.CRITICAL)
+
+        self.threed = bool(options.threed)
+
+        # Sanitize input molecule
+        self.mol = mol
+        Chem.SanitizeMol(self.mol)
+
+        # Set chirality flags from 3D coords if working in 3D
+        if self.threed:
+            Chem.rdmolops.AssignAtomChiralTagsFromStructure(self.mol, replaceExistingTags=True)
+
+        # Chiral centres of the molecule
+        self.chiral_centres = [seq[0] for seq in Chem.FindMolChiralCenters(self.mol)]
+
+        # The molecule without hydrogens, used by the MCS search. If the hydrogens
+        # cannot be removed with sanitization, they are removed without it
+        self.noh_sanitized = True
+        self.__fallback = None
+        try:
+            self.set_noh(AllChem.RemoveHs(self.mol))
+        except Exception:
+            self.noh_sanitized = False
+            self.set_noh(self.unsanitized_noh())
+
+        if not options.verbose == 'pedantic':
+            lg.setLevel(RDLogger.WARNING)
+
+    def unsanitized_noh(self):
+        """
+
+        This function returns the molecule without hydrogens removed without
+        sanitization, as done when the sanitization fails
+
+        """
+
+        mol_noh = AllChem.RemoveHs(self.mol, sanitize=False)
+        Chem.SanitizeMol(mol_noh, sanitizeOps=Chem.SanitizeFlags.SANITIZE_SETAROMATICITY)
+        return mol_noh
+
+    def set_noh(self, mol_noh):
+        """
+
+        This function sets the molecule without hydrogens and the data of its atoms
+
+        """
+
+        self.mol_noh = mol_noh
+
+        # Ring membership and hybridization classes of the atoms without hydrogens
+        self.ring_atoms = np.array([at.IsInRing() for at in self.mol_noh.GetAtoms()], dtype=bool)
+        self.hybridization = np.array([atom_hybridization(at) for at in self.mol_noh.GetAtoms()], dtype=int)
+
+        # Ring counters of the atoms without hydrogens
+        set_ring_counter(self.mol_noh)
+
+        # Coordinates of the atoms without hydrogens
+        if self.mol_noh.GetNumConformers() > 0:
+            self.coords = np.array(self.mol_noh.GetConformer().GetPositions())
+        else:
+            self.coords = None
+
+    def fallback(self):
+        """
+
+        This function returns the prepared molecule whose hydrogens are removed
+        without sanitization. The MCS of a pair uses it for both molecules when
+        the hydrogens of one of them cannot be removed with sanitization
+
+        Returns
+        -------
+        prepared : PreparedMolecule object
+            the prepared molecule, self if its hydrogens are already removed
+            without sanitization
+
+        """
+
+        if not self.noh_sanitized:
+            return self
+
+        if self.__fallback is None:
+            fallback = copy.copy(self)
+            fallback.noh_sanitized = False
+            fallback.set_noh(self.unsanitized_noh())
+            self.__fallback = fallback
+
+        return self.__fallback
 
 
 class MCS(object):
@@ -79,9 +257,10 @@ class MCS(object):
         Parameters
         ----------
 
-        moli : RDKit molecule object 
-            the first molecule used to perform the MCS calculation
-        molj : RDKit molecule object 
+        moli : RDKit molecule object or PreparedMolecule
+            the first molecule used to perform the MCS calculation. An RDKit
+            molecule is sanitized in place, a prepared molecule is not modified
+        molj : RDKit molecule object or PreparedMolecule
             the second molecule used to perform the MCS calculation
         options : argparse python object 
             the list of user options 
@@ -124,27 +303,55 @@ class MCS(object):
 
             moli_sub = moli.GetSubstructMatches(self.mcs_mol,uniquify=False)
             molj_sub = molj.GetSubstructMatches(self.mcs_mol,uniquify=False)
-            best_rmsd=1e8
+
+            if by_rmsd:
+                # The squared deviations of the match pairs are computed from the
+                # coordinate arrays, with the same operations in the same order as
+                # the RDKit points, so that the ties between symmetry equivalent
+                # matches are broken as before. The matches of moli are taken in
+                # chunks, so that the temporary arrays stay small
+                coordsi = self.__prepi.coords[np.array(moli_sub)]
+                coordsj = self.__prepj.coords[np.array(molj_sub)]
+                natoms = coordsi.shape[1]
+
+                centrei = coordsi[:, 0]
+                centrej = coordsj[:, 0]
+                for k in range(1, natoms):
+                    centrei = centrei + coordsi[:, k]
+                    centrej = centrej + coordsj[:, k]
+                centrei = centrei / natoms
+                centrej = centrej / natoms
+
+                chunk = max(1, RMSD_CHUNK_ELEMENTS // coordsj[:, 0].size)
+                best_rmsd = np.inf
+                for start in range(0, len(coordsi), chunk):
+                    # Translation to bring molj's centre over moli
+                    coord_delta = centrei[start:start + chunk, None] - centrej[None]
+                    rmsd = np.zeros(coord_delta.shape[:2])
+                    for k in range(natoms):
+                        dev = coordsi[start:start + chunk, None, k] - coordsj[None, :, k] - coord_delta
+                        rmsd += dev[..., 0] * dev[..., 0] + dev[..., 1] * dev[..., 1] + dev[..., 2] * dev[..., 2]
+
+                    # The first best pair in the order of the matches
+                    k = np.argmin(rmsd)
+                    if rmsd.flat[k] < best_rmsd:
+                        best_rmsd = rmsd.flat[k]
+                        best = (start + k // rmsd.shape[1], k % rmsd.shape[1])
+
+                return (moli_sub[best[0]], molj_sub[best[1]])
+
+            best_mismatches=1e8
             for mapi in moli_sub:
                 for mapj in molj_sub:
-                    # Compute the translation to bring molj's centre over moli
-                    coord_delta = 0
-                    if by_rmsd:
-                        coord_delta = (substructure_centre(moli,mapi)
-                                 - substructure_centre(molj,mapj))
-                    rmsd=0
+                    mismatches=0
                     for pair in zip(mapi,mapj):
-                        if by_rmsd:
-                            rmsd += (moli.GetConformer().GetAtomPosition(pair[0]) 
-                                   - molj.GetConformer().GetAtomPosition(pair[1])
-                                   - coord_delta).LengthSq()
-                        elif (moli.GetAtomWithIdx(pair[0]).GetAtomicNum() != 
-                              molj.GetAtomWithIdx(pair[1]).GetAtomicNum()):
-                            rmsd+=1
-                    if rmsd < best_rmsd:
+                        if (moli.GetAtomWithIdx(pair[0]).GetAtomicNum() != 
+                            molj.GetAtomWithIdx(pair[1]).GetAtomicNum()):
+                            mismatches+=1
+                    if mismatches < best_mismatches:
                         besti=mapi
                         bestj=mapj
-                        best_rmsd=rmsd
+                        best_mismatches=mismatches
 
             return (besti,bestj)
 
@@ -207,11 +414,11 @@ class MCS(object):
 
             to_remove = []
             for ai in self.moli.GetAtoms():
-                if ai.HasProp('to_mcs'):    # is ai in the MCS?
-                    aimcs = int(ai.GetProp('to_mcs'))
+                if ai.GetIdx() in self.__moli_to_mcs:    # is ai in the MCS?
+                    aimcs = self.__moli_to_mcs[ai.GetIdx()]
                     for bai in ai.GetNeighbors():
-                        if bai.HasProp('to_mcs'):  # Atom bonded to ai is also in the MCS
-                            baimcs = int(bai.GetProp('to_mcs'))
+                        if bai.GetIdx() in self.__moli_to_mcs:  # Atom bonded to ai is also in the MCS
+                            baimcs = self.__moli_to_mcs[bai.GetIdx()]
                             if (aimcs<baimcs):  # only do each bond once!
                                 # Check if the corresponding MCS atoms are bonded
                                 if not self.mcs_mol.GetBondBetweenAtoms(aimcs,baimcs):
@@ -256,18 +463,15 @@ class MCS(object):
 
                 return parity
 
-            def atom_mcs_chiral_parity(a):
+            def atom_mcs_chiral_parity(a, to_mcs):
                 """
                     Take the neighbours of chiral atom a. Get the index of each of these atoms
-                    in the MCS. Combine the parity of this list with the chirality flag for
-                    a to determine the "MCS parity".
+                    in the MCS from the to_mcs atom map. Combine the parity of this list with
+                    the chirality flag for a to determine the "MCS parity".
                 """
                 nbrs=[]
                 for aj in a.GetNeighbors():
-                    try:
-                        nbrs.append(int(aj.GetProp('to_mcs')))
-                    except Exception:
-                        nbrs.append(1000)   # should not be more than one!
+                    nbrs.append(to_mcs.get(aj.GetIdx(), 1000))   # should not be more than one!
 
                 if not permutation_parity(nbrs):
                     if a.GetChiralTag()==Chem.rdchem.ChiralType.CHI_TETRAHEDRAL_CW: return Chem.rdchem.ChiralType.CHI_TETRAHEDRAL_CCW
@@ -285,21 +489,21 @@ class MCS(object):
                 # Generate atommappings as they are useful below
                 map_mcs_mol()
 
-                chiral_at_moli = [seq[0] for seq in Chem.FindMolChiralCenters(moli)]
-                chiral_at_molj = [seq[0] for seq in Chem.FindMolChiralCenters(molj)]
+                chiral_at_moli = self.__prepi.chiral_centres
+                chiral_at_molj = self.__prepj.chiral_centres
 
                 invertedatoms = []
 
                 for i in chiral_at_moli:
                     # Is atom i in the MCS?
-                    ai = moli.GetAtomWithIdx(i)
-                    if (ai.HasProp('to_mcs')):
+                    ai = self.moli.GetAtomWithIdx(i)
+                    if (i in self.__moli_to_mcs):
                         for j in chiral_at_molj:
                             # Is atom j in the MCS?
-                            aj = molj.GetAtomWithIdx(j)
-                            if (aj.HasProp('to_mcs')):
+                            aj = self.molj.GetAtomWithIdx(j)
+                            if (j in self.__molj_to_mcs):
                                 # Are they the same atom?
-                                if (ai.GetProp('to_mcs') == aj.GetProp('to_mcs')):
+                                if (self.__moli_to_mcs[i] == self.__molj_to_mcs[j]):
                                     # OK, atoms are both chiral, and match the same MCS atom.
                                     # Take the list of neighbours for ai, and get their indices in 
                                     # the MCS. Use the parity of this index list together with the
@@ -307,10 +511,10 @@ class MCS(object):
                                     # for aj and check if the two are the same.
                                     # 
                                     # If not, flag with the CHI_TETRAHEDRAL_CW property.
-                                    pi = atom_mcs_chiral_parity(ai)
-                                    pj = atom_mcs_chiral_parity(aj)
+                                    pi = atom_mcs_chiral_parity(ai, self.__moli_to_mcs)
+                                    pj = atom_mcs_chiral_parity(aj, self.__molj_to_mcs)
                                     if (pi!=pj):
-                                        invertedatoms.append(int(aj.GetProp('to_mcs')))
+                                        invertedatoms.append(self.__molj_to_mcs[j])
 
                 for i in invertedatoms:
                     mcsat = self.mcs_mol.GetAtomWithIdx(i)
@@ -443,15 +647,13 @@ class MCS(object):
             for a in self.mcs_mol.GetAtoms():
                 a.ClearProp('to_moli')
                 a.ClearProp('to_molj')
-            for a in self.moli.GetAtoms():
-                a.ClearProp('to_mcs')
-            for a in self.molj.GetAtoms():
-                a.ClearProp('to_mcs')
 
-            # An RDkit atomic property is defined to store the mapping to moli
+            # An RDkit atomic property is defined to store the mapping to moli. The
+            # input molecules are not modified, their atom maps to the MCS are kept
+            # in dictionaries
             for idx in map_mcs_mol_to_moli_sub:
                 self.mcs_mol.GetAtomWithIdx(idx[0]).SetProp('to_moli', str(idx[1]))
-                self.moli.GetAtomWithIdx(idx[1]).SetProp('to_mcs', str(idx[0]))
+            self.__moli_to_mcs = {mol_idx: mcs_idx for mcs_idx, mol_idx in map_mcs_mol_to_moli_sub}
 
             mcsj_sub = tuple(range(self.mcs_mol.GetNumAtoms()))
 
@@ -464,7 +666,7 @@ class MCS(object):
             # An RDkit atomic property is defined to store the mapping to molj
             for idx in map_mcs_mol_to_molj_sub:
                 self.mcs_mol.GetAtomWithIdx(idx[0]).SetProp('to_molj', str(idx[1]))
-                self.molj.GetAtomWithIdx(idx[1]).SetProp('to_mcs', str(idx[0]))
+            self.__molj_to_mcs = {mol_idx: mcs_idx for mcs_idx, mol_idx in map_mcs_mol_to_molj_sub}
 
             # For each mcs atom we save its original index in a specified 
             # property. This could be very useful in the code development
@@ -474,40 +676,6 @@ class MCS(object):
 
             return
 
-        def set_ring_counter(mol):
-
-            """
-
-            This function is used to attach to each molecule atom a ring counter
-            rc. This parameter is used to asses if a ring has been broken or not
-            during the MCS mapping
-         
-            Parameters
-            ----------
-            mol : RDKit Molecule obj
-                the molecule used to define the atom ring counters
-            """
-
-            # set to zero the atom ring counters
-            for at in mol.GetAtoms():
-                at.SetProp('rc', '0')
-
-            rginfo = mol.GetRingInfo()
-
-            rgs = rginfo.AtomRings()
-
-            # print rgs
-
-            rgs_set = set([e for l in rgs for e in l])
-
-            for idx in rgs_set:
-                for r in rgs:
-                    if idx in r:
-                        val = int(mol.GetAtomWithIdx(idx).GetProp('rc'))
-                        val = val + 1
-                        mol.GetAtomWithIdx(idx).SetProp('rc', str(val))
-            return
-
         # START of __init__ function
         # Set logging level and format
         logging.basicConfig(format='%(levelname)s:\t%(message)s', level=logging.INFO)
@@ -517,18 +685,34 @@ class MCS(object):
         # Global beta setting for atom penalties
         self.beta = 0.1
 
-        # Local pointers to the passed molecules
-        self.moli = moli
-        self.molj = molj
-
-        # Sanitize input molecules
-        Chem.SanitizeMol(self.moli)
-        Chem.SanitizeMol(self.molj)
+        # The per-molecule data (sanitized molecules, molecules without hydrogens,
+        # chiral centres, ...). Prepared molecules are reused across the molecule
+        # pairs without a copy, as the MCS calculation does not modify them
+        # These variables are defined as private
+        def prepare(mol):
+            if isinstance(mol, PreparedMolecule):
+                if mol.threed != bool(self.options.threed):
+                    raise ValueError('The molecule has not been prepared with the same threed option')
+                return mol
+            return PreparedMolecule(mol, self.options)
+
+        self.__prepi = prepare(moli)
+        self.__prepj = prepare(molj)
+
+        # If the hydrogens of one molecule cannot be removed with sanitization,
+        # they are removed without it from both molecules
+        if not (self.__prepi.noh_sanitized and self.__prepj.noh_sanitized):
+            self.__prepi = self.__prepi.fallback()
+            self.__prepj = self.__prepj.fallback()
+
+        # Maps of the atom indexes of the molecules to the MCS atom indexes
+        # These variables are defined as private
+        self.__moli_to_mcs = {}
+        self.__molj_to_mcs = {}
 
-        # Set chirality flags from 3D coords if working in 3D
-        if self.options.threed:
-            Chem.rdmolops.AssignAtomChiralTagsFromStructure(self.moli,replaceExistingTags=True)
-            Chem.rdmolops.AssignAtomChiralTagsFromStructure(self.molj,replaceExistingTags=True)
+        # Local pointers to the passed molecules
+        self.moli = self.__prepi.mol
+        self.molj = self.__prepj.mol
 
         if not options.verbose == 'pedantic':
             lg = RDLogger.logger()
@@ -536,15 +720,8 @@ class MCS(object):
 
         # Local pointers to the passed molecules without hydrogens
         # These variables are defined as private
-        try:
-            self.__moli_noh = AllChem.RemoveHs(moli)
-            self.__molj_noh = AllChem.RemoveHs(molj)
-        except Exception:
-            self.__moli_noh = AllChem.RemoveHs(moli, sanitize=False)
-            self.__molj_noh = AllChem.RemoveHs(molj, sanitize=False)
-
-            Chem.SanitizeMol(self.__moli_noh, sanitizeOps=Chem.SanitizeFlags.SANITIZE_SETAROMATICITY)
-            Chem.SanitizeMol(self.__molj_noh, sanitizeOps=Chem.SanitizeFlags.SANITIZE_SETAROMATICITY)
+        self.__moli_noh = self.__prepi.mol_noh
+        self.__molj_noh = self.__prepj.mol_noh
 
         # MCS calculation. In RDKit the MCS is a smart string. Ring atoms are 
         # always mapped in ring atoms. 
@@ -617,9 +794,8 @@ class MCS(object):
         except Exception as e:
             raise ValueError(str(e))
 
-        # Set the ring counters for each molecule
-        set_ring_counter(self.__moli_noh)
-        set_ring_counter(self.__molj_noh)
+        # Set the ring counters of the MCS. The ones of the molecules are set
+        # when they are prepared
         set_ring_counter(self.mcs_mol)
 
         # for at in self.mcs_mol.GetAtoms():
@@ -675,6 +851,66 @@ class MCS(object):
 
         return scr_mcsr
 
+    @staticmethod
+    def atom_counts(mol):
+        """
+        This function counts the atoms of a molecule which bound the size of
+        its MCS with any other molecule
+
+        Parameters
+        ----------
+        mol : RDKit molecule object
+            the molecule
+
+        Returns
+        -------
+        counts : tuple of int
+            the number of heavy atoms used by the mcsr rule and the number of
+            ring and chain atoms of the molecule without hydrogens used by the
+            MCS search
+
+        """
+
+        mol_noh = AllChem.RemoveHs(mol, sanitize=False)
+        Chem.FastFindRings(mol_noh)
+        ring_info = mol_noh.GetRingInfo()
+
+        n_ring = sum(1 for at in mol_noh.GetAtoms() if ring_info.NumAtomRings(at.GetIdx()) > 0)
+
+        return mol.GetNumHeavyAtoms(), n_ring, mol_noh.GetNumAtoms() - n_ring
+
+    @staticmethod
+    def score_upper_bound(counts_i, counts_j, beta=0.1):
+        """
+        This function computes an upper bound of the similarity score of
+        molecule pairs without computing their MCS. As ring atoms are only
+        matched to ring atoms, the MCS has at most min(ring atoms) + min(chain
+        atoms) atoms, which bounds the mcsr rule. All the other rules are not
+        greater than one
+
+        Parameters
+        ----------
+        counts_i : numpy array of int
+            the atom_counts of the first molecules, with shape (m, 3)
+        counts_j : numpy array of int
+            the atom_counts of the second molecules, with shape (m, 3)
+        beta : float
+            the beta used by the mcsr rule
+
+        Returns
+        -------
+        bound : numpy array of float
+            the score upper bounds of the m molecule pairs
+
+        """
+
+        counts_i = np.asarray(counts_i).reshape(-1, 3)
+        counts_j = np.asarray(counts_j).reshape(-1, 3)
+
+        nmax_mcs = np.minimum(counts_i[:, 1], counts_j[:, 1]) + np.minimum(counts_i[:, 2], counts_j[:, 2])
+
+        return np.exp(-beta * (counts_i[:, 0] + counts_j[:, 0] - 2 * nmax_mcs))
+
     # MNACR rule
     def mncar(self, ths=4):
 
@@ -786,26 +1022,6 @@ class MCS(object):
 
         """
 
-        def atom_hybridization(a):
-            """
-            RDKit has an un-useful hybridization definition. Instead, just look at the number
-            of multiple bonds from an atom
-            """
-            if a.GetIsAromatic(): return 2
-            xs=0
-            for b in a.GetBonds():
-                if b.GetBondType()==Chem.rdchem.BondType.AROMATIC: return 2
-                if b.GetBondType()==Chem.rdchem.BondType.DOUBLE: xs += 1
-                if b.GetBondType()==Chem.rdchem.BondType.TRIPLE: xs += 2
-                if b.GetBondType()==Chem.rdchem.BondType.ONEANDAHALF: xs += 0.5
-
-            # O- is sp2 to avoid problems with carboxylate etc
-            if a.GetAtomicNum()==8 and a.GetFormalCharge()<0: return 2 # sp2
-
-            if xs==0: return 3 # sp3
-            if xs>1.1: return 1 # sp
-            return 2  # sp2
-
         nmismatch=0
         for at in self.mcs_mol.GetAtoms():
             moli_idx = int(at.GetProp('to_moli'))
@@ -813,8 +1029,8 @@ class MCS(object):
             moli_a = self.__moli_noh.GetAtoms()[moli_idx]
             molj_a = self.__molj_noh.GetAtoms()[molj_idx]
 
-            hybi = atom_hybridization(moli_a) 
-            hybj = atom_hybridization(molj_a) 
+            hybi = self.__prepi.hybridization[moli_idx]
+            hybj = self.__prepj.hybridization[molj_idx]
             mismatch= hybi != hybj
 
             # Allow Nsp3 to match Nsp2, otherwise guanidines etc become painful
@@ -1014,8 +1230,8 @@ class MCS(object):
         are mapped correctly.
         '''
 
-        def get_attached_atoms_not_in_mcs(mol,i):
-            ''' Get atoms attached to atom i which are not in the MCS '''
+        def get_attached_atoms_not_in_mcs(mol,to_mcs,i):
+            ''' Get atoms attached to atom i which are not in the MCS, from the mol to_mcs atom map '''
             attached=[]
             for b in mol.GetBonds():
                 if b.GetEndAtomIdx()==i or b.GetBeginAtomIdx()==i:
@@ -1023,7 +1239,7 @@ class MCS(object):
                     if (j==i):
                         j=b.GetBeginAtomIdx()
                     # OK, so j is the atom at the other end of the bond atom atom i. Is it in the MCS?
-                    inMCS = mol.GetAtomWithIdx(j).HasProp('to_mcs')
+                    inMCS = j in to_mcs
                     if not inMCS:
                         attached.append(j)
             return attached
@@ -1041,8 +1257,8 @@ class MCS(object):
         for at in self.mcs_mol.GetAtoms():
             moli_idx = int(at.GetProp('to_moli'))
             molj_idx = int(at.GetProp('to_molj'))
-            attached_i = get_attached_atoms_not_in_mcs(moli,moli_idx)
-            attached_j = get_attached_atoms_not_in_mcs(molj,molj_idx)
+            attached_i = get_attached_atoms_not_in_mcs(moli,self.__moli_to_mcs,moli_idx)
+            attached_j = get_attached_atoms_not_in_mcs(molj,self.__molj_to_mcs,molj_idx)
 
             # Now, we need to match these up, with the caveat that we *must* not match
             # a heavy to a heavy (as if we were allowed to match these, then they would be
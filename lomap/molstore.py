@@ -0,0 +1,377 @@
+# ******************
+# MODULE DOCSTRING
+# ******************
+
+"""
+
+LOMAP: Shared molecule block
+=====
+
+Alchemical free energy calculations hold increasing promise as an aid to drug
+discovery efforts. However, applications of these techniques in discovery
+projects have been relatively few, partly because of the difficulty of planning
+and setting up calculations. The Lead Optimization Mapper (LOMAP) is an
+automated algorithm to plan efficient relative free energy calculations between
+potential ligands within a substantial of compounds.
+
+"""
+
+# *****************************************************************************
+# Lomap2: A toolkit to plan alchemical relative binding affinity calculations
+# Copyright 2015 - 2016  UC Irvine and the Authors
+#
+# Authors: Dr Gaetano Calabro' and Dr David Mobley
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see http://www.gnu.org/licenses/
+# *****************************************************************************
+
+
+# ****************
+# MODULE IMPORTS
+# ****************
+
+import collections
+import mmap
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+from rdkit import Chem
+
+__all__ = ['MoleculeBlock', 'MoleculeDatabase', 'SharedMoleculeStore', 'pack_molecules', 'write_database']
+
+# Block layout: magic, number of molecules n, index int64[n, 4] and the records.
+# Each index row holds (record offset, name length, molecule length, flags) and
+# each record is the UTF-8 molecule name followed by the RDKit binary molecule
+MAGIC = b'LOMAPMB1'
+HEADER_SIZE = len(MAGIC) + 8
+INDEX_COLUMNS = 4
+
+# Index flags
+FLAG_ACTIVE = 1
+
+# Database file layout: magic, number of molecules n, offset of the molecule block,
+# total charges float64[n], atom counts int64[n, 3] (see MCS.atom_counts) and the
+# molecule block
+DB_MAGIC = b'LOMAPDB1'
+DB_HEADER_SIZE = len(DB_MAGIC) + 16
+
+
+def pack_molecules(molecules):
+    """
+    This function serializes a list of molecules into a single block of bytes
+
+    Parameters
+    ----------
+    molecules : list of Molecule objects
+        the molecules to serialize, in ID order
+
+    Returns
+    -------
+    block : bytearray
+        the serialized molecules
+
+    """
+
+    records = []
+    for mol in molecules:
+        name = mol.getName().encode('utf-8')
+        # The binary form keeps all the properties, as the electrostatic rule uses the mol2 partial charges
+        binary = bytes(mol.getBinary())
+        records.append((name, binary, FLAG_ACTIVE if mol.isActive() else 0))
+
+    n = len(records)
+    index = np.zeros((n, INDEX_COLUMNS), dtype=np.int64)
+
+    offset = HEADER_SIZE + index.nbytes
+    for k, (name, binary, flags) in enumerate(records):
+        index[k] = (offset, len(name), len(binary), flags)
+        offset += len(name) + len(binary)
+
+    block = bytearray(offset)
+    block[:len(MAGIC)] = MAGIC
+    block[len(MAGIC):HEADER_SIZE] = np.int64(n).tobytes()
+    block[HEADER_SIZE:HEADER_SIZE + index.nbytes] = index.tobytes()
+    for (name, binary, flags), (start, name_len, mol_len, _) in zip(records, index):
+        block[start:start + name_len] = name
+        block[start + name_len:start + name_len + mol_len] = binary
+
+    return block
+
+
+class MoleculeBlock(object):
+    """
+    This class reads the molecules of a serialized block without copying it.
+    The molecules are rebuilt on demand and the most recently used ones are
+    kept, so that a process only holds the molecules it is working on
+
+    """
+
+    def __init__(self, buf, cache_size=64):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        buf : buffer object
+            the block written by pack_molecules, e.g. a shared memory or a memory mapped file buffer
+        cache_size : int
+            the number of rebuilt molecules kept in memory
+
+        """
+
+        self.buf = memoryview(buf)
+
+        if bytes(self.buf[:len(MAGIC)]) != MAGIC:
+            raise ValueError('The buffer is not a molecule block')
+
+        n = int(np.frombuffer(self.buf, dtype=np.int64, count=1, offset=len(MAGIC))[0])
+        self.index = np.frombuffer(self.buf, dtype=np.int64, count=n * INDEX_COLUMNS,
+                                   offset=HEADER_SIZE).reshape(n, INDEX_COLUMNS)
+
+        self.cache_size = cache_size
+        self.__cache = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.index)
+
+    def name(self, i):
+        """
+        Get the name of the molecule i
+        """
+
+        start, name_len = int(self.index[i, 0]), int(self.index[i, 1])
+        return bytes(self.buf[start:start + name_len]).decode('utf-8')
+
+    def binary(self, i):
+        """
+        Get the RDKit binary of the molecule i, as a view of the buffer
+        """
+
+        start, name_len, mol_len = (int(x) for x in self.index[i, :3])
+        return self.buf[start + name_len:start + name_len + mol_len]
+
+    def molecule(self, i):
+        """
+        Get the RDKit molecule i
+        """
+
+        return Chem.Mol(bytes(self.binary(i)))
+
+    def __getitem__(self, i):
+        """
+        Get the molecule i as a Molecule object
+        """
+
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+
+        if i < 0:
+            i += len(self)
+
+        mol = self.__cache.get(i)
+        if mol is None:
+            # Imported here, as the dbmol module imports this one
+            from .dbmol import Molecule
+
+            # The binary is copied, so that the buffer can be released while the molecule is used
+            mol = Molecule(bytes(self.binary(i)), i, self.name(i))
+            mol.setActive(bool(self.index[i, 3] & FLAG_ACTIVE))
+
+            self.__cache[i] = mol
+            if len(self.__cache) > self.cache_size:
+                self.__cache.popitem(last=False)
+        else:
+            self.__cache.move_to_end(i)
+
+        return mol
+
+    def release(self):
+        """
+        Drop the references to the buffer, which can then be closed
+        """
+
+        self.__cache.clear()
+        self.index = None
+        self.buf.release()
+
+
+class SharedMoleculeStore(object):
+    """
+    This class places a molecule block in shared memory. The parent process
+    creates the store once and the worker processes attach to it by name
+
+    """
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        self.block = MoleculeBlock(shm.buf)
+
+    @classmethod
+    def create(cls, molecules):
+        """
+        Serialize the molecules into a new shared memory block
+
+        Parameters
+        ----------
+        molecules : list of Molecule objects
+            the molecules to store, in ID order
+
+        """
+
+        data = pack_molecules(molecules)
+        shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        shm.buf[:len(data)] = data
+
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Attach to the shared memory block created by another process
+
+        Parameters
+        ----------
+        name : str
+            the shared memory block name
+
+        """
+
+        return cls(shared_memory.SharedMemory(name=name), owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        """
+        Detach from the shared memory block, which is removed by its owner
+        """
+
+        self.block.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def write_database(fname, molecules, charges, atom_counts):
+    """
+    This function writes a molecule database file, which holds the molecules
+    and their per-molecule data used by the scoring
+
+    Parameters
+    ----------
+    fname : str
+        the database file name
+    molecules : list of Molecule objects
+        the molecules to store, in ID order
+    charges : numpy array of float
+        the total charges of the molecules
+    atom_counts : numpy array of int
+        the atom counts of the molecules, with shape (number of molecules, 3)
+
+    """
+
+    n = len(molecules)
+    charges = np.ascontiguousarray(charges, dtype=np.float64)
+    atom_counts = np.ascontiguousarray(atom_counts, dtype=np.int64).reshape(n, 3)
+
+    block_offset = DB_HEADER_SIZE + charges.nbytes + atom_counts.nbytes
+
+    # The file is written aside and renamed, so that a database being read is never truncated
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(DB_MAGIC)
+        f.write(np.array([n, block_offset], dtype=np.int64).tobytes())
+        f.write(charges.tobytes())
+        f.write(atom_counts.tobytes())
+        f.write(pack_molecules(molecules))
+    os.replace(tmp_fname, fname)
+
+
+def is_database(fname):
+    """
+    This function checks whether the passed file is a molecule database
+    """
+
+    if not os.path.isfile(fname):
+        return False
+
+    with open(fname, 'rb') as f:
+        return f.read(len(DB_MAGIC)) == DB_MAGIC
+
+
+class MoleculeDatabase(object):
+    """
+    This class opens a molecule database file written by write_database. The
+    file is memory mapped, so that opening it does not read the molecules,
+    which are accessed by ID
+
+    """
+
+    def __init__(self, fname):
+        """
+        Initialization function
+
+        Parameters
+        ----------
+        fname : str
+            the database file name
+
+        """
+
+        self.fname = fname
+
+        with open(fname, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        buf = memoryview(self.mm)
+        if bytes(buf[:len(DB_MAGIC)]) != DB_MAGIC:
+            raise ValueError('The file %s is not a molecule database' % fname)
+
+        n, block_offset = (int(x) for x in np.frombuffer(buf, dtype=np.int64, count=2, offset=len(DB_MAGIC)))
+
+        self.charges = np.frombuffer(buf, dtype=np.float64, count=n, offset=DB_HEADER_SIZE)
+        self.atom_counts = np.frombuffer(buf, dtype=np.int64, count=3 * n,
+                                         offset=DB_HEADER_SIZE + self.charges.nbytes).reshape(n, 3)
+        self.block = MoleculeBlock(buf[block_offset:], cache_size=0)
+
+    def __len__(self):
+        return len(self.block)
+
+    def __getitem__(self, i):
+        """
+        Get the molecule i as a Molecule object. The molecule refers to the
+        binary in the memory mapped file, which is only read when the molecule
+        is materialized
+        """
+
+        # Imported here, as the dbmol module imports this one
+        from .dbmol import Molecule
+
+        if i < 0:
+            i += len(self)
+
+        mol = Molecule(self.block.binary(i), i, self.block.name(i))
+        mol.setActive(bool(self.block.index[i, 3] & FLAG_ACTIVE))
+
+        return mol
+
+    def molecules(self):
+        """
+        Get all the molecules as Molecule objects, in ID order
+        """
+
+        return [self[i] for i in range(len(self))]
@@ -0,0 +1,327 @@
+# ******************
+# MODULE DOCSTRING
+# ******************
+
+"""
+
+LOMAP: Molecule file readers
+=====
+
+Alchemical free energy calculations hold increasing promise as an aid to drug
+discovery efforts. However, applications of these techniques in discovery
+projects have been relatively few, partly because of the difficulty of planning
+and setting up calculations. The Lead Optimization Mapper (LOMAP) is an
+automated algorithm to plan efficient relative free energy calculations between
+potential ligands within a substantial of compounds.
+
+"""
+
+# *****************************************************************************
+# Lomap2: A toolkit to plan alchemical relative binding affinity calculations
+# Copyright 2015 - 2016  UC Irvine and the Authors
+#
+# Authors: Dr Gaetano Calabro' and Dr David Mobley
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see http://www.gnu.org/licenses/
+# *****************************************************************************
+
+
+# ****************
+# MODULE IMPORTS
+# ****************
+
+import collections
+import glob
+import gzip
+import io
+import itertools
+import multiprocessing
+import os
+
+from rdkit import Chem
+
+__all__ = ['molecule_files', 'parse_block', 'read_molecules']
+
+# The supported molecule file formats, optionally gzipped
+EXTENSIONS = ('.mol2', '.sdf', '.mol2.gz', '.sdf.gz')
+
+MOL2_RECORD = '@<TRIPOS>MOLECULE'
+
+
+def molecule_files(sources):
+    """
+    This function expands the molecule sources into a sorted list of file names
+
+    Parameters
+    ----------
+    sources : str or list of str
+        directories, whose mol2/sdf files are taken, file names or glob patterns
+
+    Returns
+    -------
+    fnames : list of str
+        the molecule file names. The files of each source are sorted by name
+
+    """
+
+    if isinstance(sources, str):
+        sources = [sources]
+
+    fnames = []
+    for source in sources:
+        if os.path.isdir(source):
+            matches = [fname for ext in EXTENSIONS for fname in glob.glob(os.path.join(source, '*' + ext))]
+        elif os.path.isfile(source):
+            matches = [source]
+        else:
+            matches = [fname for fname in glob.glob(source) if fname.endswith(EXTENSIONS)]
+        fnames += sorted(matches)
+
+    return fnames
+
+
+def open_text(fname, mode='rt'):
+    # Open a file, which is decompressed on the fly if gzipped
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode)
+    return open(fname, mode)
+
+
+def sdf_blocks(fname):
+    """
+    This generator yields the text of the records of a SDF file, one at a time
+    """
+
+    lines = []
+    with open_text(fname) as f:
+        for line in f:
+            lines.append(line)
+            if line.startswith('$$$$'):
+                yield ''.join(lines)
+                lines = []
+
+    # The last record terminator is optional
+    if any(line.strip() for line in lines):
+        yield ''.join(lines)
+
+
+def mol2_blocks(fname):
+    """
+    This generator yields the text of the molecule records of a mol2 file, one
+    at a time. Comments before the first record are skipped
+    """
+
+    lines = []
+    with open_text(fname) as f:
+        for line in f:
+            if line.startswith(MOL2_RECORD):
+                if lines:
+                    yield ''.join(lines)
+                lines = []
+            if lines or line.startswith(MOL2_RECORD):
+                lines.append(line)
+
+    if lines:
+        yield ''.join(lines)
+
+
+def block_title(block, fmt):
+    # The title is the first line of a SDF record and the line following the
+    # record header in a mol2 one
+    lines = block.split('\n', 2)
+    title = lines[0] if fmt == 'sdf' else (lines[1] if len(lines) > 1 else '')
+    return title.strip()
+
+
+def parse_block(block, fmt, validate=False):
+    """
+    This function parses the text of a molecule record. The molecule is not
+    sanitized and all the hydrogens are kept in place
+
+    Parameters
+    ----------
+    block : str
+        the record text
+    fmt : str
+        the record format, 'sdf' or 'mol2'
+    validate : bool
+        if True, a copy of the molecule is sanitized and the failure, if any,
+        is reported along with the molecule
+
+    Returns
+    -------
+    rdkit_mol : RDKit molecule object or None
+        the molecule, None if the record cannot be read
+    error : str
+        the reason why the record cannot be read or, along with a molecule,
+        why it cannot be sanitized. Empty if there is no problem
+
+    """
+
+    if not block.strip():
+        return None, 'the record is empty'
+
+    try:
+        if fmt == 'sdf':
+            # A forward supplier parses the record, as for a whole file, so that the data fields are read
+            rdkit_mol = next(Chem.ForwardSDMolSupplier(io.BytesIO(block.encode('utf-8')), sanitize=False,
+                                                       removeHs=False), None)
+        else:
+            rdkit_mol = Chem.MolFromMol2Block(block, sanitize=False, removeHs=False)
+    except Exception as e:
+        return None, str(e)
+
+    if rdkit_mol is None:
+        return None, 'the record cannot be parsed'
+
+    if validate:
+        # The MCS sanitizes the molecules, which fails here rather than for each pair.
+        # The molecule is kept, so that the IDs do not depend on the validation
+        try:
+            Chem.SanitizeMol(Chem.Mol(rdkit_mol))
+        except Exception as e:
+            return rdkit_mol, 'sanitization failed: %s' % e
+
+    return rdkit_mol, ''
+
+
+def parse_blocks(tasks):
+    """
+    This function parses a chunk of records in a worker process. The molecules
+    are returned as RDKit binaries, which are compact to send back
+
+    Parameters
+    ----------
+    tasks : list of tuples
+        the (record text, format, validate flag) tuples
+
+    Returns
+    -------
+    results : list of tuples
+        the (RDKit binary or None, error) tuples
+
+    """
+
+    results = []
+    for block, fmt, validate in tasks:
+        rdkit_mol, error = parse_block(block, fmt, validate)
+        if rdkit_mol is not None:
+            # All the properties are kept, as the electrostatic rule uses the mol2 partial charges
+            rdkit_mol = rdkit_mol.ToBinary(Chem.PropertyPickleOptions.AllProps)
+        results.append((rdkit_mol, error))
+
+    return results
+
+
+def named_blocks(sources):
+    """
+    This generator yields the (name, record text, format) records of the
+    passed sources. A file holding a single molecule names it after the file,
+    as in the one molecule per file layout. The molecules of multi record files
+    are named after the record titles, or after the file and the record number
+    when the title is missing. Repeated names are made unique by appending the
+    record number. An empty file is yielded as an empty record
+
+    """
+
+    names = set()
+
+    for fname in molecule_files(sources):
+        basename = os.path.basename(fname)
+        fmt = 'mol2' if fname.endswith(('.mol2', '.mol2.gz')) else 'sdf'
+        blocks = mol2_blocks(fname) if fmt == 'mol2' else sdf_blocks(fname)
+
+        # One record is read ahead, to tell single molecule files
+        first = next(blocks, None)
+        second = next(blocks, None)
+
+        if first is None:
+            yield basename, '', fmt
+            continue
+
+        if second is None:
+            name = basename if basename not in names else '%s_1' % basename
+            names.add(name)
+            yield name, first, fmt
+            continue
+
+        for idx, block in enumerate(itertools.chain([first, second], blocks), 1):
+            title = block_title(block, fmt)
+            name = title if title else '%s_%d' % (basename, idx)
+            if name in names:
+                name = '%s_%d' % (name, idx)
+            names.add(name)
+            yield name, block, fmt
+
+
+def read_molecules(sources, parallel=1, validate=False, chunk_size=64, binary=False):
+    """
+    This generator reads the molecules of the passed sources without loading
+    whole files in memory. The records are read in order and, in parallel
+    mode, parsed by a pool of processes in chunks. The molecules are yielded
+    in the record order whatever the number of processes
+
+    Parameters
+    ----------
+    sources : str or list of str
+        directories, file names or glob patterns of the mol2/sdf files, which
+        can be gzipped and hold several molecules each
+    parallel : int
+        the number of parsing processes
+    validate : bool
+        if True, the molecules which cannot be sanitized are reported
+    chunk_size : int
+        in parallel mode, the number of records parsed by a process at a time
+    binary : bool
+        if True, the molecules parsed by the pool are yielded in the RDKit
+        binary form, as sent back by the processes
+
+    Returns
+    -------
+    records : generator of tuples
+        the (name, RDKit molecule, error) tuples. The molecule is None if the
+        record cannot be read, and error then holds the reason. An error along
+        with a molecule is the reason why it cannot be sanitized
+
+    """
+
+    records = named_blocks(sources)
+
+    if parallel <= 1:
+        for name, block, fmt in records:
+            rdkit_mol, error = parse_block(block, fmt, validate)
+            yield name, rdkit_mol, error
+        return
+
+    with multiprocessing.Pool(parallel) as pool:
+        # The names are kept in the parent process and the record texts are sent to
+        # the pool. A few chunks per process are in flight, so that the files are
+        # only read as the results are consumed
+        pending = collections.deque()
+        while True:
+            while len(pending) < 2 * parallel:
+                chunk = list(itertools.islice(records, chunk_size))
+                if not chunk:
+                    break
+                tasks = [(block, fmt, validate) for name, block, fmt in chunk]
+                pending.append(([name for name, block, fmt in chunk], pool.apply_async(parse_blocks, (tasks,))))
+
+            if not pending:
+                break
+
+            chunk_names, result = pending.popleft()
+            for name, (mol_binary, error) in zip(chunk_names, result.get()):
+                if mol_binary is not None and not binary:
+                    mol_binary = Chem.Mol(mol_binary)
+                yield name, mol_binary, error
@@ -16,8 +16,8 @@ if sys.argv[-1] == 'setup.py':
     print("To install, run 'python setup.py install'")
     print()
 
-if sys.version_info[:2] < (2, 7):
-    print("Lomap requires Python 2.7 or later (%d.%d detected)." %
+if sys.version_info[:2] < (3, 8):
+    print("Lomap requires Python 3.8 or later (%d.%d detected)." %
           sys.version_info[:2])
     sys.exit(-1)
 
@@ -41,7 +41,11 @@ setup(
             'Natural Language :: English',
             'Operating System :: MacOS :: MacOS X',
             'Operating System :: POSIX :: Linux',
-            'Programming Language :: Python :: 3.5',
+            'Programming Language :: Python :: 3',
+            'Programming Language :: Python :: 3.8',
+            'Programming Language :: Python :: 3.9',
+            'Programming Language :: Python :: 3.10',
+            'Programming Language :: Python :: 3.11',
             'Topic :: Scientific/Engineering :: Bio-Informatics',
             'Topic :: Scientific/Engineering :: Chemistry',
             'Topic :: Scientific/Engineering :: Mathematics',
@@ -58,6 +62,7 @@ setup(
     include_package_data = True,
 
     entry_points         = {'console_scripts':['lomap=lomap.dbmol:startup']},
+    python_requires      = '>=3.8',
     zip_safe             = False
 )
 
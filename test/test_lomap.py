@@ -9,6 +9,19 @@ import math
 import argparse
 import sys
 import logging
+import os
+import tempfile
+import pickle
+import gzip
+import glob
+import shutil
+import numpy as np
+from lomap import cache
+from lomap import molstore
+from lomap import mcs
+from lomap import readers
+from lomap import graphgen
+import networkx as nx
 
 
 def executable():
@@ -104,6 +117,610 @@ class TestLomap(unittest.TestCase):
         assert (all(s_strict == p_strict))
         assert (all(s_loose == p_loose))
 
+    # Check that the pairs handed out in batches to the processes are all scored
+    def test_parallel_batches(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        db = DBMolecules('test/basic')
+        s_strict, s_loose = db.build_matrices()
+        s_maps = dict(db.mcs_map_store)
+
+        db_p = DBMolecules('test/basic', parallel=3, batch_size=5)
+        p_strict, p_loose = db_p.build_matrices()
+
+        assert (all(s_strict == p_strict))
+        assert (all(s_loose == p_loose))
+        self.assertEqual(s_maps, db_p.mcs_map_store)
+        self.assertGreaterEqual(db_p.load_imbalance, 1.0)
+
+
+    # Check that a rerun reads all the pair scores from the score cache
+    def test_score_cache(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'scores.db')
+            db = DBMolecules('test/basic', score_cache=fname)
+            strict, loose = db.build_matrices()
+            self.assertEqual(db.score_cache.hits, 0)
+
+            db2 = DBMolecules('test/basic', score_cache=fname)
+            strict2, loose2 = db2.build_matrices()
+            self.assertEqual(db2.score_cache.misses, 0)
+            self.assertGreater(db2.score_cache.hits, 0)
+            assert (all(strict == strict2))
+            assert (all(loose == loose2))
+            self.assertEqual(db.mcs_map_store, db2.mcs_map_store)
+
+    def test_score_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sc = cache.ScoreCache(os.path.join(tmpdir, 'scores.db'), max_entries=2)
+            sc.store('a', 'b', 'o', 0.5, 0.5, 0.5, '0:1,1:0')
+            sc.flush()
+            sc.store('a', 'c', 'o', 0.6, 0.6, 0.6, None)
+            sc.flush()
+            # Touch the oldest entry, so that the second one is evicted
+            self.assertEqual(sc.lookup('b', 'a', 'o'), (0.5, 0.5, 0.5, '0:1,1:0'))
+            sc.flush()
+            sc.store('a', 'd', 'o', 0.7, 0.7, 0.7, '')
+            sc.flush()
+            self.assertEqual(len(sc), 2)
+            self.assertIsNone(sc.lookup('a', 'c', 'o'))
+            self.assertEqual(sc.lookup('a', 'd', 'o'), (0.7, 0.7, 0.7, ''))
+            sc.close()
+
+    # Check that adding molecules to a scored database gives the same scores as a full build
+    def test_add_molecules(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        full = DBMolecules('test/linksfile')
+        full.build_matrices()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for fname in ['phenyl.sdf', 'toluyl.sdf', 'phenylfuran.sdf']:
+                with open(os.path.join('test/linksfile', fname)) as fin:
+                    with open(os.path.join(tmpdir, fname), 'w') as fout:
+                        fout.write(fin.read())
+            db = DBMolecules(tmpdir)
+            db.build_matrices()
+        new_mol = dbmol.Molecule(Chem.MolFromMolFile('test/linksfile/phenylcyclobutyl.sdf', sanitize=False,
+                                                     removeHs=False), 0, 'phenylcyclobutyl.sdf')
+        strict, loose = db.add_molecules([new_mol])
+        self.assertEqual(db.nums(), 4)
+        self.assertEqual(db[3].getID(), 3)
+        for i in range(0, 4):
+            for j in range(0, 4):
+                fi = full.inv_dic_mapping[db[i].getName()]
+                fj = full.inv_dic_mapping[db[j].getName()]
+                self.assertEqual(strict[i, j], full.strict_mtx[fi, fj])
+                self.assertEqual(loose[i, j], full.loose_mtx[fi, fj])
+                # The map strings list the atoms of the lowest molecule ID first
+                full_map = full.get_MCSmap(fi, fj)
+                if (i < j) != (fi < fj):
+                    full_map = cache.transpose_map(full_map)
+                self.assertEqual(db.get_MCSmap(i, j), full_map)
+        with self.assertRaises(ValueError):
+            db.add_molecules([new_mol])
+
+    # Check that the sparse score matrices hold the same scores as the dense ones
+    def test_sparse_matrices(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        dense = DBMolecules('test/chiral', score_precision='float64')
+        strict, loose = dense.build_matrices()
+        for parallel in (1, 2):
+            db = DBMolecules('test/chiral', parallel=parallel, sparse=True)
+            s_strict, s_loose = db.build_matrices()
+            self.assertIsInstance(s_strict, dbmol.SparseSMatrix)
+            self.assertEqual(s_strict.size, strict.size)
+            self.assertLess(s_strict.nnz(), strict.size)
+            np.testing.assert_array_equal(s_strict.to_numpy_2D_array(), strict.to_numpy_2D_array())
+            np.testing.assert_array_equal(s_loose.to_dense().view(np.ndarray), loose.view(np.ndarray))
+            for i, cols, values in s_strict.iter_rows():
+                row = strict.to_numpy_2D_array()[i]
+                np.testing.assert_array_equal(cols, np.flatnonzero(row))
+                np.testing.assert_array_equal(values, row[cols])
+            self.assertEqual(list(db.build_graph().edges(data=True)), list(dense.build_graph().edges(data=True)))
+
+        # Elements are dropped when set to a value not above the floor, and kept by expand
+        mat = dbmol.SparseSMatrix(shape=(5,), floor=0.1)
+        mat[1, 3] = 0.5
+        mat[4, 0] = 0.05
+        mat.put(np.array([0, 9]), [0.7, 0.8])
+        mat[0] = 0.0
+        self.assertEqual(mat.nnz(), 2)
+        self.assertEqual((mat[3, 1], mat[0, 4], mat[3, 4]), (0.5, 0.0, 0.8))
+        big = mat.expand(7)
+        self.assertEqual((big[3, 1], big[3, 4], big[5, 6]), (0.5, 0.8, 0.0))
+        with self.assertRaises(ValueError):
+            mat[1, 5] = 0.3
+
+    # Check that the processes write the scores into the memory mapped matrix files
+    def test_memmap_matrices(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        dense = DBMolecules('test/basic', score_precision='float64')
+        strict, loose = dense.build_matrices()
+        for parallel in (1, 3):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                db = DBMolecules('test/basic', parallel=parallel, matrix_dir=tmpdir)
+                m_strict, m_loose = db.build_matrices()
+                self.assertIsNotNone(m_strict._memmap_base())
+                assert (all(m_strict == strict))
+                assert (all(m_loose == loose))
+                self.assertEqual(dense.mcs_map_store, db.mcs_map_store)
+
+                # The files are reopened read only, directly or by unpickling the matrix
+                reopened = dbmol.SMatrix.memmap(db.matrix_file('strict'))
+                self.assertEqual(reopened.mat_size(), db.nums())
+                assert (all(reopened == strict))
+                assert (all(pickle.loads(pickle.dumps(m_loose)) == loose))
+                with self.assertRaises(ValueError):
+                    reopened[0, 1] = 0.5
+                del reopened, m_strict, m_loose, db
+
+    # Check that the memory mapped matrices are extended through temporary files, and kept if this fails
+    def test_memmap_add_molecules(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        full = DBMolecules('test/linksfile')
+        full.build_matrices()
+        new_mol = dbmol.Molecule(Chem.MolFromMolFile('test/linksfile/phenylcyclobutyl.sdf', sanitize=False,
+                                                     removeHs=False), 0, 'phenylcyclobutyl.sdf')
+        with tempfile.TemporaryDirectory() as tmpdir, tempfile.TemporaryDirectory() as matrix_dir:
+            for fname in ['phenyl.sdf', 'toluyl.sdf', 'phenylfuran.sdf']:
+                shutil.copy(os.path.join('test/linksfile', fname), tmpdir)
+            db = DBMolecules(tmpdir, matrix_dir=matrix_dir)
+            db.build_matrices()
+            db.strict_mtx.flush()
+            with open(db.matrix_file('strict'), 'rb') as f:
+                before = f.read()
+
+            # The expansion of the last matrix fails, the files are left as they were
+            expand = dbmol.SMatrix.expand
+            calls = []
+
+            def failing_expand(mat, new_n, fname=None):
+                calls.append(fname)
+                if len(calls) == 3:
+                    raise IOError('No space left on device')
+                return expand(mat, new_n, fname)
+
+            dbmol.SMatrix.expand = failing_expand
+            try:
+                with self.assertRaises(IOError):
+                    db.add_molecules([new_mol])
+            finally:
+                dbmol.SMatrix.expand = expand
+            with open(db.matrix_file('strict'), 'rb') as f:
+                self.assertEqual(f.read(), before)
+            self.assertEqual(dbmol.SMatrix.memmap(db.matrix_file('loose')).mat_size(), 3)
+            self.assertEqual(sorted(os.listdir(matrix_dir)), ['loose_mtx.dat', 'strict_mtx.dat', 'true_strict_mtx.dat'])
+
+            db = DBMolecules(tmpdir, matrix_dir=matrix_dir)
+            db.build_matrices()
+            strict, loose = db.add_molecules([new_mol])
+            self.assertEqual(os.path.realpath(strict._memmap_base().filename), os.path.realpath(db.matrix_file('strict')))
+            self.assertEqual(sorted(os.listdir(matrix_dir)), ['loose_mtx.dat', 'strict_mtx.dat', 'true_strict_mtx.dat'])
+            for i in range(0, 4):
+                for j in range(0, 4):
+                    fi = full.inv_dic_mapping[db[i].getName()]
+                    fj = full.inv_dic_mapping[db[j].getName()]
+                    self.assertEqual(strict[i, j], full.strict_mtx[fi, fj])
+                    self.assertEqual(dbmol.SMatrix.memmap(db.matrix_file('loose'))[i, j], full.loose_mtx[fi, fj])
+            del strict, loose, db
+
+    # Check that the strict and loose matrices are views of the score store, and that the forced links keep their true scores
+    def test_score_store(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        db = DBMolecules('test/linksfile', links_file='test/linksfile/links3.txt')
+        strict, loose = db.build_matrices()
+        self.assertIsInstance(db.scores, dbmol.ScoreStore)
+        self.assertEqual(strict.dtype, np.float64)
+        # A third of the memory of three float64 matrices, the forced links are kept aside
+        self.assertEqual(db.scores.data.nbytes, 8 * db.scores.size)
+        self.assertTrue(np.shares_memory(strict, db.scores.data) and np.shares_memory(loose, db.scores.data))
+        self.assertTrue(np.shares_memory(strict.condensed(), db.scores.data))
+        self.assertEqual(len(db.scores.forced), len({frozenset(k) for k, s in db.prespecified_links.items() if s < 0}))
+        for (i, j), score in db.prespecified_links.items():
+            if score < 0:
+                self.assertEqual((strict[i, j], loose[i, j]), (1.0, 1.0))
+                self.assertLess(db.true_strict_mtx[i, j], 1.0)
+                self.assertEqual(db.true_strict_mtx.to_numpy_2D_array()[j, i], db.true_strict_mtx[i, j])
+
+        narrow = DBMolecules('test/linksfile', links_file='test/linksfile/links3.txt', score_precision='float32')
+        n_strict, n_loose = narrow.build_matrices()
+        self.assertEqual(n_strict.dtype, np.float32)
+        self.assertEqual(narrow.scores.data.nbytes, 4 * narrow.scores.size)
+        np.testing.assert_allclose(n_strict.view(np.ndarray), strict.view(np.ndarray), rtol=1e-6)
+        np.testing.assert_allclose(narrow.true_strict_mtx.to_numpy_2D_array(),
+                                   db.true_strict_mtx.to_numpy_2D_array(), rtol=1e-6)
+
+        # The stores written with a flags field are read back
+        data = np.zeros(db.scores.size, dtype=[('score', np.float64), ('flags', np.uint8)])
+        data['score'] = db.scores.data
+        data['flags'][db.scores.forced] = dbmol.ScoreStore.FORCED
+        old = object.__new__(dbmol.ScoreStore)
+        old.__setstate__({'n': db.scores.n, 'data': data, 'true_scores': dict(db.scores.true_scores)})
+        np.testing.assert_array_equal(old.forced, db.scores.forced)
+        np.testing.assert_array_equal(dbmol.TrueScoreMatrix(old).to_numpy_2D_array(),
+                                      db.true_strict_mtx.to_numpy_2D_array())
+
+    # Check that the default score precision gives the graph of the float64 scores
+    def test_score_precision_graph(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        db = DBMolecules('test/transforms')
+        db.build_matrices()
+        wide = DBMolecules('test/transforms', score_precision='float64')
+        wide.build_matrices()
+        edges = sorted(db.build_graph().edges())
+        self.assertEqual(edges, sorted(wide.build_graph().edges()))
+        for edge in [(0, 10), (20, 45), (28, 42), (28, 45)]:
+            self.assertIn(edge, edges)
+
+        # The views are rebuilt when the database is loaded
+        loaded = pickle.loads(pickle.dumps(db))
+        self.assertTrue(np.shares_memory(loaded.strict_mtx, loaded.scores.data))
+        self.assertTrue(np.shares_memory(loaded.loose_mtx, loaded.scores.data))
+        np.testing.assert_array_equal(loaded.true_strict_mtx.to_numpy_2D_array(),
+                                      db.true_strict_mtx.to_numpy_2D_array())
+
+    # Check that the fingerprint prefilter only skips pairs scoring below the graph cutoff
+    def test_fingerprint_prefilter(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        full = DBMolecules('test/chiral')
+        strict, loose = full.build_matrices()
+        db = DBMolecules('test/chiral', fp_cutoff=0.3)
+        f_strict, f_loose = db.build_matrices()
+        prefiltered = db.pair_status == dbmol.PAIR_PREFILTERED
+        self.assertGreater(prefiltered.sum(), 0)
+        self.assertTrue(all(f_strict.view(np.ndarray)[prefiltered] == 0.0))
+        self.assertTrue(all(strict.view(np.ndarray)[prefiltered] < 0.4))
+        self.assertTrue(all(f_strict.view(np.ndarray)[~prefiltered] == strict.view(np.ndarray)[~prefiltered]))
+        self.assertTrue(all(f_loose.view(np.ndarray)[~prefiltered] == loose.view(np.ndarray)[~prefiltered]))
+
+    # Check that the score upper bound only prunes pairs scoring below the prune cutoff
+    def test_score_bound_pruning(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        full = DBMolecules('test/chiral')
+        strict, loose = full.build_matrices()
+        db = DBMolecules('test/chiral', prune_cutoff=0.4)
+        p_strict, p_loose = db.build_matrices()
+        pruned = db.pair_status == dbmol.PAIR_PRUNED
+        self.assertGreater(pruned.sum(), 0)
+        self.assertTrue(all(strict.view(np.ndarray)[pruned] < 0.4))
+        self.assertTrue(all(p_strict.view(np.ndarray)[pruned] == 0.0))
+        self.assertTrue(all(p_strict.view(np.ndarray)[~pruned] == strict.view(np.ndarray)[~pruned]))
+        self.assertTrue(all(p_loose.view(np.ndarray)[~pruned] == loose.view(np.ndarray)[~pruned]))
+
+    # Check that only the pairs within each charge class are dispatched
+    def test_charge_classes(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        db = DBMolecules('test/chiral')
+        strict, loose = db.build_matrices()
+        charges = db.total_charges()
+        self.assertEqual(sorted(set(np.round(charges, 3))), [0.0, 1.0])
+
+        # All the pairs computed without charge classes
+        ref = DBMolecules('test/chiral')
+        ref_strict = dbmol.SMatrix(shape=(ref.nums(),))
+        ref_loose = dbmol.SMatrix(shape=(ref.nums(),))
+        ref_true_strict = dbmol.SMatrix(shape=(ref.nums(),))
+        ref.compute_mtx(0, ref_strict.size - 1, ref_strict, ref_loose, ref_true_strict, {})
+        assert (all(strict == ref_strict))
+        assert (all(loose == ref_loose))
+
+        for i in range(0, db.nums()):
+            for j in range(i + 1, db.nums()):
+                k = dbmol.pair_to_linear(i, j, db.nums())
+                if abs(charges[i] - charges[j]) < 1e-3:
+                    self.assertEqual(db.pair_status[k], dbmol.PAIR_SCORED)
+                else:
+                    self.assertEqual(db.pair_status[k], dbmol.PAIR_CHARGE)
+                    self.assertEqual(strict[i, j], 0.0)
+
+    # Check the distances updated as the edges are removed against the eccentricities of the graph
+    def test_distance_matrix(self):
+        rng = np.random.RandomState(7)
+        for seed in range(5):
+            graph = nx.connected_watts_strogatz_graph(30, 4, 0.3, seed=seed)
+            distances = graphgen.DistanceMatrix(graph)
+            for k in rng.permutation(graph.number_of_edges()):
+                u, v = list(graph.edges())[k % graph.number_of_edges()]
+                graph.remove_edge(u, v)
+                if not nx.is_connected(graph):
+                    graph.add_edge(u, v)
+                    continue
+                max_distance = int(rng.randint(3, 8))
+                node = distances.check_removed_edge(u, v, max_distance)
+                self.assertEqual(node is None, nx.diameter(graph) <= max_distance)
+                if node is None:
+                    distances.commit(u, v)
+                    expected = dict(nx.all_pairs_shortest_path_length(graph))
+                    for a in graph:
+                        for b in graph:
+                            self.assertEqual(distances.dist[distances.index[a], distances.index[b]], expected[a][b])
+                else:
+                    self.assertGreater(nx.eccentricity(graph, node), max_distance)
+                    graph.add_edge(u, v)
+                    with self.assertRaises(ValueError):
+                        distances.commit(u, v)
+
+        # The lengths are stored in the smallest type holding the number of nodes
+        self.assertEqual(graphgen.DistanceMatrix(nx.path_graph(30)).dist.dtype, np.int8)
+        for n in (127, 128):
+            graph = nx.cycle_graph(n)
+            distances = graphgen.DistanceMatrix(graph)
+            self.assertEqual(distances.dist.dtype, np.int8 if n == 127 else np.int16)
+            self.assertEqual(distances.ecc.max(), n // 2)
+            graph.remove_edge(n // 2, n // 2 + 1)
+            self.assertIsNone(distances.check_removed_edge(n // 2, n // 2 + 1, n))
+            distances.commit(n // 2, n // 2 + 1)
+            self.assertEqual(distances.dist[distances.index[n // 2], distances.index[n // 2 + 1]], n - 1)
+            self.assertEqual(distances.ecc.max(), n - 1)
+
+    def test_active_distances(self):
+        rng = np.random.RandomState(11)
+        for seed in range(10):
+            graph = nx.gnm_random_graph(30, 60, seed=seed)
+            for node in graph:
+                graph.nodes[node]['active'] = bool(rng.rand() < 0.15)
+            actives = [node for node in graph if graph.nodes[node]['active']]
+            cutoff = int(rng.randint(1, 4))
+            distances = graphgen.ActiveDistances(graph, cutoff)
+            for k in rng.permutation(graph.number_of_edges()):
+                u, v = list(graph.edges())[k % graph.number_of_edges()]
+                graph.remove_edge(u, v)
+                failures = distances.check_removed_edge(u, v)
+                lengths = nx.multi_source_dijkstra_path_length(graph, actives, cutoff=cutoff) if actives else {}
+                self.assertEqual(failures, graph.number_of_nodes() - len(lengths))
+                if rng.rand() < 0.5:
+                    distances.commit(u, v)
+                    self.assertEqual(distances.lengths, lengths)
+                else:
+                    graph.add_edge(u, v)
+
+    # Check that the two passes join the components with maximum spanning forests
+    def test_connect_components(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        db = DBMolecules('test/basic')
+        strict, loose = db.build_matrices()
+        scores = loose.to_numpy_2D_array()
+        rng = np.random.RandomState(3)
+        for trial in range(5):
+            graph = nx.Graph()
+            graph.add_nodes_from((i, {'ID': i}) for i in range(db.nums()))
+            graph.add_edges_from((int(a), int(b)) for a, b in rng.randint(0, db.nums(), size=(3, 2)) if a != b)
+            components = [sorted(c) for c in nx.connected_components(graph)]
+            contracted = nx.Graph()
+            contracted.add_nodes_from(range(len(components)))
+            for a in range(len(components)):
+                for b in range(a + 1, len(components)):
+                    best = scores[np.ix_(components[a], components[b])].max()
+                    if best > 0.0:
+                        contracted.add_edge(a, b, weight=best)
+
+            gen = graphgen.GraphGen.__new__(graphgen.GraphGen)
+            gen.dbase = db
+            gen.resultGraph = graph.copy()
+            gen.edgesAddedInFirstTreePass = []
+            gen.connect_graph_components_brute_force()
+            added = gen.edgesAddedInFirstTreePass
+            tree = nx.maximum_spanning_tree(contracted)
+            self.assertEqual(len(added), tree.number_of_edges())
+            self.assertAlmostEqual(sum(float(e[2]) for e in added), tree.size(weight='weight'), places=5)
+            self.assertEqual(len(gen.workingSubgraphsList), nx.number_connected_components(contracted))
+
+            # The second pass joins the same components without the edges of the first one
+            excluded = {frozenset(e[:2]) for e in added}
+            contracted = nx.Graph()
+            contracted.add_nodes_from(range(len(components)))
+            for a in range(len(components)):
+                for b in range(a + 1, len(components)):
+                    best = max([scores[k, l] for k in components[a] for l in components[b]
+                                if frozenset((k, l)) not in excluded] + [0.0])
+                    if best > 0.0:
+                        contracted.add_edge(a, b, weight=best)
+            gen.resultingSubgraphsList = [graph.subgraph(c).copy() for c in components]
+            gen.copyResultGraph = graph.copy()
+            gen.connect_graph_components_brute_force_2()
+            second = set(gen.copyResultGraph.edges()) - set(graph.edges())
+            self.assertFalse({frozenset(e) for e in second} & excluded)
+            tree = nx.maximum_spanning_tree(contracted)
+            self.assertEqual(len(second), tree.number_of_edges())
+            self.assertAlmostEqual(sum(scores[e] for e in second), tree.size(weight='weight'), places=5)
+
+    # Check the local cycle covering check against the bridges of the whole graph
+    def test_two_edge_connected(self):
+        for seed in range(10):
+            graph = nx.gnm_random_graph(20, 28, seed=seed)
+            bridges = set(nx.bridges(graph))
+            cycle_nodes = {node for cycle in nx.cycle_basis(graph) for node in cycle}
+            gen = graphgen.GraphGen.__new__(graphgen.GraphGen)
+            self.assertEqual(gen.find_non_cyclic_nodes(graph), {node for node in graph if node not in cycle_nodes})
+            for u, v in list(graph.edges()):
+                if (u, v) in bridges or (v, u) in bridges:
+                    continue
+                graph.remove_edge(u, v)
+                new_bridges = {frozenset(e) for e in nx.bridges(graph)} - {frozenset(e) for e in bridges}
+                self.assertEqual(graphgen.two_edge_connected(graph, u, v), not new_bridges)
+                graph.add_edge(u, v)
+
+    def test_nodes_connected(self):
+        for seed in range(10):
+            graph = nx.gnm_random_graph(20, 22, seed=seed)
+            for u in graph:
+                for v in graph:
+                    self.assertEqual(graphgen.nodes_connected(graph, u, v), nx.has_path(graph, u, v))
+
+    def test_component_labels(self):
+        for seed in range(10):
+            graph = nx.gnm_random_graph(40, 30 + seed, seed=seed)
+            edges = np.array(list(graph.edges()), dtype=int).reshape(-1, 2)
+            labels = graphgen.component_labels(graph.number_of_nodes(), edges[:, 0], edges[:, 1])
+            for component in nx.connected_components(graph):
+                self.assertEqual({int(labels[node]) for node in component}, {min(component)})
+
+    def test_linear_to_pair(self):
+        n = 7
+        i, j = dbmol.linear_to_pair(range(0, n * (n - 1) // 2), n)
+        k = 0
+        for a in range(0, n):
+            for b in range(a + 1, n):
+                self.assertEqual((i[k], j[k]), (a, b))
+                self.assertEqual(dbmol.pair_to_linear(b, a, n), k)
+                k += 1
+
+    # Check that the molecules are held as binaries, materialized once for the read only access
+    def test_molecule_access(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        rdmol = Chem.MolFromMol2File('test/basic/toluene.mol2', sanitize=False, removeHs=False)
+        binary = rdmol.ToBinary(Chem.PropertyPickleOptions.AllProps)
+        for source in (rdmol, binary, memoryview(binary)):
+            mol = dbmol.Molecule(source, 0, 'toluene.mol2')
+            self.assertEqual(bytes(mol.getBinary()), binary)
+            self.assertIs(mol.getMolecule(copy=False), mol.getMolecule(copy=False))
+            self.assertIsNot(mol.getMolecule(), mol.getMolecule(copy=False))
+            self.assertEqual(mol.getMolecule().GetAtomWithIdx(0).GetProp('_TriposPartialCharge'),
+                             rdmol.GetAtomWithIdx(0).GetProp('_TriposPartialCharge'))
+            loaded = pickle.loads(pickle.dumps(mol))
+            self.assertEqual(bytes(loaded.getBinary()), binary)
+
+        # The MCS does not set atom properties on the passed molecules
+        moli = Chem.MolFromMol2File('test/basic/toluene.mol2', sanitize=False, removeHs=False)
+        molj = Chem.MolFromMol2File('test/basic/1-butyl-4-methylbenzene.mol2', sanitize=False, removeHs=False)
+        MC = MCS(moli, molj)
+        self.assertTrue(MC.all_atom_match_list())
+        self.assertFalse(any(at.HasProp('to_mcs') for m in (moli, molj) for at in m.GetAtoms()))
+
+    # Check that prepared molecules reused across pairs give the same MCS as the RDKit molecules
+    def test_prepared_molecules(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        files = ['chlorophenol.sdf', 'chlorophenyl.sdf', 'chlorophenyl2.sdf', 'phenylfuran.sdf']
+        read = lambda f: Chem.MolFromMolFile('test/transforms/' + f, sanitize=False, removeHs=False)
+        for threed in (False, True):
+            options = argparse.Namespace(time=20, verbose='info', max3d=1000, threed=threed)
+            prepared = [mcs.PreparedMolecule(read(f), options) for f in files]
+            for a in range(0, len(files)):
+                for b in range(a + 1, len(files)):
+                    MC = MCS(read(files[a]), read(files[b]), options)
+                    MCp = MCS(prepared[a], prepared[b], options)
+                    self.assertEqual(MCp.all_atom_match_list(), MC.all_atom_match_list())
+                    self.assertEqual(MCp.mcsr(), MC.mcsr())
+                    self.assertEqual(MCp.hybridization_rule(), MC.hybridization_rule())
+            # The per pair atom properties are not set on the prepared molecules
+            self.assertFalse(any(at.HasProp('to_mcs') for p in prepared for at in p.mol.GetAtoms()))
+        with self.assertRaises(ValueError):
+            MCS(prepared[0], prepared[1], argparse.Namespace(time=20, verbose='info', max3d=1000, threed=False))
+
+        # If the hydrogens of one molecule are removed without sanitization, they are for both
+        fallback = prepared[1].fallback()
+        self.assertFalse(fallback.noh_sanitized)
+        self.assertIs(prepared[1].fallback(), fallback)
+        MC = MCS(prepared[0], fallback, options)
+        self.assertIs(MC._MCS__moli_noh, prepared[0].fallback().mol_noh)
+        self.assertIs(MC._MCS__molj_noh, fallback.mol_noh)
+        self.assertTrue(prepared[0].noh_sanitized)
+
+    # Check the index conversions of matrices too large for the floating point formula
+    def test_linear_to_pair_large(self):
+        n = 3 * 10 ** 9
+        l = n * (n - 1) // 2
+        ks = np.array([0, 1, n - 2, n - 1, l - n + 1, l - 2, l - 1, 123456789012345678])
+        i, j = dbmol.linear_to_pair(ks, n)
+        self.assertTrue(np.all((0 <= i) & (i < j) & (j < n)))
+        np.testing.assert_array_equal(dbmol.pair_to_linear(i, j, n), ks)
+
+    # Check the vectorised element access against the single element access
+    def test_smatrix_vector_access(self):
+        n = 7
+        dense = dbmol.SMatrix(shape=(n,))
+        dense[:] = np.round(np.random.RandomState(1).rand(n * (n - 1) // 2), 1)
+        sparse = dbmol.SparseSMatrix.from_dense(dense)
+        full = np.array([[dense[i, j] for j in range(0, n)] for i in range(0, n)])
+        for mat in (dense, sparse):
+            np.testing.assert_array_equal(mat.to_numpy_2D_array(), full)
+            i, j = np.array([0, 3, 6, 2]), np.array([5, 3, 1, 2])
+            np.testing.assert_array_equal(mat[i, j], full[i, j])
+            np.testing.assert_array_equal(mat[i[:, None], j[None, :]], full[i[:, None], j[None, :]])
+            for r in range(0, n):
+                np.testing.assert_array_equal(mat.row(r), full[r])
+                cols, values = mat.top_k(r, 3)
+                self.assertEqual(len(cols), 3)
+                self.assertNotIn(r, cols)
+                np.testing.assert_array_equal(values, full[r, cols])
+                self.assertEqual(list(values), sorted(np.delete(full[r], r), reverse=True)[:3])
+            pi, pj, values = mat.pairs_above(0.5)
+            self.assertEqual(sorted(zip(pi, pj)), [(a, b) for a in range(0, n) for b in range(a + 1, n)
+                                                   if full[a, b] > 0.5])
+            np.testing.assert_array_equal(values, full[pi, pj])
+            mat[np.array([1, 4]), np.array([0, 6])] = [0.25, 0.75]
+            self.assertEqual((mat[0, 1], mat[6, 4]), (0.25, 0.75))
+            with self.assertRaises(ValueError):
+                mat[np.array([2]), np.array([2])] = 1.0
+        self.assertTrue(np.shares_memory(dense.condensed(), dense))
+
+    # Check that the molecules read from a shared memory block match the database
+    def test_shared_molecule_store(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        db = DBMolecules('test/basic')
+        db[1].setActive(True)
+        store = molstore.SharedMoleculeStore.create(db[:])
+        self.addCleanup(store.close)
+        other = molstore.SharedMoleculeStore.attach(store.name)
+        self.addCleanup(other.close)
+        self.assertEqual(len(other.block), db.nums())
+        for i in range(0, db.nums()):
+            mol = other.block[i]
+            self.assertEqual(mol.getName(), db[i].getName())
+            self.assertEqual(mol.getID(), i)
+            self.assertEqual(mol.isActive(), i == 1)
+            self.assertEqual(Chem.MolToSmiles(mol.getMolecule()), Chem.MolToSmiles(db[i].getMolecule()))
+            # The mol2 partial charges are private atom properties
+            props = [a.GetPropsAsDict(True, True) for a in mol.getMolecule().GetAtoms()]
+            self.assertEqual(props, [a.GetPropsAsDict(True, True) for a in db[i].getMolecule().GetAtoms()])
+
+    # Check that each molecule is prepared once, whatever the cache size of the molecule block
+    def test_prepared_once_per_worker(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        db = DBMolecules('test/basic')
+        block = molstore.MoleculeBlock(molstore.pack_molecules(db[:]), cache_size=2)
+        view = DBMolecules.scoring_view(block, db.options, db.prespecified_links, charges=db.total_charges())
+
+        built = []
+
+        class CountedPreparedMolecule(mcs.PreparedMolecule):
+            def __init__(self, mol, options):
+                built.append(mol.GetNumAtoms())
+                super().__init__(mol, options)
+
+        self.addCleanup(setattr, mcs, 'PreparedMolecule', mcs.PreparedMolecule)
+        mcs.PreparedMolecule = CountedPreparedMolecule
+
+        strict = dbmol.SMatrix(shape=(db.nums(),))
+        view.compute_mtx(0, strict.size - 1, strict, {}, {}, {})
+        self.assertEqual(len(built), db.nums())
+        self.assertGreater(np.count_nonzero(strict), 0)
+
+    # Check that a molecule which cannot be prepared is tried once, rather than for each of its pairs
+    def test_prepared_once_on_failure(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for fname in ('2-methylnaphthalene.mol2', 'methylcyclohexane.mol2', 'toluene.mol2'):
+                shutil.copy(os.path.join('test/basic', fname), tmpdir)
+            bad = Chem.MolFromSmiles('C(C)(C)(C)(C)C', sanitize=False)
+            with open(os.path.join(tmpdir, 'pentavalent.sdf'), 'w') as f:
+                f.write(Chem.MolToMolBlock(bad, kekulize=False))
+            db = DBMolecules(tmpdir)
+
+        built = []
+
+        class CountedPreparedMolecule(mcs.PreparedMolecule):
+            def __init__(self, mol, options):
+                built.append(mol.GetNumAtoms())
+                super().__init__(mol, options)
+
+        self.addCleanup(setattr, mcs, 'PreparedMolecule', mcs.PreparedMolecule)
+        mcs.PreparedMolecule = CountedPreparedMolecule
+
+        strict = dbmol.SMatrix(shape=(db.nums(),))
+        db.compute_mtx(0, strict.size - 1, strict, {}, {}, {})
+        self.assertEqual(len(built), db.nums())
+        self.assertTrue(np.all(strict.to_numpy_2D_array()[2] == 0))
+        self.assertGreater(strict.to_numpy_2D_array()[0, 3], 0)
 
     def test_read_mol2_files(self):
         logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
@@ -113,6 +730,131 @@ class TestLomap(unittest.TestCase):
             db.read_molecule_files()
 
 
+    # Check that the molecules of multi record and gzipped files are named after the record titles
+    def test_read_multi_record_files(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        ref = DBMolecules('test/linksfile')
+        strict, loose = ref.build_matrices()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sdf_gz = os.path.join(tmpdir, 'library.sdf.gz')
+            with gzip.open(sdf_gz, 'wt') as out:
+                for fname in sorted(glob.glob('test/linksfile/*.sdf')):
+                    with open(fname) as f:
+                        out.write(f.read())
+            db = DBMolecules(sdf_gz)
+            self.assertEqual([db[i].getName() for i in range(db.nums())], ['phenyl', 'phenyl_cyclobutyl', 'phenylfuran', 'toluyl'])
+            m_strict, m_loose = db.build_matrices()
+            assert (all(m_strict == strict))
+
+            # A broken record is skipped, the repeated and missing titles are made unique
+            mol2 = os.path.join(tmpdir, 'library.mol2')
+            with open(mol2, 'w') as out:
+                for fname in sorted(glob.glob('test/basic/*.mol2'))[:3]:
+                    with open(fname) as f:
+                        out.write(f.read())
+                out.write('@<TRIPOS>MOLECULE\nbroken\n 1 0 0 0 0\n@<TRIPOS>ATOM\n')
+            names = [name for name, mol, error in readers.read_molecules([mol2, 'test/basic/toluene.mol2'])]
+            mols = [mol for name, mol, error in readers.read_molecules(mol2)]
+            self.assertEqual(names, ['*****', '*****_2', '*****_3', 'broken', 'toluene.mol2'])
+            self.assertEqual([mol is None for mol in mols], [False, False, False, True])
+            db = DBMolecules([mol2, os.path.join(tmpdir, '*.sdf.gz')])
+            self.assertEqual(db.nums(), 7)
+
+    # Check that the parallel parsing gives the molecules in the serial order and reports the invalid ones
+    def test_parallel_reading(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        serial = DBMolecules('test/chiral')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # A pentavalent carbon is parsed, but cannot be sanitized
+            bad = Chem.MolFromSmiles('C(C)(C)(C)(C)C', sanitize=False)
+            with open(os.path.join(tmpdir, 'pentavalent.sdf'), 'w') as f:
+                f.write(Chem.MolToMolBlock(bad, kekulize=False))
+            for parallel in (1, 3):
+                records = list(readers.read_molecules(['test/chiral', tmpdir], parallel=parallel, validate=True))
+                self.assertEqual([name for name, mol, error in records[:-1]],
+                                 [serial[i].getName() for i in range(serial.nums())])
+                self.assertEqual(records[-1][0], 'pentavalent.sdf')
+                self.assertIsNotNone(records[-1][1])
+                self.assertIn('sanitization', records[-1][2])
+
+                db = DBMolecules(['test/chiral', tmpdir], parallel=parallel)
+                self.assertEqual(db.nums(), serial.nums() + 1)
+                for i in range(serial.nums()):
+                    self.assertEqual(db[i].getMolecule().ToBinary(), serial[i].getMolecule().ToBinary())
+
+    # Check that a molecule which cannot be sanitized keeps its place in the IDs, and that its pairs are scored 0
+    def test_invalid_molecule_kept(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for fname in ('2-methylnaphthalene.mol2', 'methylcyclohexane.mol2', 'toluene.mol2'):
+                shutil.copy(os.path.join('test/basic', fname), tmpdir)
+            bad = Chem.MolFromSmiles('C(C)(C)(C)(C)C', sanitize=False)
+            with open(os.path.join(tmpdir, 'pentavalent.sdf'), 'w') as f:
+                f.write(Chem.MolToMolBlock(bad, kekulize=False))
+            names = ['2-methylnaphthalene.mol2', 'methylcyclohexane.mol2', 'pentavalent.sdf', 'toluene.mol2']
+            for parallel in (1, 2):
+                db = DBMolecules(tmpdir, parallel=parallel)
+                self.assertEqual([(db[i].getID(), db[i].getName()) for i in range(db.nums())], list(enumerate(names)))
+                strict, loose = db.build_matrices()
+                scores = strict.to_numpy_2D_array()
+                self.assertTrue(np.all(scores[2] == 0))
+                self.assertGreater(scores[0, 3], 0)
+
+    # Check that a molecule database written by lomap prepare gives the same molecules and scores
+    def test_molecule_database(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        ref = DBMolecules('test/basic')
+        strict, loose = ref.build_matrices()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'basic.lomapdb')
+            actives = os.path.join(tmpdir, 'actives.txt')
+            with open(actives, 'w') as f:
+                f.write('toluene.mol2\n')
+            progname = sys.argv[0]
+            sys.argv = [progname, 'prepare', 'test/basic', '-o', fname, '-v', 'off', '--known-actives-file', actives]
+            dbmol.startup()
+            sys.argv = [progname]
+            self.assertTrue(molstore.is_database(fname))
+
+            for parallel in (1, 2):
+                db = DBMolecules(fname, parallel=parallel)
+                self.assertEqual(db.nums(), ref.nums())
+                for i in range(db.nums()):
+                    self.assertEqual(db[i].getName(), ref[i].getName())
+                    self.assertEqual(db[i].isActive(), ref[i].getName() == 'toluene.mol2')
+                    self.assertIsInstance(db[i].getBinary(), memoryview)
+                self.assertEqual(db.known_actives, [ref.inv_dic_mapping['toluene.mol2']])
+                np.testing.assert_array_equal(db._charges, ref.total_charges())
+                np.testing.assert_array_equal(db._atom_counts, ref.atom_counts())
+                d_strict, d_loose = db.build_matrices()
+                assert (all(d_strict == strict))
+                self.assertEqual(db.mcs_map_store, ref.mcs_map_store)
+                del db, d_strict, d_loose
+
+            # The input is checked and the database opened once
+            opened = []
+
+            class CountedMoleculeDatabase(molstore.MoleculeDatabase):
+                def __init__(self, fname):
+                    opened.append(fname)
+                    super().__init__(fname)
+
+            self.addCleanup(setattr, molstore, 'MoleculeDatabase', molstore.MoleculeDatabase)
+            molstore.MoleculeDatabase = CountedMoleculeDatabase
+            checked = []
+            is_database = molstore.is_database
+            self.addCleanup(setattr, molstore, 'is_database', is_database)
+            molstore.is_database = lambda fname: checked.append(fname) or is_database(fname)
+            db = DBMolecules(fname)
+            self.assertEqual((opened, checked), ([fname], [fname]))
+            del db
+            checked.clear()
+            DBMolecules('test/basic')
+            self.assertEqual(checked, ['test/basic'])
+
+            with self.assertRaises(IOError):
+                DBMolecules([fname, 'test/basic'])
+
     # Test which heterocycles I can grow (growing off a phenyl)
     # Test by Max indicates that growing complex heterocycles tends
     # to fail, so only allow growing phenyl, furan and pyrrole
@@ -206,6 +948,19 @@ class TestLomap(unittest.TestCase):
         self.assertEqual(MCS1.mcs_mol.GetNumHeavyAtoms(),9)
         self.assertEqual(MCS2.mcs_mol.GetNumHeavyAtoms(),8)
 
+    # Test that the trimming on 3D keeps the atoms of the best matches, among the symmetry equivalent ones
+    def test_clip_on_3d_mapping_string(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        mol1 = Chem.MolFromMol2File('test/radial/ejm_47.mol2',sanitize=False, removeHs=False)
+        mol2 = Chem.MolFromMol2File('test/radial/ejm_48.mol2',sanitize=False, removeHs=False)
+        lg = RDLogger.logger()
+        lg.setLevel(RDLogger.CRITICAL)
+        testdata=[(False,"0:0,1:1,2:2,3:3,4:4,5:5,7:7,8:8,19:19,24:25,25:26,26:27"),
+                  (True,"0:0,1:5,2:4,3:3,4:2,5:1,7:7,8:8,19:6,24:25,25:27,26:26")]
+        for d in testdata:
+            MC = MCS(Chem.Mol(mol1),Chem.Mol(mol2),options=argparse.Namespace(time=20, verbose='info', max3d=1.0, threed=d[0]))
+            self.assertEqual(MC.all_atom_match_list(), d[1])
+
     # Test disallowing turning a methyl group (or larger) into a ring atom
     def test_transmuting_methyl_into_ring_rule(self):
         logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
@@ -403,6 +1158,35 @@ class TestLomap(unittest.TestCase):
         self.assertEqual(self.fields_for_link('phenylcyclobutyl.sdf','toluyl.sdf')[7],"No")
         self.assertEqual(self.fields_for_link('phenylfuran.sdf','toluyl.sdf')[7],"Yes")
 
+    # Check that the limited score report lists the graph edges and the best partners
+    def test_score_report_top(self):
+        logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
+        progname=sys.argv[0]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            name = os.path.join(tmpdir, 'top')
+            sys.argv=[progname,'-o','--output-no-images','--output-no-graph','-n',name,'--score-report-top','1',
+                      'test/basic']
+            dbmol.startup()
+            with open(name + '.pickle', 'rb') as f:
+                graph = pickle.load(f)
+            with open(name + '_score_with_connection.txt') as f:
+                lines = f.readlines()[1:]
+        # The file names can hold commas, so the connection field is found by its value
+        fields = [[field.strip() for field in line.split(',')] for line in lines]
+        pairs = [(int(field[0]), int(field[1])) for field in fields]
+        self.assertEqual(pairs, sorted(set(pairs)))
+        self.assertTrue(all(i < j for i, j in pairs))
+        linked = {pair for pair, field in zip(pairs, fields) if 'Yes' in field}
+        self.assertEqual(linked, {(min(u, v), max(u, v)) for u, v in graph.resultGraph.edges()})
+        strict = graph.dbase.strict_mtx
+        for i in range(graph.dbase.nums()):
+            cols, values = strict.top_k(i, 1)
+            self.assertIn((min(i, cols[0]), max(i, cols[0])), pairs)
+        self.assertLess(len(pairs), graph.dbase.nums() * (graph.dbase.nums() - 1) // 2)
+        # A negative number of partners is rejected
+        with self.assertRaises(argparse.ArgumentTypeError):
+            dbmol.parser.parse_args(['--score-report-top=-1', 'test/basic'])
+
     def test_linksfile(self):
         """ Test a linksfile forcing a link from phenyl to phenylfuran. """
         logging.basicConfig(format='%(message)s', level=logging.CRITICAL)